@@ -0,0 +1,123 @@
+"""Estimate the resources of cluster jobs before running them."""
+
+import logging
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+import psutil
+
+from .ms_trees import ClusterRun, estimate_Consumption
+
+LOG = logging.getLogger(__name__)
+
+OUT_OF_CORE_METHODS = ("MSTree", "MSTreeV2")
+
+
+@dataclass
+class JobPlan:
+    """How a cluster job should be run."""
+
+    n_profile: int
+    n_loci: int
+    estimated_time: float
+    estimated_memory: float
+    memory_budget: float
+    out_of_core: bool = False
+    forward: bool = False
+
+    def as_meta(self) -> dict:
+        """Get the plan as a job meta entry."""
+        return asdict(self)
+
+
+def profile_size(profile: str) -> tuple[int, int]:
+    """Get the number of profiles and loci of a tsv profile without parsing it."""
+    lines = [
+        line
+        for line in profile.split("\n")
+        if line.strip() and not line.startswith("##")
+    ]
+    if not lines:
+        return 0, 0
+    header = lines[0].strip().split("\t")
+    n_loci = sum(
+        1
+        for col in header[1:]
+        if not col.startswith("#") and col.lower() not in {"st_id", "st"}
+    )
+    return len(lines) - 1, n_loci
+
+
+def plan_job(
+    method: str,
+    n_profile: int,
+    n_loci: int,
+    memory_budget: float | None = None,
+    large_job_runtime: float | None = None,
+) -> JobPlan:
+    """Decide how to run a job from its estimated time and memory consumption.
+
+    Jobs that need more memory than the budget are run with the distance matrix on
+    disk if the method supports it. Jobs that run longer than large_job_runtime
+    seconds should be forwarded to the queue for large jobs.
+
+    :raises ValueError: if the job would not fit in the memory budget.
+    """
+    params = ClusterRun(method=method).params
+    estimated_time, estimated_memory = estimate_Consumption(
+        platform.system(),
+        params["method"],
+        params["matrix_type"],
+        int(params["n_proc"]),
+        n_loci,
+        n_profile,
+    )
+    if memory_budget is None:
+        memory_budget = psutil.virtual_memory().available
+    plan = JobPlan(
+        n_profile=n_profile,
+        n_loci=n_loci,
+        estimated_time=estimated_time,
+        estimated_memory=estimated_memory,
+        memory_budget=memory_budget,
+    )
+    if estimated_memory > memory_budget:
+        if method not in OUT_OF_CORE_METHODS:
+            msg = (
+                f"Clustering {n_profile} samples with {method} needs an estimated "
+                f"{estimated_memory / 2**30:.1f} GiB of memory, the limit is "
+                f"{memory_budget / 2**30:.1f} GiB"
+            )
+            LOG.error(msg)
+            raise ValueError(msg)
+        LOG.info("Keeping the distance matrix of %d samples on disk", n_profile)
+        plan.out_of_core = True
+    if large_job_runtime is not None and estimated_time > large_job_runtime:
+        plan.forward = True
+    return plan
+
+
+@contextmanager
+def monitor_resources(interval: float = 0.5):
+    """Measure the runtime and peak resident memory of the process."""
+    usage = {"runtime": None, "max_rss": psutil.Process().memory_info().rss}
+    done = threading.Event()
+
+    def sample():
+        process = psutil.Process()
+        while not done.wait(interval):
+            usage["max_rss"] = max(usage["max_rss"], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        yield usage
+    finally:
+        done.set()
+        sampler.join()
+        usage["runtime"] = time.perf_counter() - start
+        usage["max_rss"] = max(usage["max_rss"], psutil.Process().memory_info().rss)
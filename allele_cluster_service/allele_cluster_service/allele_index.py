@@ -0,0 +1,444 @@
+"""Inverted index of allele profiles for finding the closest samples.
+
+Each sample is given a row of integer allele codes in a memory mapped file. For
+every locus the rows are also sorted by allele, which gives the rows with an allele,
+the posting list of a (locus, allele), as a slice. Rows are never changed once
+written, a sample whose profile changed is given a new row, so the posting lists
+stay valid as samples are added and only the newest rows need to be scanned. The
+newest rows are merged into the posting lists in batches. Rows of removed samples
+and old profiles are dropped when they make up a large part of the matrix.
+"""
+
+import fcntl
+import json
+import logging
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# rows added after the posting lists were written are scanned until there are this
+# many, then they are merged into the posting lists
+MERGE_ROWS = 1024
+# rows of removed samples and old profiles are reclaimed when there are at least
+# MERGE_ROWS of them and they are this fraction of the rows
+RECLAIM_FRACTION = 0.25
+# loci compared at a time when counting the mismatches of the candidates
+VERIFY_LOCI = 256
+# arrays of the posting lists, each stored as a npy file
+POSTING_ARRAYS = ("rows", "keys", "starts", "ends")
+
+
+class AlleleIndex:
+    """Allele profiles of samples indexed by locus and allele.
+
+    The posting lists of a locus are the rows sorted by their allele at the locus,
+    stored in one array per locus, together with the sorted allele codes and where
+    their rows start and end. Missing alleles, coded as 0, have a posting list too.
+    The arrays are written to a new directory every merge and memory mapped by the
+    processes querying the index.
+    """
+
+    def __init__(self, directory: str | Path):
+        """Open, or create, an allele index in a directory."""
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = self.directory / "index.lock"
+        self._index_file = self.directory / "index.json"
+        self._thread_lock = threading.Lock()
+        self._postings = None
+
+    @contextmanager
+    def _locked(self):
+        """Lock the index for other threads and processes."""
+        with self._thread_lock, open(self._lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> dict:
+        index = {
+            "loci": [],
+            "n_rows": 0,
+            "samples": {},
+            "version": 0,
+            "allele_file": "alleles.u32",
+            # directory of the posting lists and the number of rows they cover
+            "postings": None,
+            "n_indexed": 0,
+        }
+        if self._index_file.exists():
+            with open(self._index_file, encoding="utf-8") as inpt:
+                index.update(json.load(inpt))
+        return index
+
+    def _write_index(self, index: dict):
+        tmp_file = self._index_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as out:
+            json.dump(index, out)
+        tmp_file.replace(self._index_file)
+
+    def _open_alleles(self, index: dict, n_rows: int, mode: str = "r") -> np.ndarray:
+        """Open the allele matrix, growing it to n_rows rows when writing."""
+        n_loci = len(index["loci"])
+        if n_rows == 0:
+            return np.zeros([0, n_loci], dtype=np.uint32)
+        allele_file = self.directory / index["allele_file"]
+        if mode != "r":
+            allele_file.touch()
+            if allele_file.stat().st_size < n_rows * n_loci * 4:
+                with open(allele_file, "r+b") as out:
+                    out.truncate(n_rows * n_loci * 4)
+        return np.memmap(
+            allele_file, dtype=np.uint32, mode=mode, shape=(n_rows, n_loci)
+        )
+
+    def _open(self):
+        """Read the index and open its allele matrix and posting lists.
+
+        The files are replaced when rows are reclaimed, the index is read again if
+        they were replaced after it was read.
+        """
+        try:
+            index = self._read_index()
+            matrix = self._open_alleles(index, index["n_rows"])
+            return index, matrix, self._open_postings(index)
+        except FileNotFoundError:
+            index = self._read_index()
+            matrix = self._open_alleles(index, index["n_rows"])
+            return index, matrix, self._open_postings(index)
+
+    def __len__(self):
+        return len(self._read_index()["samples"])
+
+    def add(self, names, loci, alleles) -> int:
+        """Add, or update, the allele profiles of samples.
+
+        Profiles are matched to the loci of the index by name. Loci that are not in
+        the index are added to it, as missing alleles in the profiles already added.
+
+        :param names: sample ids
+        :param loci: locus names of the columns of alleles
+        :param alleles: integer allele codes with 0 for missing alleles
+        :return: the number of new or changed profiles
+        """
+        alleles = np.asarray(alleles)
+        with self._locked():
+            index = self._read_index()
+            added_loci = self._add_loci(index, [str(locus) for locus in loci])
+            columns = {locus: i for i, locus in enumerate(index["loci"])}
+            target = np.array([columns[str(locus)] for locus in loci], dtype=int)
+            codes = np.zeros([len(names), len(index["loci"])], dtype=np.uint32)
+            codes[:, target] = alleles
+
+            matrix = self._open_alleles(index, index["n_rows"])
+            new = []
+            for name, profile in zip(names, codes):
+                row = index["samples"].get(str(name))
+                if row is None or not np.array_equal(matrix[row], profile):
+                    new.append(str(name))
+            if new:
+                n_rows = index["n_rows"]
+                matrix = self._open_alleles(index, n_rows + len(new), mode="r+")
+                changed = np.isin(np.asarray(names, dtype=str), new)
+                matrix[n_rows:] = codes[changed]
+                matrix.flush()
+                for row, name in enumerate(new, start=n_rows):
+                    index["samples"][name] = row
+                index["n_rows"] += len(new)
+            if index["n_rows"] - index["n_indexed"] >= MERGE_ROWS:
+                self._merge_postings(index, matrix)
+            elif new or added_loci:
+                self._write_index(index)
+                self._remove_stale_files(index)
+        LOG.info("Added %d new or changed profiles to the allele index", len(new))
+        return len(new)
+
+    def _add_loci(self, index: dict, loci: list[str]) -> bool:
+        """Append the loci that are not in the index as new columns.
+
+        The new columns are missing alleles in the rows already added. The allele
+        matrix is copied to a file with the new columns and the posting lists are
+        built again from all rows at the next merge.
+
+        :return: True if loci were added
+        """
+        known = set(index["loci"])
+        new_loci = [locus for locus in dict.fromkeys(loci) if locus not in known]
+        if not new_loci:
+            return False
+        n_rows, n_known = index["n_rows"], len(index["loci"])
+        matrix = self._open_alleles(index, n_rows)
+        index["loci"] = index["loci"] + new_loci
+        if n_rows > 0:
+            version = index["version"] + 1
+            allele_file = f"alleles.{version}.u32"
+            widened = np.memmap(
+                self.directory / allele_file,
+                dtype=np.uint32,
+                mode="w+",
+                shape=(n_rows, len(index["loci"])),
+            )
+            step = max(2**24 // max(n_known, 1), 1)
+            for first in range(0, n_rows, step):
+                widened[first : first + step, :n_known] = matrix[first : first + step]
+            widened.flush()
+            del widened
+            index.update(
+                version=version, allele_file=allele_file, postings=None, n_indexed=0
+            )
+        LOG.info("Added %d loci to the allele index", len(new_loci))
+        return True
+
+    def remove(self, names) -> int:
+        """Remove samples from the index and get how many were removed."""
+        with self._locked():
+            index = self._read_index()
+            removed = [
+                name
+                for name in names
+                if index["samples"].pop(str(name), None) is not None
+            ]
+            if removed and self._n_reclaimable(index) > 0:
+                self._merge_postings(index, self._open_alleles(index, index["n_rows"]))
+            elif removed:
+                self._write_index(index)
+        return len(removed)
+
+    @staticmethod
+    def _n_reclaimable(index: dict) -> int:
+        """Get the number of rows to reclaim, or 0 if there are too few of them."""
+        n_dead = index["n_rows"] - len(index["samples"])
+        if n_dead < max(MERGE_ROWS, RECLAIM_FRACTION * index["n_rows"]):
+            return 0
+        return n_dead
+
+    @staticmethod
+    def _posting_lists(postings: dict, locus: int):
+        """Get the rows of a locus in the posting lists and their sorted alleles."""
+        bounds = np.array([locus, locus + 1], dtype=np.uint64) << np.uint64(32)
+        first, last = np.searchsorted(postings["keys"], bounds)
+        starts, ends = postings["starts"][first:last], postings["ends"][first:last]
+        values = (postings["keys"][first:last] & np.uint64(0xFFFFFFFF)).astype(
+            np.uint32
+        )
+        return np.asarray(postings["rows"][locus]), np.repeat(values, ends - starts)
+
+    def _merge_postings(self, index: dict, matrix: np.ndarray):
+        """Merge the rows added since the posting lists were written into them.
+
+        For every locus the new rows are sorted by their allele and inserted after
+        the indexed rows with the same allele, which keeps the posting lists sorted
+        without sorting the indexed rows again. Rows of removed samples and old
+        profiles are left out, and are removed from the allele matrix when there
+        are enough of them to reclaim. Writes the index.
+        """
+        n_rows, n_loci = matrix.shape
+        live = np.zeros(n_rows, dtype=bool)
+        live[list(index["samples"].values())] = True
+        n_live = int(live.sum())
+        reclaim = self._n_reclaimable(index) > 0
+        # rows are numbered by their rank among the live rows once reclaimed
+        renumber = np.cumsum(live) - 1 if reclaim else np.arange(n_rows)
+        postings = self._open_postings(index)
+        n_indexed = index["n_indexed"]
+        new_rows = np.flatnonzero(live[n_indexed:]) + n_indexed
+
+        version = index["version"] + 1
+        name = f"postings.{version}"
+        tmp_dir = self.directory / f"{name}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+        rows = np.lib.format.open_memmap(
+            tmp_dir / "rows.npy", mode="w+", dtype=np.uint32, shape=(n_loci, n_live)
+        )
+        keys, starts, ends = [], [], []
+        step = max(2**24 // max(new_rows.size, 1), 1)
+        for first in range(0, n_loci, step):
+            block = np.asarray(matrix[n_indexed:, first : first + step])
+            block = np.ascontiguousarray(block[live[n_indexed:]].T)
+            for locus, column in enumerate(block, start=first):
+                order = np.argsort(column, kind="stable")
+                merged, alleles = new_rows[order], column[order]
+                if postings is not None:
+                    indexed, indexed_alleles = self._posting_lists(postings, locus)
+                    kept = live[indexed]
+                    indexed, indexed_alleles = indexed[kept], indexed_alleles[kept]
+                    pos = np.searchsorted(indexed_alleles, alleles, side="right")
+                    merged = np.insert(indexed, pos, merged)
+                    alleles = np.insert(indexed_alleles, pos, alleles)
+                is_start = np.ones(alleles.size, dtype=bool)
+                is_start[1:] = alleles[1:] != alleles[:-1]
+                start = np.flatnonzero(is_start)
+                rows[locus] = renumber[merged]
+                keys.append((np.uint64(locus) << np.uint64(32)) | alleles[start])
+                starts.append(start)
+                ends.append(np.append(start[1:], alleles.size))
+        rows.flush()
+        del rows
+        np.save(
+            tmp_dir / "keys.npy",
+            np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64),
+        )
+        np.save(
+            tmp_dir / "starts.npy",
+            np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64),
+        )
+        np.save(
+            tmp_dir / "ends.npy",
+            np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64),
+        )
+        tmp_dir.replace(self.directory / name)
+
+        if reclaim:
+            allele_file = f"alleles.{version}.u32"
+            kept_rows = np.flatnonzero(live)
+            compacted = np.memmap(
+                self.directory / allele_file,
+                dtype=np.uint32,
+                mode="w+",
+                shape=(n_live, n_loci),
+            )
+            step = max(2**24 // max(n_loci, 1), 1)
+            for first in range(0, n_live, step):
+                chunk = kept_rows[first : first + step]
+                compacted[first : first + chunk.size] = matrix[chunk]
+            compacted.flush()
+            del compacted
+            index["samples"] = {
+                sample: int(renumber[row]) for sample, row in index["samples"].items()
+            }
+            index.update(allele_file=allele_file, n_rows=n_live)
+            LOG.info("Reclaimed %d rows of the allele index", n_rows - n_live)
+        index.update(version=version, postings=name, n_indexed=index["n_rows"])
+        self._write_index(index)
+        self._remove_stale_files(index)
+        LOG.debug("Merged %d rows into the posting lists", new_rows.size)
+
+    def _remove_stale_files(self, index: dict):
+        """Remove the allele matrices and posting lists the index no longer uses."""
+        for path in self.directory.glob("postings.*"):
+            if path.name != index["postings"]:
+                shutil.rmtree(path, ignore_errors=True)
+        for path in self.directory.glob("alleles.*u32"):
+            if path.name != index["allele_file"]:
+                path.unlink(missing_ok=True)
+
+    def _open_postings(self, index: dict) -> dict | None:
+        """Get the memory mapped posting lists of the index."""
+        name = index["postings"]
+        if name is None:
+            return None
+        if self._postings is None or self._postings["name"] != name:
+            path = self.directory / name
+            postings = {
+                key: np.load(path / f"{key}.npy", mmap_mode="r")
+                for key in POSTING_ARRAYS
+            }
+            self._postings = dict(postings, name=name, n_rows=index["n_indexed"])
+        return self._postings
+
+    def _candidates(self, postings: dict, profile: np.ndarray, max_distance: int):
+        """Get the indexed rows that can be within max_distance of a profile.
+
+        A row that neither has the allele of the profile, nor a missing allele, at
+        max_distance + 1 of its called loci has more mismatches than max_distance.
+        The loci with the shortest posting lists are used to get few candidates.
+        """
+        called = np.flatnonzero(profile > 0).astype(np.uint64)
+        if called.size <= max_distance:
+            return np.arange(postings["n_rows"])
+        keys = postings["keys"]
+        if keys.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        slices = []
+        for allele in (profile[called.astype(int)], np.zeros(called.size, np.uint64)):
+            query = (called << np.uint64(32)) | allele.astype(np.uint64)
+            pos = np.minimum(np.searchsorted(keys, query), keys.size - 1)
+            found = keys[pos] == query
+            start = np.where(found, postings["starts"][pos], 0)
+            end = np.where(found, postings["ends"][pos], 0)
+            slices.append((start, end))
+        sizes = sum(end - start for start, end in slices)
+        shortest = np.argsort(sizes, kind="stable")[: max_distance + 1]
+        rows = [
+            postings["rows"][int(called[i]), start[i] : end[i]]
+            for i in shortest
+            for start, end in slices
+        ]
+        return np.unique(np.concatenate(rows)).astype(np.int64)
+
+    def _near(self, sample_id: str, max_distance: int):
+        """Get the rows of the samples that can be within max_distance of a sample.
+
+        :raises ValueError: if the sample is not in the index
+        :return: the allele matrix, the profile of the sample, the candidate rows
+            and their sample ids
+        """
+        index, matrix, postings = self._open()
+        if sample_id not in index["samples"]:
+            raise ValueError(f"Sample {sample_id} is not in the allele index")
+        n_rows = index["n_rows"]
+        profile = np.array(matrix[index["samples"][sample_id]])
+
+        n_indexed = 0
+        candidates = [np.zeros(0, dtype=np.int64)]
+        if postings is not None:
+            n_indexed = min(int(postings["n_rows"]), n_rows)
+            candidates.append(self._candidates(postings, profile, max_distance))
+        candidates.append(np.arange(n_indexed, n_rows))
+        candidates = np.concatenate(candidates)
+
+        # rows of removed samples and old profiles are not in the sample map
+        names = np.array(list(index["samples"]), dtype=object)
+        sample_of_row = np.full(n_rows, -1, dtype=np.int64)
+        sample_of_row[list(index["samples"].values())] = np.arange(names.size)
+        sample_of_row[index["samples"][sample_id]] = -1
+        candidates = candidates[sample_of_row[candidates] >= 0]
+        return matrix, profile, candidates, names[sample_of_row[candidates]]
+
+    def profiles_near(self, sample_id: str, max_distance: int):
+        """Get the profiles of the samples that can be within max_distance of a sample.
+
+        :raises ValueError: if the sample is not in the index
+        :return: the profile of the sample and the sample ids and profiles of the
+            candidates
+        """
+        matrix, profile, candidates, names = self._near(sample_id, max_distance)
+        return profile, names.tolist(), np.asarray(matrix[candidates])
+
+    def neighbours(
+        self, sample_id: str, max_distance: int, limit: int | None = None
+    ) -> list[dict]:
+        """Find the samples with at most max_distance allele differences to a sample.
+
+        Loci missing in either sample are not counted.
+
+        :raises ValueError: if the sample is not in the index
+        :return: sample ids and number of differing alleles, closest first
+        """
+        matrix, profile, candidates, names = self._near(sample_id, max_distance)
+        # mismatches counted so far are a lower bound, drop candidates that exceed
+        # the maximum distance before counting the rest
+        mismatches = np.zeros(candidates.size, dtype=np.int64)
+        for first in range(0, profile.size, VERIFY_LOCI):
+            if candidates.size == 0:
+                break
+            cols = slice(first, first + VERIFY_LOCI)
+            block = matrix[candidates, cols]
+            alleles = profile[cols]
+            mismatches += np.sum((block != alleles) & (block > 0) & (alleles > 0), 1)
+            within = mismatches <= max_distance
+            candidates, mismatches = candidates[within], mismatches[within]
+            names = names[within]
+
+        hits = sorted(zip(mismatches.tolist(), names.tolist()))
+        return [
+            {"sample_id": name, "distance": distance} for distance, name in hits[:limit]
+        ]
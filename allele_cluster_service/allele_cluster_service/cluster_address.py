@@ -0,0 +1,217 @@
+"""Single linkage cluster addresses of samples at fixed allele distance thresholds.
+
+Samples are assigned to clusters as they are added. A sample within the threshold
+of samples in several clusters merges them into the oldest one, clusters are never
+split, which keeps the addresses of samples stable. The merges are appended to a
+log next to the addresses.
+"""
+
+import fcntl
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from .allele_index import AlleleIndex
+from .ms_trees import distance_matrix
+
+LOG = logging.getLogger(__name__)
+
+
+def _find(parent: list[int], cluster: int) -> int:
+    """Find the cluster a cluster was merged into, compressing the path to it."""
+    top = cluster
+    while parent[top] >= 0:
+        top = parent[top]
+    while parent[cluster] >= 0 and parent[cluster] != top:
+        parent[cluster], cluster = top, parent[cluster]
+    return top
+
+
+class ClusterAddresses:
+    """Cluster addresses kept with one union-find of clusters per threshold.
+
+    Clusters are numbered from 1 for each threshold. The address of a sample lists
+    its clusters from the largest to the smallest threshold.
+    """
+
+    def __init__(self, directory: str | Path, thresholds=(5, 10, 25, 50)):
+        """Open, or create, the cluster addresses in a directory.
+
+        The thresholds of existing addresses are kept.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = self.directory / "addresses.lock"
+        self._state_file = self.directory / "addresses.json"
+        self._merge_file = self.directory / "merges.jsonl"
+        self._thread_lock = threading.Lock()
+        self.thresholds = sorted(int(t) for t in thresholds)
+        if self._state_file.exists():
+            self.thresholds = self._read_state()["thresholds"]
+
+    @contextmanager
+    def _locked(self):
+        """Lock the addresses for other threads and processes."""
+        with self._thread_lock, open(self._lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_state(self) -> dict:
+        if not self._state_file.exists():
+            return {
+                "thresholds": self.thresholds,
+                # parent of each cluster, or -1, with an unused cluster 0
+                "parent": [[-1] for _ in self.thresholds],
+                "samples": {},
+            }
+        with open(self._state_file, encoding="utf-8") as inpt:
+            return json.load(inpt)
+
+    def _write_state(self, state: dict):
+        tmp_file = self._state_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as out:
+            json.dump(state, out)
+        tmp_file.replace(self._state_file)
+
+    def _read_merges(self) -> dict[str, list[dict]]:
+        """Read the merges caused by each sample from the merge log."""
+        merges: dict[str, list[dict]] = {}
+        if not self._merge_file.exists():
+            return merges
+        with open(self._merge_file, encoding="utf-8") as inpt:
+            for line in inpt:
+                merge = json.loads(line)
+                merges.setdefault(merge["sample_id"], []).append(
+                    {key: merge[key] for key in ("threshold", "clusters", "cluster")}
+                )
+        return merges
+
+    def _append_merges(self, merges: list[dict]):
+        with open(self._merge_file, "a", encoding="utf-8") as out:
+            for merge in merges:
+                out.write(json.dumps(merge) + "\n")
+
+    def _format(self, state: dict, sample_id: str) -> dict:
+        clusters = [
+            _find(parent, cluster)
+            for parent, cluster in zip(state["parent"], state["samples"][sample_id])
+        ]
+        return {
+            "thresholds": state["thresholds"],
+            "clusters": clusters,
+            "address": ".".join(str(cluster) for cluster in clusters[::-1]),
+        }
+
+    def addresses(self, names=None) -> dict[str, dict]:
+        """Get the addresses of samples, or of all samples, with their merges.
+
+        Samples without an address are left out.
+        """
+        with self._locked():
+            state = self._read_state()
+            merges = self._read_merges()
+        names = state["samples"] if names is None else names
+        return {
+            name: dict(self._format(state, name), merges=merges.get(name, []))
+            for name in names
+            if name in state["samples"]
+        }
+
+    def address(self, sample_id: str) -> dict | None:
+        """Get the thresholds, clusters, address and merges of a sample."""
+        return self.addresses([sample_id]).get(sample_id)
+
+    def assign(self, sample_id: str, index: AlleleIndex) -> dict[str, dict]:
+        """Assign a sample in the allele index to clusters, merging clusters it links.
+
+        Distances are the number of differing alleles called in both samples.
+
+        :return: address of the sample, with the merges it caused, and the addresses
+            of the samples in the clusters it merged
+        """
+        with self._locked():
+            state = self._read_state()
+            profile, names, profiles = index.profiles_near(
+                sample_id, max(state["thresholds"])
+            )
+            profiles = np.vstack([profile, profiles])
+            mismatch, _ = distance_matrix.pair_counts(
+                profiles,
+                np.zeros(len(names), dtype=np.int64),
+                np.arange(1, len(names) + 1, dtype=np.int64),
+            )
+            assigned = {
+                name: distance
+                for name, distance in zip(names, mismatch.tolist())
+                if name in state["samples"]
+            }
+
+            clusters, merges, changed = [], [], set()
+            previous = state["samples"].get(sample_id)
+            for k, threshold in enumerate(state["thresholds"]):
+                parent = state["parent"][k]
+                linked = {
+                    _find(parent, state["samples"][name][k])
+                    for name, distance in assigned.items()
+                    if distance <= threshold
+                }
+                if previous is not None:
+                    linked.add(_find(parent, previous[k]))
+                if not linked:
+                    parent.append(-1)
+                    linked.add(len(parent) - 1)
+                cluster = min(linked)
+                clusters.append(cluster)
+                if len(linked) > 1:
+                    # samples in the merged clusters get new addresses
+                    others = linked - {cluster}
+                    changed.update(
+                        name
+                        for name, sample_clusters in state["samples"].items()
+                        if _find(parent, sample_clusters[k]) in others
+                    )
+                    for other in others:
+                        parent[other] = cluster
+                    merges.append(
+                        {
+                            "threshold": threshold,
+                            "clusters": sorted(linked),
+                            "cluster": cluster,
+                        }
+                    )
+            state["samples"][sample_id] = clusters
+            # samples in merged clusters only change address, their merges are kept
+            addresses = {name: self._format(state, name) for name in changed}
+            addresses[sample_id] = dict(self._format(state, sample_id), merges=merges)
+            self._write_state(state)
+            merged_at = datetime.now(timezone.utc).isoformat()
+            self._append_merges(
+                [
+                    dict(merge, sample_id=sample_id, merged_at=merged_at)
+                    for merge in merges
+                ]
+            )
+        if merges:
+            LOG.info("Sample %s merged %d clusters", sample_id, len(merges))
+        return addresses
+
+    def remove(self, names) -> int:
+        """Remove samples, leaving the clusters they linked, and get the count."""
+        with self._locked():
+            state = self._read_state()
+            removed = [
+                name
+                for name in names
+                if state["samples"].pop(str(name), None) is not None
+            ]
+            if removed:
+                self._write_state(state)
+        return len(removed)
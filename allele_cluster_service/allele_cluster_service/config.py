@@ -5,7 +5,39 @@ from os import getenv
 # Redis variables
 REDIS_HOST = getenv("REDIS_HOST", "redis")
 REDIS_PORT = getenv("REDIS_PORT", "6379")
-REDIS_QUEUE = "allele_cluster"
+REDIS_QUEUE = getenv("REDIS_QUEUE", "allele_cluster")
+
+# Admission control of cluster jobs. Jobs are estimated to fit in MEMORY_BUDGET
+# bytes, by default the available memory, and sent to LARGE_JOB_QUEUE if they are
+# estimated to run longer than LARGE_JOB_RUNTIME seconds. Jobs are only forwarded
+# if both are set, a worker with REDIS_QUEUE set to LARGE_JOB_QUEUE must run them.
+MEMORY_BUDGET = getenv("MEMORY_BUDGET")
+LARGE_JOB_RUNTIME = getenv("LARGE_JOB_RUNTIME")
+LARGE_JOB_QUEUE = getenv("LARGE_JOB_QUEUE")
+
+# Newick results are cached in redis for RESULT_TTL seconds under the hash of the
+# clustered profiles and options, set by the API
+RESULT_TTL = int(getenv("RESULT_TTL", 60 * 60 * 24))
+
+# The last MSTree of a group is kept for TREE_STATE_TTL seconds to insert new samples
+TREE_STATE_TTL = int(getenv("TREE_STATE_TTL", 60 * 60 * 24 * 30))
+
+# Number of processes of the distance worker pool, shared by all jobs of a worker
+DISTANCE_PROCESSES = int(getenv("DISTANCE_PROCESSES", "5"))
+
+# Directory for caching pairwise distances between jobs, disabled if not set
+DISTANCE_CACHE_DIR = getenv("DISTANCE_CACHE_DIR")
+
+# Directory of the allele index used for finding the closest samples, disabled if
+# not set
+ALLELE_INDEX_DIR = getenv("ALLELE_INDEX_DIR")
+
+# Allele distance thresholds of the single linkage cluster addresses, kept in the
+# directory of the allele index
+CLUSTER_THRESHOLDS = [
+    int(threshold)
+    for threshold in getenv("CLUSTER_THRESHOLDS", "5,10,25,50").split(",")
+]
 
 # Logging configuration
 DICT_CONFIG = {
@@ -0,0 +1,221 @@
+"""Persistent store of the pairwise allele distances between samples.
+
+The store keep the number of mismatching and comparable loci for each pair of
+samples that has been clustered together, which is enough to derive the symmetric
+and asymmetric distance matrices regardless of which other samples are in a job.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from .ms_trees import distance_matrix
+
+LOG = logging.getLogger(__name__)
+
+UNKNOWN = np.iinfo(np.uint32).max
+MISSING_ALLELES = ("0", "N", "-")
+
+
+def profile_hash(loci, alleles) -> str:
+    """Hash the called alleles of a profile.
+
+    Only called loci are included to make the hash independent of which loci are
+    included in a job.
+    """
+    called = ~np.isin(alleles, MISSING_ALLELES)
+    checksum = hashlib.sha1()
+    checksum.update("\t".join(loci[called]).encode())
+    checksum.update(b"\n")
+    checksum.update("\t".join(alleles[called]).encode())
+    return checksum.hexdigest()
+
+
+def pair_offset(rows, cols):
+    """Get the offset of pairs in the lower triangular storage."""
+    high, low = np.maximum(rows, cols), np.minimum(rows, cols)
+    return high * (high - 1) // 2 + low
+
+
+class DistanceCache:
+    """Mismatch and comparable loci counts between previously clustered samples.
+
+    Each sample is given a row and the counts for a pair of rows i > j are stored at
+    i * (i - 1) / 2 + j in memory mapped files, which lets the store grow without
+    rewriting it. A sample whose profile changed gets a row freed by a changed
+    profile, or a new row if none is free, and all counts of the row are
+    invalidated. The files therefore grow with the number of samples, not with the
+    number of profiles.
+    """
+
+    def __init__(self, directory: str | Path):
+        """Open, or create, a distance cache in a directory."""
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = self.directory / "cache.lock"
+        self._index_file = self.directory / "index.json"
+        self._count_files = {
+            name: self.directory / f"{name}.u32" for name in ("mismatch", "comparable")
+        }
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Lock the cache for other threads and processes."""
+        with self._thread_lock, open(self._lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> dict:
+        index = {"n_rows": 0, "samples": {}, "free": []}
+        if self._index_file.exists():
+            with open(self._index_file, encoding="utf-8") as inpt:
+                index.update(json.load(inpt))
+        return index
+
+    def _write_index(self, index: dict):
+        tmp_file = self._index_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as out:
+            json.dump(index, out)
+        tmp_file.replace(self._index_file)
+
+    def _open_counts(self, n_rows: int) -> dict[str, np.memmap]:
+        """Open the count files, growing them to hold pairs between n_rows rows."""
+        n_pairs = max(n_rows * (n_rows - 1) // 2, 1)
+        counts = {}
+        for name, path in self._count_files.items():
+            path.touch()
+            if path.stat().st_size < n_pairs * 4:
+                with open(path, "r+b") as out:
+                    out.truncate(n_pairs * 4)
+            counts[name] = np.memmap(path, dtype=np.uint32, mode="r+", shape=(n_pairs,))
+        return counts
+
+    def _invalidate(self, counts: dict[str, np.memmap], row: int, n_rows: int):
+        """Mark the counts of all pairs with a row as not calculated."""
+        start = row * (row - 1) // 2
+        counts["mismatch"][start : start + row] = UNKNOWN
+        later = np.arange(row + 1, n_rows)
+        counts["mismatch"][later * (later - 1) // 2 + row] = UNKNOWN
+
+    def distances(self, profile_keys, profiles, func, handle_missing):
+        """Get the distance matrix of profiles from their cached loci counts.
+
+        The distances are written a row of pairs at a time into the matrix, which
+        is the only n x n array allocated. Counts of pairs that are not in the cache
+        are calculated without holding the lock of the cache and stored if the
+        profiles still have the same rows.
+
+        :param profile_keys: sample id and profile hash of each profile
+        :param profiles: integer coded allele profiles
+        :param func: symmetric or asymmetric
+        :param handle_missing: how missing alleles are compared
+        :return: the distances as a float32 matrix
+        """
+        n_profile, n_loci = profiles.shape
+        n_present = np.sum(profiles > 0, 1)
+        res = np.zeros([n_profile, n_profile], dtype=np.float32)
+        missing = []
+        with self._locked():
+            index = self._read_index()
+            rows = np.zeros(n_profile, dtype=np.int64)
+            new_rows = []
+            for i, (sample_id, checksum) in enumerate(profile_keys):
+                entry = index["samples"].get(sample_id)
+                if entry is None or entry["hash"] != checksum:
+                    if entry is not None:
+                        index["free"].append(entry["row"])
+                    if index["free"]:
+                        row = index["free"].pop()
+                    else:
+                        row = index["n_rows"]
+                        index["n_rows"] += 1
+                    entry = {"row": row, "hash": checksum}
+                    index["samples"][sample_id] = entry
+                    new_rows.append(row)
+                rows[i] = entry["row"]
+            counts = self._open_counts(index["n_rows"])
+            # pairs involving the new rows have not been computed
+            for row in new_rows:
+                self._invalidate(counts, row, index["n_rows"])
+
+            for i in range(1, n_profile):
+                offsets = pair_offset(rows[i], rows[:i])
+                mismatch = counts["mismatch"][offsets]
+                comparable = counts["comparable"][offsets]
+                distance_matrix.fill_from_counts(
+                    res,
+                    func,
+                    handle_missing,
+                    np.full(i, i),
+                    np.arange(i),
+                    mismatch,
+                    comparable,
+                    n_present,
+                    n_loci,
+                )
+                unknown = np.flatnonzero(mismatch == UNKNOWN)
+                if unknown.size:
+                    missing.append(np.vstack([np.full(unknown.size, i), unknown]))
+            for count in counts.values():
+                count.flush()
+            self._write_index(index)
+        if missing:
+            pair_rows, pair_cols = np.hstack(missing)
+            LOG.debug("Calculating %d new pairwise distances", pair_rows.size)
+            n_diff, n_comparable = distance_matrix.pair_counts(
+                profiles, pair_rows, pair_cols
+            )
+            distance_matrix.fill_from_counts(
+                res,
+                func,
+                handle_missing,
+                pair_rows,
+                pair_cols,
+                n_diff,
+                n_comparable,
+                n_present,
+                n_loci,
+            )
+            self._store_counts(
+                profile_keys, rows, pair_rows, pair_cols, n_diff, n_comparable
+            )
+        LOG.info(
+            "Used %d of %d cached pairwise distances",
+            n_profile * (n_profile - 1) // 2 - sum(m.shape[1] for m in missing),
+            n_profile * (n_profile - 1) // 2,
+        )
+        return res
+
+    def _store_counts(self, profile_keys, rows, pair_rows, pair_cols, *pair_counts):
+        """Store the counts of pairs whose profiles still have the rows they had.
+
+        Rows of profiles that changed while the counts were calculated may have been
+        given to other profiles.
+        """
+        with self._locked():
+            index = self._read_index()
+            current = index["samples"]
+            unchanged = np.array(
+                [
+                    current.get(sample_id) == {"row": int(row), "hash": checksum}
+                    for (sample_id, checksum), row in zip(profile_keys, rows)
+                ],
+                dtype=bool,
+            )
+            keep = unchanged[pair_rows] & unchanged[pair_cols]
+            counts = self._open_counts(index["n_rows"])
+            offsets = pair_offset(rows[pair_rows[keep]], rows[pair_cols[keep]])
+            for name, pair_count in zip(("mismatch", "comparable"), pair_counts):
+                counts[name][offsets] = pair_count[keep]
+            for count in counts.values():
+                count.flush()
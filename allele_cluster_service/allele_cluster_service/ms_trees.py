@@ -2,6 +2,7 @@
 
 # pylint: skip-file
 import argparse
+import atexit
 import gzip
 import logging
 import os
@@ -9,17 +10,27 @@ import platform
 import re
 import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from enum import Enum
+from io import BytesIO
 from glob import glob
 from importlib.resources import files
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 from subprocess import PIPE, Popen
 
-import networkx as nx
 import numpy as np
 import psutil
-from ete3 import Tree
-from numba import jit
+from numba import njit, prange, set_num_threads
+
+from . import config
+from .tree import ArrayTree
+from .tree_state import MAX_CHANGED_EDGES
 
 LOG = logging.getLogger(__name__)
 BIN_DIR = files("allele_cluster_service.bin")
@@ -33,9 +44,10 @@ class ClusterMethod(str, Enum):
     NEIGHBOR_JOINING = "NJ"
     RAPID_NJ = "RapidNJ"
     NINJA = "ninja"
+    DISTANCE = "distance"
 
 
-params = dict(
+DEFAULT_PARAMS = dict(
     method="MSTreeV2",  # MSTree , NJ
     matrix_type="symmetric",
     heuristic="eBurst",
@@ -44,13 +56,12 @@ params = dict(
     wgMLST=False,
     n_proc=5,
     checkEnv=False,
+    out_of_core="auto",  # True, False
+    distance_format="phylip",  # npz
     NJ_Windows=BIN_DIR.joinpath("fastme.exe"),
     NJ_Darwin=BIN_DIR.joinpath("fastme-2.1.5-osx"),
     NJ_Linux=BIN_DIR.joinpath("fastme-2.1.5-linux64"),
     NJ_Linux32=BIN_DIR.joinpath("fastme-2.1.5-linux32"),
-    edmonds_Windows=BIN_DIR.joinpath("edmonds.exe"),
-    edmonds_Darwin=BIN_DIR.joinpath("edmonds-osx"),
-    edmonds_Linux=BIN_DIR.joinpath("edmonds-linux"),
     RapidNJ_Linux=BIN_DIR.joinpath("rapidnj"),
     RapidNJ_Darwin=BIN_DIR.joinpath("rapidnj-osx"),
     RapidNJ_Windows=BIN_DIR.joinpath("rapidnj.exe"),
@@ -60,7 +71,7 @@ params = dict(
 )
 
 
-@jit(nopython=True)
+@njit(cache=True)
 def contemporary(a, b, c, n_loci):
     a[0], a[1] = max(min(a[0], n_loci - 0.5), 0.5), max(min(a[1], n_loci - 0.5), 0.5)
     b, c = max(min(b, n_loci - 0.5), 0.5), max(min(c, n_loci - 0.5), 0.5)
@@ -91,6 +102,587 @@ def contemporary(a, b, c, n_loci):
     return p1 >= p2
 
 
+@njit(cache=True)
+def _pairwise_block(values, lo, hi):
+    n = hi - lo
+    if n < 8:
+        res = 0.0
+        for i in range(lo, hi):
+            res += values[i]
+        return res
+    r0, r1, r2, r3 = values[lo], values[lo + 1], values[lo + 2], values[lo + 3]
+    r4, r5, r6, r7 = values[lo + 4], values[lo + 5], values[lo + 6], values[lo + 7]
+    i = lo + 8
+    while i < hi - (n % 8):
+        r0 += values[i]
+        r1 += values[i + 1]
+        r2 += values[i + 2]
+        r3 += values[i + 3]
+        r4 += values[i + 4]
+        r5 += values[i + 5]
+        r6 += values[i + 6]
+        r7 += values[i + 7]
+        i += 8
+    res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+    while i < hi:
+        res += values[i]
+        i += 1
+    return res
+
+
+@njit(cache=True)
+def _pairwise_sum(values, lo, hi):
+    """Sum values[lo:hi] in the same order as numpy's pairwise summation.
+
+    The recursive halving of numpy is unrolled with an explicit stack as numba
+    can't cache recursive functions.
+    """
+    los, his = np.empty(64, np.int64), np.empty(64, np.int64)
+    stage, left = np.zeros(64, np.int8), np.empty(64, np.float64)
+    los[0], his[0], stage[0] = lo, hi, 0
+    depth, res = 1, 0.0
+    while depth > 0:
+        top = depth - 1
+        n = his[top] - los[top]
+        n2 = n // 2
+        n2 -= n2 % 8
+        if n <= 128:
+            res = _pairwise_block(values, los[top], his[top])
+            depth -= 1
+        elif stage[top] == 0:
+            stage[top] = 1
+            los[depth], his[depth], stage[depth] = los[top], los[top] + n2, 0
+            depth += 1
+        elif stage[top] == 1:
+            left[top], stage[top] = res, 2
+            los[depth], his[depth], stage[depth] = los[top] + n2, his[top], 0
+            depth += 1
+        else:
+            res = left[top] + res
+            depth -= 1
+    return res
+
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def _symmetric_kernel(codes, presences, start, end, pair_delete, out):
+    n_loci = codes.shape[1]
+    for c in prange(end - start):
+        i = start + c
+        for r in range(i):
+            n_diff, n_comparable = 0, 0
+            for l in range(n_loci):
+                if presences[r, l] and presences[i, l]:
+                    n_comparable += 1
+                    if codes[r, l] != codes[i, l]:
+                        n_diff += 1
+            if pair_delete:
+                out[r, c] = (n_diff + 0.01) * float(n_loci) / (n_comparable + 0.01)
+            else:
+                out[r, c] = n_diff
+    # mirror the distances between profiles within the block
+    for c in range(end - start):
+        for c2 in range(c):
+            out[start + c, c2] = out[start + c2, c]
+
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def _asymmetric_kernel(codes, presences, start, end, absolute, out):
+    n_profile, n_loci = codes.shape
+    for c in prange(end - start):
+        i = start + c
+        n_present = 0
+        for l in range(n_loci):
+            n_present += presences[i, l]
+        for r in range(n_profile):
+            n_diff = 0
+            for l in range(n_loci):
+                if presences[i, l] and codes[r, l] != codes[i, l]:
+                    n_diff += 1
+            if absolute:
+                out[r, c] = n_diff
+            else:
+                out[r, c] = n_diff * float(n_loci) / n_present
+
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def _asymmetric_wgmlst_kernel(codes, presences, pp, start, end, out):
+    n_profile, n_loci = codes.shape
+    for c in prange(end - start):
+        i = start + c
+        n_present = 0
+        for l in range(n_loci):
+            n_present += presences[i, l]
+        terms = np.empty(n_loci, dtype=np.float64)
+        for r in range(n_profile):
+            for l in range(n_loci):
+                mismatch = 0.0
+                if presences[r, l] and presences[i, l] and codes[r, l] != codes[i, l]:
+                    mismatch = 1.0
+                if presences[r, l] < presences[i, l]:
+                    terms[l] = mismatch + pp[l]
+                else:
+                    terms[l] = mismatch
+            out[r, c] = _pairwise_sum(terms, 0, n_loci) * float(n_loci) / n_present
+
+
+@njit(parallel=True, cache=True)
+def _blockwise_kernel(codes, start, end, penalty, out):
+    n_profile, n_loci = codes.shape
+    for c in prange(end - start):
+        i = start + c
+        for r in range(n_profile):
+            d1, n_diff, prev = 0, 0, 0
+            for l in range(n_loci):
+                diff = np.int64(codes[r, l]) - np.int64(codes[i, l])
+                if diff != 0:
+                    n_diff += 1
+                    if diff != prev:
+                        d1 += 1
+                prev = diff
+            out[r, c] = d1 + (n_diff - d1) * penalty
+
+
+@njit(parallel=True, cache=True)
+def _pair_count_kernel(codes, presences, rows, cols, mismatch, comparable):
+    n_loci = codes.shape[1]
+    for k in prange(rows.size):
+        i, j = rows[k], cols[k]
+        n_diff, n_comparable = 0, 0
+        for l in range(n_loci):
+            if presences[i, l] and presences[j, l]:
+                n_comparable += 1
+                if codes[i, l] != codes[j, l]:
+                    n_diff += 1
+        mismatch[k], comparable[k] = n_diff, n_comparable
+
+
+@njit(parallel=True, cache=True)
+def _distance_histogram_kernel(dist, rows, lo, out):
+    # number of truncated distances of each row in lo, lo + 1, ...
+    width = out.shape[1]
+    for k in prange(rows.size):
+        row = dist[rows[k]]
+        for j in range(row.size):
+            d = np.int64(row[j]) - lo
+            if d >= 0 and d < width:
+                out[k, d] += 1
+
+
+@njit(cache=True)
+def _edge_before(w1, a1, b1, w2, a2, b2):
+    # edges of equal weight are ordered on their nodes, giving a unique tree
+    if w1 != w2:
+        return w1 < w2
+    lo1, hi1 = min(a1, b1), max(a1, b1)
+    lo2, hi2 = min(a2, b2), max(a2, b2)
+    return lo1 < lo2 or (lo1 == lo2 and hi1 < hi2)
+
+
+@njit(cache=True)
+def _symmetric_mst_kernel(dist, weight, src, dst, edge_weight):
+    """Prim's minimum spanning tree on the rounded and weighted symmetric dist.
+
+    Only rows of dist are read, which keeps the access sequential when it is on disk.
+    """
+    n_node = dist.shape[0]
+    in_tree = np.zeros(n_node, dtype=np.bool_)
+    best = np.full(n_node, np.inf)
+    best_from = np.full(n_node, -1, dtype=np.int64)
+    node = 0
+    in_tree[node] = True
+    for k in range(n_node - 1):
+        for v in range(n_node):
+            if in_tree[v]:
+                continue
+            w = np.float64(np.rint(dist[node, v])) + min(weight[node], weight[v])
+            if _edge_before(w, node, v, best[v], best_from[v], v):
+                best[v], best_from[v] = w, node
+        node = -1
+        for v in range(n_node):
+            if in_tree[v]:
+                continue
+            if node < 0 or _edge_before(
+                best[v], best_from[v], v, best[node], best_from[node], node
+            ):
+                node = v
+        in_tree[node] = True
+        src[k], dst[k], edge_weight[k] = best_from[node], node, best[node]
+
+
+@njit(cache=True)
+def _find(group, node):
+    """Find the outermost group of a node, compressing the path to it."""
+    top = node
+    while group[top] >= 0:
+        top = group[top]
+    while group[node] >= 0 and group[node] != top:
+        group[node], node = top, group[node]
+    return top
+
+
+@njit(cache=True)
+def _kruskal_kernel(src, dst, order, n_node, keep):
+    """Kruskal's minimum spanning tree of edges taken in the given order."""
+    group = np.full(n_node, -1, dtype=np.int64)
+    n_kept = 0
+    for e in order:
+        a, b = _find(group, src[e]), _find(group, dst[e])
+        if a != b:
+            group[a] = b
+            keep[e] = True
+            n_kept += 1
+            if n_kept == n_node - 1:
+                break
+    return n_kept
+
+
+@njit(cache=True)
+def _arborescence_kernel(inbound, targets, parents):
+    """Chu-Liu/Edmonds minimum spanning arborescence on a dense matrix.
+
+    inbound[v, u] is the cost of the edge u -> v and is overwritten. The last node
+    is a virtual root with edges to all other nodes, which should cost more than
+    any tree. targets is scratch space of the same shape. The source of the edge
+    entering each node is written to parents.
+    """
+    n_node = inbound.shape[0]
+    root = n_node - 1
+    n_id = 2 * n_node
+    # nodes on a cycle are contracted into a new node, a group, that takes over the
+    # row of inbound costs of the first node on the cycle
+    group = np.full(n_id, -1, dtype=np.int64)
+    cycle = np.full(n_id, -1, dtype=np.int64)
+    row = np.empty(n_id, dtype=np.int64)
+    row[:n_node] = np.arange(n_node)
+    # 0 unvisited, 1 on the current path, 2 connected to the root
+    state = np.zeros(n_id, dtype=np.int8)
+    state[root] = 2
+    path = np.empty(n_id, dtype=np.int64)
+    position = np.empty(n_id, dtype=np.int64)
+    in_src = np.full(n_id, -1, dtype=np.int64)
+    in_dst = np.full(n_id, -1, dtype=np.int64)
+    in_cost = np.zeros(n_id)
+    # the original node entered by each inbound edge
+    for v in range(n_node):
+        targets[v, :] = v
+    next_id = n_node
+    for start in range(n_node - 1):
+        node = _find(group, start)
+        depth = 0
+        while state[node] != 2:
+            state[node], path[depth], position[node] = 1, node, depth
+            depth += 1
+            r = row[node]
+            best, src = np.inf, -1
+            for u in range(n_node):
+                if inbound[r, u] < best and _find(group, u) != node:
+                    best, src = inbound[r, u], u
+            in_src[node], in_dst[node], in_cost[node] = src, targets[r, src], best
+            parent = _find(group, src)
+            if state[parent] == 0:
+                node = parent
+            elif state[parent] == 2:
+                for k in range(depth):
+                    state[path[k]] = 2
+                node = parent
+            else:
+                # contract the cycle and reduce the cost of edges entering it with
+                # the cost of the edge they replace
+                node, next_id = next_id, next_id + 1
+                r = row[parent]
+                row[node] = r
+                for u in range(n_node):
+                    inbound[r, u] -= in_cost[parent]
+                for k in range(position[parent] + 1, depth):
+                    member = path[k]
+                    r_member = row[member]
+                    for u in range(n_node):
+                        cost = inbound[r_member, u] - in_cost[member]
+                        if cost < inbound[r, u]:
+                            inbound[r, u], targets[r, u] = cost, targets[r_member, u]
+                for k in range(position[parent], depth):
+                    group[path[k]], cycle[path[k]] = node, node
+                depth = position[parent]
+
+    # expand the cycles, every node keeps its edge except the one entered from
+    # outside its cycle, which takes the edge entering the cycle
+    final_src, final_dst = in_src.copy(), in_dst.copy()
+    for node in range(next_id - 1, -1, -1):
+        if node == root or final_src[node] < 0 or node < n_node:
+            continue
+        member = final_dst[node]
+        while cycle[member] != node:
+            member = cycle[member]
+        final_src[member], final_dst[member] = final_src[node], final_dst[node]
+    for v in range(root):
+        parents[v] = final_src[v] if final_src[v] != root else -1
+
+
+@njit(cache=True)
+def _before(w1, d1, n1, w2, d2, n2):
+    """Order (weight, distance, node) triples as sorted tuples."""
+    if w1 != w2:
+        return w1 < w2
+    if d1 != d2:
+        return d1 < d2
+    return n1 < n2
+
+
+@njit(cache=True)
+def _closest_members(node, following, weights, dist_to, closest):
+    """Find the three members of the group starting with node that come first.
+
+    Members are ordered by weight, then distance and index. Returns the number of
+    members written to closest.
+    """
+    n_closest = 0
+    while node >= 0:
+        j = n_closest
+        while j > 0 and _before(
+            weights[node],
+            dist_to[node],
+            node,
+            weights[closest[j - 1]],
+            dist_to[closest[j - 1]],
+            closest[j - 1],
+        ):
+            if j < 3:
+                closest[j] = closest[j - 1]
+            j -= 1
+        if j < 3:
+            closest[j] = node
+        n_closest = min(n_closest + 1, 3)
+        node = following[node]
+    return n_closest
+
+
+@njit(cache=True)
+def _sorted_neighbours(
+    node, adjacent, adj_node, adj_next, tried, stamp, weights, dist_to, limit, mid
+):
+    """Sort the untried neighbours closer than limit by weight, distance and index."""
+    n_mid = 0
+    e = adjacent[node]
+    while e >= 0:
+        v = adj_node[e]
+        e = adj_next[e]
+        if tried[v] == stamp or dist_to[v] >= limit:
+            continue
+        j = n_mid
+        while j > 0 and _before(
+            weights[v],
+            dist_to[v],
+            v,
+            weights[mid[j - 1]],
+            dist_to[mid[j - 1]],
+            mid[j - 1],
+        ):
+            mid[j] = mid[j - 1]
+            j -= 1
+        mid[j] = v
+        n_mid += 1
+    return n_mid
+
+
+@njit(cache=True)
+def _recraft_kernel(src_of, tgt_of, length, dist, weights, n_loci, scale):
+    """Move the ends of the branches to contemporary nodes, see _branch_recraft.
+
+    Branches are processed in order and join the groups of their ends. src_of,
+    tgt_of and length are updated in place. scale holds 1.5 in the dtype of dist.
+    """
+    n_node = dist.shape[0]
+    n_branch = src_of.size
+    # groups are merged with union-find and list their members through following
+    group = np.full(n_node, -1, dtype=np.int64)
+    size = np.ones(n_node, dtype=np.int64)
+    first = np.arange(n_node)
+    last = np.arange(n_node)
+    following = np.full(n_node, -1, dtype=np.int64)
+    # neighbours of the nodes in the branches processed so far
+    adjacent = np.full(n_node, -1, dtype=np.int64)
+    adj_node = np.empty(2 * n_branch, dtype=np.int64)
+    adj_next = np.empty(2 * n_branch, dtype=np.int64)
+    n_adj = 0
+    # nodes tried for a branch are marked with the stamp of the attempt
+    tried = np.zeros(n_node, dtype=np.int64)
+    stamp = 0
+    mid = np.empty(n_node, dtype=np.int64)
+    closest = np.empty(3, dtype=np.int64)
+    pair = np.empty(2, dtype=dist.dtype)
+    tail_sorted = False
+    # the GrapeTree implementation compares the target with the last member tried
+    # as a shortcut to it, t is kept between the loops to do the same
+    t = -1
+    i = 0
+    while i < n_branch:
+        stamp += 1
+        src, tgt = src_of[i], tgt_of[i]
+        root_s, root_t = _find(group, src), _find(group, tgt)
+        if size[root_s] > 1:
+            to_tgt = dist[:, tgt]
+            n_closest = _closest_members(
+                first[root_s], following, weights, to_tgt, closest
+            )
+            for k in range(n_closest):
+                s = closest[k]
+                if s == src:
+                    break
+                d = to_tgt[s]
+                if d < scale[0] * dist[src, tgt]:
+                    pair[0], pair[1] = dist[s, src], dist[src, s]
+                    if contemporary(pair, d, dist[src, tgt], n_loci):
+                        tried[src], src = stamp, s
+                        break
+            while tried[src] != stamp:
+                tried[src] = stamp
+                n_mid = _sorted_neighbours(
+                    src,
+                    adjacent,
+                    adj_node,
+                    adj_next,
+                    tried,
+                    stamp,
+                    weights,
+                    to_tgt,
+                    2 * dist[src, tgt],
+                    mid,
+                )
+                for k in range(n_mid):
+                    s = mid[k]
+                    w, d = weights[s], to_tgt[s]
+                    if d < dist[src, tgt]:
+                        pair[0], pair[1] = dist[src, s], dist[s, src]
+                        if not contemporary(pair, dist[src, tgt], d, n_loci):
+                            tried[src], src = stamp, s
+                            break
+                    elif w < weights[src]:
+                        pair[0], pair[1] = dist[s, src], dist[src, s]
+                        if contemporary(pair, d, dist[src, tgt], n_loci):
+                            tried[src], src = stamp, s
+                            break
+                    tried[s] = stamp
+        if size[root_t] > 1:
+            from_src = dist[src, :]
+            n_closest = _closest_members(
+                first[root_t], following, weights, from_src, closest
+            )
+            for k in range(n_closest):
+                t = closest[k]
+                if t == tgt:
+                    break
+                d = from_src[t]
+                if d < scale[0] * dist[src, tgt]:
+                    pair[0], pair[1] = dist[t, tgt], dist[tgt, t]
+                    if contemporary(pair, d, dist[src, tgt], n_loci):
+                        tried[tgt], tgt = stamp, t
+                        break
+            while tried[tgt] != stamp:
+                tried[tgt] = stamp
+                n_mid = _sorted_neighbours(
+                    tgt,
+                    adjacent,
+                    adj_node,
+                    adj_next,
+                    tried,
+                    stamp,
+                    weights,
+                    from_src,
+                    2 * dist[src, tgt],
+                    mid,
+                )
+                for k in range(n_mid):
+                    s = mid[k]
+                    w, d = weights[s], from_src[s]
+                    if d < dist[src, tgt]:
+                        pair[0], pair[1] = dist[tgt, t], dist[t, tgt]
+                        if not contemporary(pair, dist[src, tgt], d, n_loci):
+                            tried[tgt], tgt = stamp, t
+                            break
+                    elif w < weights[tgt]:
+                        pair[0], pair[1] = dist[t, tgt], dist[tgt, t]
+                        if contemporary(pair, d, dist[src, tgt], n_loci):
+                            tried[tgt], tgt = stamp, t
+                            break
+                    tried[t] = stamp
+        brlen = dist[src, tgt]
+        src_of[i], tgt_of[i], length[i] = src, tgt, brlen
+        if i >= n_branch - 1 or length[i + 1] >= brlen:
+            group[root_t] = root_s
+            size[root_s] += size[root_t]
+            following[last[root_s]] = first[root_t]
+            last[root_s] = last[root_t]
+            adj_node[n_adj], adj_next[n_adj], adjacent[src] = tgt, adjacent[src], n_adj
+            adj_node[n_adj + 1], adj_next[n_adj + 1] = src, adjacent[tgt]
+            adjacent[tgt] = n_adj + 1
+            n_adj += 2
+            i += 1
+        elif tail_sorted:
+            # the rest is already sorted by length, move the branch into place
+            j = i + 1
+            while j < n_branch and length[j] < brlen:
+                src_of[j - 1], tgt_of[j - 1], length[j - 1] = (
+                    src_of[j],
+                    tgt_of[j],
+                    length[j],
+                )
+                j += 1
+            src_of[j - 1], tgt_of[j - 1], length[j - 1] = src, tgt, brlen
+        else:
+            order = np.argsort(length[i:], kind="mergesort") + i
+            src_of[i:], tgt_of[i:], length[i:] = (
+                src_of[order],
+                tgt_of[order],
+                length[order],
+            )
+            tail_sorted = True
+
+
+# numba's fallback workqueue threading layer can't run parallel kernels from
+# several threads at once, concurrent runs take turns launching them
+_KERNEL_LOCK = threading.Lock()
+
+
+def compact_codes(profiles):
+    """Store integer allele codes in the smallest unsigned type that fits them."""
+    dtype = np.uint16 if profiles.max(initial=0) < 2**16 else np.uint32
+    return profiles.astype(dtype, copy=False)
+
+
+def presence_mask(profiles, handle_missing="pair_delete"):
+    """Get a mask of the loci that are compared for each profile."""
+    if handle_missing in ("as_allele",):
+        return np.ones(shape=profiles.shape, dtype=np.uint8)
+    elif handle_missing in ("pair_delete", "absolute_distance"):
+        return (profiles > 0).view(np.uint8)
+    present = np.sum(profiles > 0, 0) >= profiles.shape[0]
+    return np.broadcast_to(present.view(np.uint8), profiles.shape).copy()
+
+
+# distances counted by the first pass of the eBurst ordering, doubled by every pass
+EBURST_WINDOW = 64
+# number of matrix elements processed at a time by tiled operations
+TILE_SIZE = 2**24
+
+
+def tiles(n_rows, n_cols):
+    """Split the rows of a matrix into tiles of at most TILE_SIZE elements."""
+    step = max(TILE_SIZE // max(n_cols, 1), 1)
+    return [slice(start, min(start + step, n_rows)) for start in range(0, n_rows, step)]
+
+
+def symmetrize(dist):
+    """Copy the largest of dist[i, j] and dist[j, i] to both, one tile at a time."""
+    n_profile = dist.shape[0]
+    step = max(int(TILE_SIZE**0.5), 1)
+    for start in range(0, n_profile, step):
+        rows = slice(start, start + step)
+        for start2 in range(start, n_profile, step):
+            cols = slice(start2, start2 + step)
+            block = np.maximum(dist[rows, cols], dist[cols, rows].T)
+            dist[rows, cols], dist[cols, rows] = block, block.T
+
+
 def add_args():
     parser = argparse.ArgumentParser(
         description='For details, see "https://github.com/achtman-lab/GrapeTree/blob/master/README.md".\nIn brief, GrapeTree generates a NEWICK tree to the default output (screen) \nor a redirect output, e.g., a file. ',
@@ -163,6 +755,13 @@ def add_args():
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--out_of_core",
+        dest="out_of_core",
+        help="[DEFAULT: auto] Keep the distance matrix on disk while building a MSTree. auto: only when it does not fit in the available memory. ",
+        default="auto",
+        choices=["auto", "yes", "no"],
+    )
     parser.add_argument(
         "--block_penalty",
         "-b",
@@ -175,6 +774,7 @@ def add_args():
     args.profile = args.fname
     args.method = args.tree
     args.n_proc = args.number_of_processes
+    args.out_of_core = {"yes": True, "no": False}.get(args.out_of_core, "auto")
     args.handle_missing = [
         "pair_delete",
         "complete_delete",
@@ -198,25 +798,235 @@ def add_args():
     return args.__dict__
 
 
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Get the process pool used for computing distances.
+
+    The pool is created with config.DISTANCE_PROCESSES processes on first use and
+    is kept for the lifetime of the process to avoid starting new processes for
+    every job. Runs share the pool whatever their n_proc, they split their work in
+    n_proc chunks.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            n_proc = config.DISTANCE_PROCESSES
+            LOG.debug("Starting distance worker pool with %d processes", n_proc)
+            _POOL = ProcessPoolExecutor(
+                n_proc, mp_context=get_context("spawn"), initializer=_init_pool_worker
+            )
+        return _POOL
+
+
+def _discard_pool(pool):
+    """Drop a broken pool so that the next run starts a new one."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_pool_worker():
+    # the pool already runs one process per core, keep the kernels single threaded
+    set_num_threads(1)
+
+
+@atexit.register
+def shutdown_pool():
+    """Stop the distance worker pool."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
+
+
+def _cpu_time():
+    """Get the CPU time of the process and of the child processes it waited for."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageTimer(object):
+    """Wall time, CPU time and peak resident memory of the stages of a run.
+
+    The number of distinct profiles and of loci of the run are kept with them.
+
+    The peak memory of a stage is sampled every interval seconds while it runs and
+    at its start and end. It is the resident memory of the whole process, so stages
+    of concurrent runs in the same process include the memory of each other. CPU
+    time covers all threads of the process and the external programs it ran, but
+    not the distance worker pool. The memory of external programs is not included.
+    """
+
+    def __init__(self, interval=0.1):
+        self.stages = []
+        self.dimensions = {}
+        self.interval = interval
+
+    @contextmanager
+    def __call__(self, name):
+        process = psutil.Process()
+        max_rss = process.memory_info().rss
+        done = threading.Event()
+
+        def sample():
+            nonlocal max_rss
+            while not done.wait(self.interval):
+                max_rss = max(max_rss, process.memory_info().rss)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        wall, cpu = time.perf_counter(), _cpu_time()
+        sampler.start()
+        try:
+            yield
+        finally:
+            done.set()
+            sampler.join()
+            self.stages.append(
+                {
+                    "stage": name,
+                    "wall_time": time.perf_counter() - wall,
+                    "cpu_time": _cpu_time() - cpu,
+                    "max_rss": max(max_rss, process.memory_info().rss),
+                }
+            )
+
+
+class ClusterRun(object):
+    """A single clustering run.
+
+    Carries the configuration of the run together with its scratch files and shared
+    memory blocks, so that several runs can be processed by the same process.
+    """
+
+    def __init__(self, **args):
+        self.params = dict(DEFAULT_PARAMS, **args)
+        if self.params["method"] == "MSTreeV2":
+            self.params.update(
+                method="MSTree",
+                matrix_type="asymmetric",
+                heuristic="harmonic",
+                branch_recraft=True,
+            )
+        self.distance_cache = self.params.pop("distance_cache", None)
+        self.tree_state = self.params.pop("tree_state", None)
+        self.stage = self.params.pop("stage_timer", None) or StageTimer()
+        self.profile_keys = None
+        self.out_of_core = False
+        self.tempfix = None
+        self.dist_file = None
+        self._scratch_dir = None
+        self._shared_blocks = []
+
+    def __enter__(self):
+        self._scratch_dir = tempfile.TemporaryDirectory(dir=os.path.expanduser("~"))
+        self.tempfix = os.path.join(self._scratch_dir.name, "run")
+        self.dist_file = self.tempfix + ".dist.npy"
+        return self
+
+    def __exit__(self, *exc):
+        self.release_shared_memory()
+        self._scratch_dir.cleanup()
+
+    @property
+    def n_proc(self):
+        return int(self.params["n_proc"])
+
+    def executable(self, name, system=None):
+        """Get path to a bundled executable for the current platform."""
+        return self.params["{0}_{1}".format(name, system or platform.system())]
+
+    def create_matrix(self, name, shape, dtype):
+        """Allocate a matrix, in a scratch file when running out of core."""
+        if not self.out_of_core:
+            return np.empty(shape, dtype=dtype)
+        return np.lib.format.open_memmap(
+            "{0}.{1}.npy".format(self.tempfix, name),
+            mode="w+",
+            dtype=dtype,
+            shape=tuple(shape),
+        )
+
+    def create_shared_array(self, shape, dtype):
+        """Allocate an array in shared memory the distance workers can attach to."""
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = SharedMemory(create=True, size=size)
+        self._shared_blocks.append(block)
+        return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def release_shared_memory(self, block=None):
+        """Release one, or all, shared memory blocks allocated by the run."""
+        blocks = [block] if block is not None else list(self._shared_blocks)
+        for blk in blocks:
+            self._shared_blocks.remove(blk)
+            try:
+                blk.close()
+            except BufferError:
+                # arrays still refer to the block, it is unmapped once they are gone
+                pass
+            blk.unlink()
+
+
 def parallel_distance(callup):
-    func, prof_file, sub_prefix, handle_missing, index_range = callup
-    profiles = np.load(prof_file)
-    res = eval("distance_matrix." + func)(profiles, handle_missing, index_range)
-    subfile = sub_prefix.format(index_range[0])
-    np.save(subfile, res)
-    return subfile
+    func, prof_name, prof_shape, prof_dtype, dist_name, handle_missing, index_range = (
+        callup
+    )
+    prof_block = SharedMemory(name=prof_name)
+    dist_block = SharedMemory(name=dist_name)
+    try:
+        profiles = np.ndarray(prof_shape, dtype=prof_dtype, buffer=prof_block.buf)
+        res = np.ndarray(
+            [prof_shape[0], prof_shape[0]], dtype=np.float32, buffer=dist_block.buf
+        )
+        res[:, index_range[0] : index_range[1]] = getattr(distance_matrix, func)(
+            profiles, handle_missing, index_range
+        )
+        del profiles, res
+    finally:
+        prof_block.close()
+        dist_block.close()
+    return index_range[0]
 
 
 class distance_matrix(object):
     @staticmethod
-    def get_distance(func, profiles, handle_missing):
-        from multiprocessing import Pool
-
+    def get_distance(func, profiles, handle_missing, run):
         n_profile, n_allele = profiles.shape
-        n_proc = min(int(params["n_proc"]), profiles.shape[0])
-        np.save(params["prof_file"], profiles)
-        if n_proc > 1:
-            pool = Pool(n_proc)
+        n_proc = min(run.n_proc, n_profile)
+        profiles = compact_codes(profiles)
+        if run.out_of_core:
+            # columns are written one tile at a time straight to the saved matrix
+            res = np.lib.format.open_memmap(
+                run.dist_file, mode="w+", dtype=np.float32, shape=(n_profile, n_profile)
+            )
+            for cols in tiles(n_profile, n_profile):
+                res[:, cols] = getattr(distance_matrix, func)(
+                    profiles, handle_missing, [cols.start, cols.stop]
+                )
+            if func == "symmetric":
+                symmetrize(res)
+            res.flush()
+            return res
+        elif run.distance_cache is not None and distance_matrix.is_cacheable(
+            func, handle_missing
+        ):
+            res = run.distance_cache.distances(
+                run.profile_keys, profiles, func, handle_missing
+            )
+        elif n_proc > 1:
+            # workers read the profiles and fill their columns of the matrix in place
+            dist_block, res = run.create_shared_array(
+                [n_profile, n_profile], np.float32
+            )
+            prof_block, shared_profiles = run.create_shared_array(
+                profiles.shape, profiles.dtype
+            )
+            shared_profiles[:] = profiles
             indices = np.array(
                 [
                     [n_profile * v / n_proc + 0.5, n_profile * (v + 1) / n_proc + 0.5]
@@ -224,81 +1034,121 @@ class distance_matrix(object):
                 ],
                 dtype=int,
             )
-            del profiles
-            subfiles = pool.map(
-                parallel_distance,
-                [
-                    [
-                        func,
-                        params["prof_file"],
-                        params["dist_subfile"],
-                        handle_missing,
-                        idx,
-                    ]
-                    for idx in indices
-                ],
-            )
-            pool.close()
-            del pool
-
-            res = np.zeros([n_profile, n_profile], dtype=np.float32)
-
-            for id, sf in zip(indices, subfiles):
-                res[:, id[0] : id[1]] = np.load(sf)
-        else:
-            subfiles = [
-                parallel_distance(
-                    [
-                        func,
-                        params["prof_file"],
-                        params["dist_subfile"],
-                        handle_missing,
-                        [0, n_profile],
-                    ]
-                )
-            ]
-            res = np.load(subfiles[0])
-        for subfile in subfiles:
+            pool = get_pool()
             try:
-                os.unlink(subfile)
-            except:
-                pass
-        np.save(params["dist_file"], res)
+                list(
+                    pool.map(
+                        parallel_distance,
+                        [
+                            [
+                                func,
+                                prof_block.name,
+                                profiles.shape,
+                                profiles.dtype.str,
+                                dist_block.name,
+                                handle_missing,
+                                idx,
+                            ]
+                            for idx in indices
+                        ],
+                    )
+                )
+            except BrokenProcessPool:
+                # a pool process was killed, e.g. by the OOM killer; fail the job
+                # and let the next one start a new pool
+                _discard_pool(pool)
+                raise
+            del shared_profiles
+            run.release_shared_memory(prof_block)
+        else:
+            res = getattr(distance_matrix, func)(
+                profiles, handle_missing, [0, n_profile]
+            )
         if func == "symmetric":
             res[res.T > res] = res.T[res.T > res]
         return res
 
+    @staticmethod
+    def is_cacheable(func, handle_missing):
+        """Check if the distances only depend on the pair of profiles compared."""
+        return func in ("symmetric", "asymmetric") and handle_missing in (
+            "pair_delete",
+            "absolute_distance",
+            "as_allele",
+        )
+
+    @staticmethod
+    def pair_counts(profiles, rows, cols):
+        """Count mismatching and comparable loci between pairs of profiles."""
+        presences = presence_mask(profiles)
+        mismatch = np.zeros(rows.size, dtype=np.uint32)
+        comparable = np.zeros(rows.size, dtype=np.uint32)
+        with _KERNEL_LOCK:
+            _pair_count_kernel(profiles, presences, rows, cols, mismatch, comparable)
+        return mismatch, comparable
+
+    @staticmethod
+    def _count_distances(
+        func, handle_missing, mismatch, comparable, n_row, n_col, n_loci
+    ):
+        """Get distances from the loci counts of pairs and their number of alleles."""
+        mm = mismatch.astype(np.int64)
+        # loci only present in the row or the column profile
+        only_row = n_row - comparable
+        only_col = n_col - comparable
+        if func == "asymmetric":
+            d = mm + only_col
+            if handle_missing not in ("absolute_distance",):
+                d = d * float(n_loci) / n_col
+        elif handle_missing in ("pair_delete",):
+            d = (mm + 0.01) * float(n_loci) / (comparable + 0.01)
+        elif handle_missing in ("as_allele",):
+            d = mm + only_row + only_col
+        else:
+            d = mm
+        return d
+
+    @staticmethod
+    def fill_from_counts(
+        res, func, handle_missing, rows, cols, mismatch, comparable, n_present, n_loci
+    ):
+        """Write the distances of pairs from their mismatch and comparable loci counts.
+
+        Both res[rows, cols] and res[cols, rows] are written, with the same
+        distances as the symmetric and asymmetric matrices. n_present is the number
+        of alleles called in each profile.
+        """
+        n_row, n_col = n_present[rows], n_present[cols]
+        counts = (mismatch, comparable)
+        res[rows, cols] = distance_matrix._count_distances(
+            func, handle_missing, *counts, n_row, n_col, n_loci
+        )
+        if func == "asymmetric":
+            res[cols, rows] = distance_matrix._count_distances(
+                func, handle_missing, *counts, n_col, n_row, n_loci
+            )
+        else:
+            res[cols, rows] = res[rows, cols]
+
     @staticmethod
     def asymmetric_wgMLST(profiles, handle_missing="pair_delete", index_range=None):
         if index_range is None:
             index_range = [0, profiles.shape[0]]
 
-        presences = profiles > 0
+        presences = presence_mask(profiles)
         pp = np.sum(presences, 0).astype(float)
         pp = pp * (pp - 1) / (presences.shape[0] * (presences.shape[0] - 1))
 
         distances = np.zeros(
             shape=[profiles.shape[0], index_range[1] - index_range[0]], dtype=np.float32
         )
-
-        if handle_missing not in ("absolute_distance",):
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                diffs = (
-                    np.sum(
-                        ((profiles != profile) & (presences * presence))
-                        + (presences < presence) * pp,
-                        axis=1,
-                    )
-                    * float(presence.size)
-                    / np.sum(presence)
+        with _KERNEL_LOCK:
+            if handle_missing not in ("absolute_distance",):
+                _asymmetric_wgmlst_kernel(
+                    profiles, presences, pp, *index_range, distances
                 )
-                distances[:, i2] = diffs
-        else:
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum((profiles != profile) & presence, axis=1)
-                distances[:, i2] = diffs
+            else:
+                _asymmetric_kernel(profiles, presences, *index_range, True, distances)
         return distances
 
     @staticmethod
@@ -306,24 +1156,11 @@ class distance_matrix(object):
         if index_range is None:
             index_range = [0, profiles.shape[0]]
 
-        presences = profiles > 0
         distances = np.zeros(
             shape=[profiles.shape[0], index_range[1] - index_range[0]], dtype=np.float32
         )
-
-        for i2, id in enumerate(np.arange(*index_range)):
-            profile = profiles[id]
-            diffs = np.hstack(
-                [
-                    np.zeros([profiles.shape[0], 1], dtype=int),
-                    profiles - profile,
-                    np.zeros([profiles.shape[0], 1], dtype=int),
-                ]
-            )
-            d1 = np.sum((diffs[:, 1:] != diffs[:, :-1]) & (diffs[:, 1:] != 0), 1)
-            d2 = np.sum(diffs != 0, 1) - d1
-            distances[:, i2] = d1 + d2 * handle_missing
-
+        with _KERNEL_LOCK:
+            _blockwise_kernel(profiles, *index_range, float(handle_missing), distances)
         return distances
 
     @staticmethod
@@ -331,25 +1168,18 @@ class distance_matrix(object):
         if index_range is None:
             index_range = [0, profiles.shape[0]]
 
-        presences = profiles > 0
+        presences = presence_mask(profiles)
         distances = np.zeros(
             shape=[profiles.shape[0], index_range[1] - index_range[0]], dtype=np.float32
         )
-
-        if handle_missing not in ("absolute_distance",):
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                diffs = (
-                    np.sum(((profiles != profile) & presence), axis=1)
-                    * float(presence.size)
-                    / np.sum(presence)
-                )
-                distances[:, i2] = diffs
-        else:
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum((profiles != profile) & presence, axis=1)
-                distances[:, i2] = diffs
+        with _KERNEL_LOCK:
+            _asymmetric_kernel(
+                profiles,
+                presences,
+                *index_range,
+                handle_missing in ("absolute_distance",),
+                distances,
+            )
         return distances
 
     @staticmethod
@@ -357,43 +1187,18 @@ class distance_matrix(object):
         if index_range is None:
             index_range = [0, profiles.shape[0]]
 
-        if handle_missing in ("as_allele",):
-            presences = np.ones(shape=profiles.shape, dtype=int)
-        elif handle_missing in ("pair_delete", "absolute_distance"):
-            presences = profiles > 0
-        else:
-            presences = (
-                np.repeat(
-                    np.sum(profiles > 0, 0) >= profiles.shape[0], profiles.shape[0]
-                )
-                .reshape([profiles.shape[1], profiles.shape[0]])
-                .T
-            )
+        presences = presence_mask(profiles, handle_missing)
         distances = np.zeros(
             shape=[profiles.shape[0], index_range[1] - index_range[0]], dtype=np.float32
         )
-
-        if handle_missing in ("pair_delete",):
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                comparable = presences[:id] * presence
-                diffs = (
-                    (np.sum((profiles[:id] != profile) & comparable, axis=1) + 0.01)
-                    * float(presence.size)
-                    / (np.sum(comparable, axis=1) + 0.01)
-                )
-
-                distances[:id, i2] = diffs
-                distances[id, :i2] = diffs[index_range[0] : index_range[0] + id]
-        else:
-            for i2, id in enumerate(np.arange(*index_range)):
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum(
-                    (profiles[:id] != profile) & (presences[:id] * presence), axis=1
-                )
-
-                distances[:id, i2] = diffs
-                distances[id, :i2] = diffs[index_range[0] : index_range[0] + id]
+        with _KERNEL_LOCK:
+            _symmetric_kernel(
+                profiles,
+                presences,
+                *index_range,
+                handle_missing in ("pair_delete",),
+                distances,
+            )
         return distances
 
     @staticmethod
@@ -416,77 +1221,124 @@ class distance_matrix(object):
             for s, t, d in links
         ]
 
+    @staticmethod
+    def to_npz(names, profile, dist):
+        """Serialize a symmetric distance matrix of the distinct profiles as npz.
+
+        The distances are stored as float32, condensed to the upper triangle of
+        the matrix row by row, with the sample names and the profile of each sample.
+        """
+        n_profile = dist.shape[0]
+        distances = np.empty(n_profile * (n_profile - 1) // 2, dtype=np.float32)
+        start = 0
+        for i in range(n_profile - 1):
+            distances[start : start + n_profile - i - 1] = dist[i, i + 1 :]
+            start += n_profile - i - 1
+        buffer = BytesIO()
+        np.savez(
+            buffer,
+            names=np.asarray(names, dtype=str),
+            profile=np.asarray(profile, dtype=np.int64),
+            distances=distances,
+        )
+        return buffer.getvalue()
+
     @staticmethod
     def harmonic(dist, n_str):
-        weights = dist.shape[0] / np.sum(1.0 / (dist + 0.1), 1)
+        weights = dist.shape[0] / np.concatenate(
+            [np.sum(1.0 / (dist[rows] + 0.1), 1) for rows in tiles(*dist.shape)]
+        )
         cw = np.vstack([-np.array(n_str), weights])
         weights[np.lexsort(cw)] = np.arange(dist.shape[0], dtype=float) / dist.shape[0]
         return weights
 
     @staticmethod
     def eBurst(dist, n_str):
-        weights = np.apply_along_axis(
-            np.bincount,
-            1,
-            np.hstack(
-                [
-                    dist.astype(int),
-                    np.array([[np.max(dist).astype(int) + 1]] * dist.shape[1]),
-                ]
-            ),
-        )
-        weights.T[0] += n_str
-        dist_order = np.concatenate([[0], np.arange(weights.shape[1] - 1, 0, -1)])
-        orders = np.lexsort(-weights.T[dist_order])
-        weights = np.zeros(dist.shape[0])
-        weights[orders] = (np.arange(orders.size)) / float(orders.size)
+        """Rank profiles on their number of neighbours at each distance.
+
+        Profiles with the most neighbours at distance 1 come first, ties are broken
+        by the neighbours at distance 2 and so on, then by the number of samples
+        with the profile and last by their index. Distances are truncated to
+        integers. Only the profiles that are still tied are counted for the next
+        window of distances.
+        """
+        n_profile = dist.shape[0]
+        weights = np.zeros(n_profile)
+        if n_profile == 0:
+            return weights
+        max_dist = int(np.max(dist)) + 1
+        order = np.arange(n_profile)
+        # if a profile ranks equal to the profile before it
+        tied = np.ones(n_profile, dtype=bool)
+        tied[0] = False
+        lo, width = 1, EBURST_WINDOW
+        while lo < max_dist:
+            width = min(width, max_dist - lo)
+            if not distance_matrix._break_ties(dist, order, tied, lo, width):
+                break
+            lo, width = lo + width, 2 * width
+        distance_matrix._break_ties(dist, order, tied, 0, 1, n_str)
+        weights[order] = np.arange(n_profile) / float(n_profile)
         return weights
 
+    @staticmethod
+    def _break_ties(dist, order, tied, lo, width, n_str=None):
+        """Order tied profiles on their number of neighbours at distances lo, ...
+
+        The rank order and the tied flags are updated in place.
+
+        :return: if any profiles are left tied
+        """
+        ranks = np.flatnonzero(tied | np.append(tied[1:], False))
+        if ranks.size == 0:
+            return False
+        rows = order[ranks]
+        counts = np.zeros([rows.size, width], dtype=np.int64)
+        _distance_histogram_kernel(dist, rows, lo, counts)
+        if n_str is not None:
+            counts[:, 0] += np.asarray(n_str)[rows]
+        group = np.cumsum(~tied[ranks])
+        resort = np.lexsort(np.vstack([-counts.T[::-1], group]))
+        rows, counts, group = rows[resort], counts[resort], group[resort]
+        order[ranks] = rows
+        tied[ranks[1:]] = (group[1:] == group[:-1]) & np.all(
+            counts[1:] == counts[:-1], 1
+        )
+        return bool(np.any(tied))
+
 
 class methods(object):
     @staticmethod
-    def _blockwise(dist, weight, **params):
-        x = methods._symmetric(dist * 10000.0, weight, **params)
+    def _blockwise(dist, weight, run):
+        x = methods._symmetric(dist * 10000.0, weight, run)
         return [[b[0], b[1], b[2] / 10000.0] for b in x]
 
     @staticmethod
-    def _symmetric(dist, weight, **params):
-        def minimum_spanning_tree(dist):
-            n_node = dist.shape[0]
-            nodes = np.arange(n_node)
-            ng = {n: [n] for n in nodes}
-            edges = np.array(
-                [[x, y, dist[x, y]] for y in np.arange(n_node) for x in np.arange(y)]
-            )
-            edges = edges[np.argsort(edges.T[2])].astype(int)
-            mst = []
-            for m, e in enumerate(edges):
-                if nodes[e[0]] == nodes[e[1]]:
-                    continue
-                mst.append(e.tolist())
-                if nodes[e[0]] > nodes[e[1]]:
-                    s, e = nodes[e[1]], nodes[e[0]]
-                else:
-                    s, e = nodes[e[0]], nodes[e[1]]
-                nodes[ng[e]] = s
-                ng[s].extend(ng.pop(e))
-            return mst
-
-        dist = np.round(dist, 0) + weight.reshape([weight.size, -1])
-        np.fill_diagonal(dist, 0.0)
-        dist[dist > dist.T] = dist.T[dist > dist.T]
-        try:
-            g = nx.Graph(dist)
-            ms = nx.minimum_spanning_tree(g)
-            dist = dist.astype(np.uint32)
-            return [[d[0], d[1], int(d[2]["weight"])] for d in ms.edges(data=True)]
-        except:
-            res = minimum_spanning_tree(dist)
-            dist = dist.astype(np.uint32)
-            return res
+    def _symmetric(dist, weight, run):
+        n_edge = max(dist.shape[0] - 1, 0)
+        src, dst = np.empty(n_edge, dtype=np.int64), np.empty(n_edge, dtype=np.int64)
+        edge_weight = np.empty(n_edge, dtype=float)
+        _symmetric_mst_kernel(dist, weight.astype(float), src, dst, edge_weight)
+        return methods._mst_branches(dist.shape[0], src, dst, edge_weight)
 
     @staticmethod
-    def _asymmetric(dist, weight, **params):
+    def _mst_branches(n_node, src, dst, edge_weight):
+        # list the branches in the order networkx gave them, nodes in order with the
+        # edges of each node in the order they were added by Kruskal's algorithm
+        lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+        neighbours = [[] for _ in range(n_node)]
+        for e in np.lexsort([hi, lo, edge_weight]):
+            neighbours[lo[e]].append(e)
+            neighbours[hi[e]].append(e)
+        return [
+            [n, int(hi[e]), int(edge_weight[e])]
+            for n, edges in enumerate(neighbours)
+            for e in edges
+            if lo[e] == n
+        ]
+
+    @staticmethod
+    def _asymmetric(dist, weight, run):
         def get_shortcut(dist, weight, cutoff=20):
             if dist.shape[0] < 3000:
                 cutoff = 2
@@ -494,74 +1346,102 @@ class methods(object):
                 cutoff = 5
             elif dist.shape[0] < 30000:
                 cutoff = 10
-            link = np.array(np.where(dist < (cutoff + 1)))
+            link = np.hstack(
+                [
+                    np.array(np.where(dist[rows] < (cutoff + 1))) + [[rows.start], [0]]
+                    for rows in tiles(*dist.shape)
+                ]
+            )
             link = link.T[weight[link[0]] < weight[link[1]]].T
             link = np.vstack([link, dist[tuple(link.tolist())] + weight[link[0]]])
             link = link.T[np.lexsort(link)]
             return link[np.unique(link.T[1], return_index=True)[1]].astype(int)
 
-        try:
-            presence = np.arange(weight.shape[0])
-            shortcuts = get_shortcut(dist, weight)
-            for s, t, d in shortcuts:
-                dist[s, dist[s] > dist[t]] = dist[t, dist[s] > dist[t]]
-            presence[shortcuts.T[1]] = -1
-            dist = dist.T[presence >= 0].T[presence >= 0]
-            presence = presence[presence >= 0]
-            weight2 = weight[presence]
-            dist = np.round(dist, 0) + weight2.reshape([weight2.size, -1])
-            np.fill_diagonal(dist, 0.0)
-
-            dist_file = params["tempfix"] + ".dist.list"
-            with open(dist_file, "w") as fout:
-                for d in dist:
-                    fout.write(
-                        "{0}\n".format(
-                            "\t".join(
-                                ["{0:.5f}".format(dd) for dd in (d + (1.0 - 0.000005))]
-                            )
-                        )
-                    )
-            del dist, d
-            mstree = Popen(
-                [params["edmonds_" + platform.system()], dist_file], stdout=PIPE
-            ).communicate()[0]
-            os.unlink(dist_file)
-            if isinstance(mstree, bytes):
-                mstree = mstree.decode("utf8")
-            mstree = np.array(
-                [br.strip().split() for br in mstree.strip().split("\n")], dtype=float
-            ).astype(int)
-            assert mstree.size > 0
-            mstree.T[2] -= 1
-            mstree.T[:2] = presence[mstree.T[:2]]
-            return mstree.tolist() + shortcuts.tolist()
-        except:
-            try:
-                os.unlink(dist_file)
-            except:
-                pass
-            dist = np.load(params["dist_file"])
-            dist = np.round(dist, 0) + weight.reshape([weight.size, -1])
-            np.fill_diagonal(dist, 0.0)
-
-            presence = np.arange(weight.shape[0])
-            shortcuts = get_shortcut(dist, weight)
-            for s, t, d in shortcuts:
-                dist[s, dist[s] > dist[t]] = dist[t, dist[s] > dist[t]]
-                presence[t] = -1
-            dist = dist.T[presence >= 0].T[presence >= 0]
-            presence = presence[presence >= 0]
-
-            g = nx.DiGraph(dist)
-            ms = nx.minimum_spanning_arborescence(g)
-            return [
-                [presence[d[0]], presence[d[1]], int(d[2]["weight"])]
-                for d in ms.edges(data=True)
-            ] + shortcuts.tolist()
+        # the source of a shortcut takes the shorter distances of its target, the
+        # rows are kept aside to leave the distance matrix unchanged
+        presence = np.arange(weight.shape[0])
+        shortcuts = get_shortcut(dist, weight)
+        sources = {s: i for i, s in enumerate(np.unique(shortcuts.T[0]))}
+        shortcut_rows = run.create_matrix(
+            "shortcuts", [len(sources), dist.shape[1]], dist.dtype
+        )
+        for s, i in sources.items():
+            shortcut_rows[i] = dist[s]
+        for s, t, d in shortcuts:
+            row_t = shortcut_rows[sources[t]] if t in sources else dist[t]
+            np.minimum(shortcut_rows[sources[s]], row_t, out=shortcut_rows[sources[s]])
+        presence[shortcuts.T[1]] = -1
+        presence = presence[presence >= 0]
+        weight2 = weight[presence]
+
+        def row(s):
+            return shortcut_rows[sources[s]] if s in sources else dist[s]
+
+        def reduced_rows(rows):
+            """Rounded and weighted distances from the kept nodes in rows."""
+            block = np.vstack([row(s)[presence] for s in presence[rows]])
+            return np.round(block, 0) + weight2[rows].reshape([-1, 1])
+
+        # edges enter the nodes of the rows, from a virtual root in the last column
+        n_node = presence.size
+        inbound = run.create_matrix("inbound", [n_node + 1, n_node + 1], float)
+        max_dist = 0.0
+        for rows in tiles(n_node, n_node):
+            block = reduced_rows(rows)
+            inbound[:n_node, rows] = block.T
+            max_dist = max(max_dist, np.max(block))
+        np.fill_diagonal(inbound, np.inf)
+        inbound[:n_node, n_node] = (max_dist + 1.0) * (n_node + 1)
+        targets = run.create_matrix("targets", inbound.shape, np.int32)
+        parents = np.empty(n_node, dtype=np.int64)
+        _arborescence_kernel(inbound, targets, parents)
+        del inbound, targets
+        tgt = np.flatnonzero(parents >= 0)
+        src = parents[tgt]
+        # round the branch lengths the way they were passed through the edmonds binary
+        weighted = (
+            np.round(
+                np.array(
+                    [row(s)[t] for s, t in zip(presence[src], presence[tgt])],
+                    dtype=dist.dtype,
+                ),
+                0,
+            )
+            + weight2[src]
+        )
+        brlen = [
+            int(float("{0:.6g}".format(float("{0:.5f}".format(d))))) - 1
+            for d in weighted + (1.0 - 0.000005)
+        ]
+        mstree = np.vstack([presence[src], presence[tgt], brlen]).T
+        return mstree.tolist() + shortcuts.tolist()
 
     @staticmethod
     def _branch_recraft(branches, dist, weights, n_loci):
+        """Reattach the branches of a tree to contemporary nodes of their groups."""
+        if n_loci is None:
+            n_loci = np.max(dist)
+        if len(branches) == 0:
+            return []
+        src_of, tgt_of, length = np.array(branches, dtype=float).T
+        src_of, tgt_of = src_of.astype(np.int64), tgt_of.astype(np.int64)
+        weight_of = np.sort([weights[src_of], weights[tgt_of]], 0)
+        order = np.lexsort([weight_of[1], weight_of[0], dist[src_of, tgt_of]])
+        src_of, tgt_of, length = src_of[order], tgt_of[order], length[order]
+        _recraft_kernel(
+            src_of,
+            tgt_of,
+            length,
+            dist,
+            weights,
+            n_loci,
+            np.full(1, 1.5, dtype=dist.dtype),
+        )
+        return [[s, t, d] for s, t, d in zip(src_of.tolist(), tgt_of.tolist(), length)]
+
+    @staticmethod
+    def _branch_recraft_python(branches, dist, weights, n_loci):
+        """The GrapeTree implementation of _branch_recraft, used as a reference."""
         if n_loci is None:
             n_loci = np.max(dist)
 
@@ -665,82 +1545,124 @@ class methods(object):
                 branches[i:] = sorted(branches[i:], key=lambda br: br[2])
         return branches
 
+    @staticmethod
+    def _insert_into_tree(state, keys, profiles, handle_missing):
+        """Insert new profiles into the symmetric spanning tree of a previous run.
+
+        The new tree is the spanning tree of the previous edges and the edges of the
+        new profiles. Returns the order of the profiles, with the previous ones
+        first, their ranks and the branches, or None if too many edges changed.
+        """
+        position = {key: i for i, key in enumerate(keys)}
+        old = np.array([position[key] for key in state.keys], dtype=np.int64)
+        is_new = np.ones(len(keys), dtype=bool)
+        is_new[old] = False
+        order = np.concatenate([old, np.flatnonzero(is_new)])
+        n_old, n_node = old.size, order.size
+        ranks = np.concatenate([state.ranks, np.arange(n_old, n_node)])
+        # columns of the new profiles, filled for the profiles before them
+        dist = distance_matrix.symmetric(
+            compact_codes(profiles[order]), handle_missing, [n_old, n_node]
+        )
+        rows, cols = np.nonzero(
+            np.arange(n_node).reshape([-1, 1]) < np.arange(n_old, n_node)
+        )
+        src = np.concatenate([state.src, rows])
+        dst = np.concatenate([state.dst, cols + n_old])
+        distance = np.concatenate(
+            [state.distance, np.rint(dist[rows, cols]).astype(np.int64)]
+        )
+        # edges are ordered as in _symmetric_mst_kernel with rank / n_node weights
+        lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+        min_rank = np.minimum(ranks[src], ranks[dst])
+        keep = np.zeros(src.size, dtype=np.bool_)
+        _kruskal_kernel(
+            src, dst, np.lexsort([hi, lo, min_rank, distance]), n_node, keep
+        )
+        n_changed = state.src.size - np.sum(keep[: state.src.size])
+        if n_changed > MAX_CHANGED_EDGES * state.src.size:
+            LOG.info("Inserting profiles changed %d edges of the tree", n_changed)
+            return None
+        edge_weight = distance[keep] + min_rank[keep] / float(n_node)
+        branches = methods._mst_branches(n_node, src[keep], dst[keep], edge_weight)
+        return order, ranks, branches
+
     @staticmethod
     def _network2tree(branches, names):
         """Create a tree object from branches."""
-        tree = Tree()
-
-        # build tree object
-        if len(branches) == 0:  # all samples have the same profile
-            for name in names:
-                tree.add_child(name=name, dist=0)
-        else:  # if samples have different profiles
-            branches.sort(key=lambda x: x[2], reverse=True)
-            branch = []
-            in_use = {branches[0][0]: 1}
-            while len(branches):
-                remain = []
-                for br in branches:
-                    if br[0] in in_use:
-                        branch.append(br)
-                        in_use[br[1]] = 1
-                    elif br[1] in in_use:
-                        branch.append([br[1], br[0], br[2]])
-                        in_use[br[0]] = 1
-                    else:
-                        remain.append(br)
-                branches = remain
-
-            nodeFinder = {}
-
-            tree.name = branch[0][0]
-            nodeFinder[tree.name] = tree
-            for src, tgt, dif in branch:
-                node = nodeFinder[src]
-                child = node.add_child(name=tgt, dist=dif)
-                nodeFinder[child.name] = child
-            for node in tree.traverse("postorder"):
-                if not node.is_leaf():
-                    name = node.name
-                    node.name = ""
-                    node.add_child(name=names[name], dist=0.0)
-                else:
-                    node.name = names[node.name]
-        return tree
+        return ArrayTree.from_branches(branches, names)
 
     @staticmethod
     def MSTree(
         names,
         profiles,
         embeded,
+        run,
         matrix_type="asymmetric",
         heuristic="harmonic",
         branch_recraft=True,
         handle_missing="pair_delete",
-        **params
+        **params,
     ):
         n_loci = profiles.shape[1]
-        dist = distance_matrix.get_distance(matrix_type, profiles, handle_missing)
-        weight = eval("distance_matrix." + heuristic)(
-            dist, [len(embeded[n]) for n in names]
+        # symmetric trees of a group are kept between runs to insert new profiles
+        incremental = (
+            run.tree_state is not None
+            and run.profile_keys is not None
+            and matrix_type == "symmetric"
+            and not branch_recraft
+            and distance_matrix.is_cacheable(matrix_type, handle_missing)
         )
-
-        tree = eval("methods._" + matrix_type)(dist, weight, **params)
-        del dist
-        if branch_recraft:
-            tree = methods._branch_recraft(
-                tree, np.load(params["dist_file"]), weight, n_loci
+        if incremental:
+            keys = [key for _, key in run.profile_keys]
+            if not run.tree_state.needs_rebuild(keys):
+                with run.stage("insert"):
+                    inserted = methods._insert_into_tree(
+                        run.tree_state, keys, profiles, handle_missing
+                    )
+                if inserted is not None:
+                    order, ranks, tree = inserted
+                    LOG.info(
+                        "Inserted %d profiles into the spanning tree",
+                        len(keys) - len(run.tree_state),
+                    )
+                    run.tree_state.update(np.asarray(keys)[order], ranks, tree)
+                    names, profiles = np.asarray(names)[order], profiles[order]
+                    with run.stage("link"):
+                        tree = distance_matrix.symmetric_link(
+                            profiles, tree, handle_missing=handle_missing
+                        )
+                        return methods._network2tree(tree, names)
+            LOG.info("Rebuilding the spanning tree of %d profiles", len(keys))
+        with run.stage("distance"):
+            dist = distance_matrix.get_distance(
+                matrix_type, profiles, handle_missing, run
             )
-        if matrix_type != "blockwise":
-            tree = distance_matrix.symmetric_link(
-                np.load(params["prof_file"]), tree, handle_missing=handle_missing
+        with run.stage("heuristic"):
+            weight = getattr(distance_matrix, heuristic)(
+                dist, [len(embeded[n]) for n in names]
             )
-        tree = methods._network2tree(tree, names)
+
+        with run.stage("tree"):
+            tree = getattr(methods, "_" + matrix_type)(dist, weight, run)
+        if incremental:
+            ranks = np.argsort(np.argsort(weight, kind="stable"), kind="stable")
+            run.tree_state.update(keys, ranks, tree, n_built=len(keys))
+        if branch_recraft:
+            with run.stage("recraft"):
+                tree = methods._branch_recraft(tree, dist, weight, n_loci)
+        del dist
+        with run.stage("link"):
+            if matrix_type != "blockwise":
+                tree = distance_matrix.symmetric_link(
+                    profiles, tree, handle_missing=handle_missing
+                )
+            tree = methods._network2tree(tree, names)
         return tree
 
     @staticmethod
-    def goeBurst(names, profiles, embeded, handle_missing="pair_delete", **params):
-        goeburst = Popen([params["goeburst_Linux"]] + ["-t"], stdin=PIPE, stdout=PIPE)
+    def goeBurst(names, profiles, embeded, run, handle_missing="pair_delete", **params):
+        goeburst = Popen([run.executable("goeburst")] + ["-t"], stdin=PIPE, stdout=PIPE)
         if handle_missing == "pair_delete":
             for n, p in enumerate(profiles):
                 goeburst.stdin.write(
@@ -769,9 +1691,11 @@ class methods(object):
         names,
         profiles,
         embeded,
+        run,
         matrix_type="symmetric",
         handle_missing="pair_delete",
-        **params
+        distance_format="phylip",
+        **params,
     ):
         ids = {n: id for id, n in enumerate(names)}
         ids = {gg: ids[k] for k, g in embeded.items() for gg in g}
@@ -780,9 +1704,14 @@ class methods(object):
             names.append(n)
             indices.append(i)
         indices = np.array(indices)
-        d = distance_matrix.get_distance(matrix_type, profiles, handle_missing)
+        with run.stage("distance"):
+            d = distance_matrix.get_distance(matrix_type, profiles, handle_missing, run)
         if handle_missing != "absolute_distance" and matrix_type != "blockwise":
             d /= profiles.shape[1]
+        if distance_format == "npz":
+            if matrix_type not in ("symmetric", "blockwise"):
+                raise ValueError("Only symmetric distances can be written as npz")
+            return distance_matrix.to_npz(names, indices, d)
 
         dist = np.zeros([len(names), len(names)])
         for i, i2 in enumerate(indices):
@@ -795,182 +1724,195 @@ class methods(object):
         return dist_txt
 
     @staticmethod
-    def fastme(names, profiles, embeded, handle_missing="pair_delete", **params):
-        dist = distance_matrix.get_distance("symmetric", profiles, handle_missing)
-
-        dist_file = params["tempfix"] + "dist.list"
-        with open(dist_file, "w") as fout:
-            fout.write("    {0}\n".format(dist.shape[0]))
-            for n, d in enumerate(dist):
-                fout.write(
-                    "{0!s:10} {1}\n".format(
-                        n, " ".join(["{:.6f}".format(dd) for dd in d])
+    def fastme(names, profiles, embeded, run, handle_missing="pair_delete", **params):
+        with run.stage("distance"):
+            dist = distance_matrix.get_distance(
+                "symmetric", profiles, handle_missing, run
+            )
+
+        with run.stage("write_distance"):
+            dist_file = run.tempfix + "dist.list"
+            with open(dist_file, "w") as fout:
+                fout.write("    {0}\n".format(dist.shape[0]))
+                for n, d in enumerate(dist):
+                    fout.write(
+                        "{0!s:10} {1}\n".format(
+                            n, " ".join(["{:.6f}".format(dd) for dd in d])
+                        )
                     )
-                )
-        del dist, d
-        try:
-            Popen(
-                [
-                    params["NJ_{0}".format(platform.system())],
-                    "-i",
-                    dist_file,
-                    "-m",
-                    "B",
-                    "-n",
-                    "B",
-                ],
-                stdout=PIPE,
-            ).communicate()
-        except Exception as e:
-            if platform.system() == "Linux":
+            del dist, d
+        with run.stage("tree"):
+            try:
                 Popen(
-                    [params["NJ_Linux32"], "-i", dist_file, "-m", "N"], stdout=PIPE
+                    [
+                        run.executable("NJ"),
+                        "-i",
+                        dist_file,
+                        "-m",
+                        "B",
+                        "-n",
+                        "B",
+                    ],
+                    stdout=PIPE,
                 ).communicate()
-            else:
-                raise e
-        tree = Tree(dist_file + "_fastme_tree.nwk")
-        for fname in glob(dist_file + "*"):
-            os.unlink(fname)
+            except Exception as e:
+                if platform.system() == "Linux":
+                    Popen(
+                        [run.executable("NJ", "Linux32"), "-i", dist_file, "-m", "N"],
+                        stdout=PIPE,
+                    ).communicate()
+                else:
+                    raise e
+            from ete3 import Tree
 
-        try:
-            tree.set_outgroup(tree.get_midpoint_outgroup())
-            tree.unroot()
-        except:
-            pass
+            tree = Tree(dist_file + "_fastme_tree.nwk")
+            for fname in glob(dist_file + "*"):
+                os.unlink(fname)
 
-        for leaf in tree.get_leaves():
-            leaf.name = names[int(leaf.name.strip("'"))]
-        return tree
+            try:
+                tree.set_outgroup(tree.get_midpoint_outgroup())
+                tree.unroot()
+            except:
+                pass
+
+            for leaf in tree.get_leaves():
+                leaf.name = names[int(leaf.name.strip("'"))]
+            return ArrayTree.from_ete3(tree)
 
     @staticmethod
-    def NJ(names, profiles, embeded, handle_missing="pair_delete", **params):
+    def NJ(names, profiles, embeded, run, handle_missing="pair_delete", **params):
         # NJ requires four taxa to compute a tree
         if len(np.unique(profiles, axis=0)) < 4:
             raise ValueError("NJ cannot compute tree with less than 4 unique taxa.")
 
-        dist = distance_matrix.get_distance("symmetric", profiles, handle_missing)
+        with run.stage("distance"):
+            dist = distance_matrix.get_distance(
+                "symmetric", profiles, handle_missing, run
+            )
 
-        dist_file = params["tempfix"] + "dist.list"
-        with open(dist_file, "w") as fout:
-            fout.write("    {0}\n".format(dist.shape[0]))
-            for n, d in enumerate(dist):
-                fout.write(
-                    "{0!s:10} {1}\n".format(
-                        n, " ".join(["{:.6f}".format(dd) for dd in d])
+        with run.stage("write_distance"):
+            dist_file = run.tempfix + "dist.list"
+            with open(dist_file, "w") as fout:
+                fout.write("    {0}\n".format(dist.shape[0]))
+                for n, d in enumerate(dist):
+                    fout.write(
+                        "{0!s:10} {1}\n".format(
+                            n, " ".join(["{:.6f}".format(dd) for dd in d])
+                        )
                     )
-                )
-        del dist, d
-        try:
-            Popen(
-                [
-                    params["NJ_{0}".format(platform.system())],
-                    "-i",
-                    dist_file,
-                    "-m",
-                    "N",
-                ],
-                stdout=PIPE,
-            ).communicate()
-        except Exception as e:
-            if platform.system() == "Linux":
+            del dist, d
+        with run.stage("tree"):
+            try:
                 Popen(
-                    [params["NJ_Linux32"], "-i", dist_file, "-m", "N"], stdout=PIPE
+                    [
+                        run.executable("NJ"),
+                        "-i",
+                        dist_file,
+                        "-m",
+                        "N",
+                    ],
+                    stdout=PIPE,
                 ).communicate()
-            else:
-                raise e
-        tree = Tree(dist_file + "_fastme_tree.nwk")
-        for fname in glob(dist_file + "*"):
-            os.unlink(fname)
+            except Exception as e:
+                if platform.system() == "Linux":
+                    Popen(
+                        [run.executable("NJ", "Linux32"), "-i", dist_file, "-m", "N"],
+                        stdout=PIPE,
+                    ).communicate()
+                else:
+                    raise e
+            from ete3 import Tree
 
-        try:
-            tree.set_outgroup(tree.get_midpoint_outgroup())
-            tree.unroot()
-        except:
-            pass
+            tree = Tree(dist_file + "_fastme_tree.nwk")
+            for fname in glob(dist_file + "*"):
+                os.unlink(fname)
 
-        for leaf in tree.get_leaves():
-            leaf.name = names[int(leaf.name.strip("'"))]
-        return tree
+            try:
+                tree.set_outgroup(tree.get_midpoint_outgroup())
+                tree.unroot()
+            except:
+                pass
+
+            for leaf in tree.get_leaves():
+                leaf.name = names[int(leaf.name.strip("'"))]
+            return ArrayTree.from_ete3(tree)
 
     @staticmethod
-    def RapidNJ(names, profiles, embeded, handle_missing="pair_delete", **params):
-        dist = distance_matrix.get_distance("symmetric", profiles, handle_missing)
-
-        dist_file = params["tempfix"] + "dist.list"
-        with open(dist_file, "w") as fout:
-            fout.write("    {0}\n".format(dist.shape[0]))
-            for n, d in enumerate(dist):
-                fout.write(
-                    "{0!s:10} {1}\n".format(
-                        n, " ".join(["{:.6f}".format(dd) for dd in d])
+    def RapidNJ(names, profiles, embeded, run, handle_missing="pair_delete", **params):
+        with run.stage("distance"):
+            dist = distance_matrix.get_distance(
+                "symmetric", profiles, handle_missing, run
+            )
+
+        with run.stage("write_distance"):
+            dist_file = run.tempfix + "dist.list"
+            with open(dist_file, "w") as fout:
+                fout.write("    {0}\n".format(dist.shape[0]))
+                for n, d in enumerate(dist):
+                    fout.write(
+                        "{0!s:10} {1}\n".format(
+                            n, " ".join(["{:.6f}".format(dd) for dd in d])
+                        )
                     )
-                )
-        del dist, d
-        args = [
-            params["RapidNJ_{0}".format(platform.system())],
-            "-n",
-            "-x",
-            dist_file + "_rapidnj.nwk",
-            "-i",
-            "pd",
-            dist_file,
-        ]
-        _, std_err = Popen(
-            args, stdout=PIPE, stderr=PIPE, encoding="utf-8"
-        ).communicate()
-        if "error" in std_err.lower():
-            raise ValueError(std_err)
-        tree = Tree(dist_file + "_rapidnj.nwk")
-        for fname in glob(dist_file + "*"):
-            os.unlink(fname)
+            del dist, d
+        with run.stage("tree"):
+            args = [
+                run.executable("RapidNJ"),
+                "-n",
+                "-x",
+                dist_file + "_rapidnj.nwk",
+                "-i",
+                "pd",
+                dist_file,
+            ]
+            _, std_err = Popen(
+                args, stdout=PIPE, stderr=PIPE, encoding="utf-8"
+            ).communicate()
+            if "error" in std_err.lower():
+                raise ValueError(std_err)
+            from ete3 import Tree
 
-        try:
-            tree.set_outgroup(tree.get_midpoint_outgroup())
-            tree.unroot()
-        except:
-            pass
+            tree = Tree(dist_file + "_rapidnj.nwk")
+            for fname in glob(dist_file + "*"):
+                os.unlink(fname)
 
-        for leaf in tree.get_leaves():
-            leaf.name = names[int(leaf.name.strip("'"))]
-        return tree
+            try:
+                tree.set_outgroup(tree.get_midpoint_outgroup())
+                tree.unroot()
+            except:
+                pass
+
+            for leaf in tree.get_leaves():
+                leaf.name = names[int(leaf.name.strip("'"))]
+            return ArrayTree.from_ete3(tree)
 
     @staticmethod
-    def ninja(names, profiles, embeded, handle_missing="pair_delete", **params):
-        dist = distance_matrix.get_distance("symmetric", profiles, handle_missing)
+    def ninja(names, profiles, embeded, run, handle_missing="pair_delete", **params):
+        with run.stage("distance"):
+            dist = distance_matrix.get_distance(
+                "symmetric", profiles, handle_missing, run
+            )
         dist = dist / profiles.shape[1]
-        dist_file = params["tempfix"] + "dist.list"
-        with open(dist_file, "w") as fout:
-            fout.write("    {0}\n".format(dist.shape[0]))
-            for n, d in enumerate(dist):
-                fout.write(
-                    "{0!s:10} {1}\n".format(
-                        n, " ".join(["{:.6f}".format(dd) for dd in d])
+        with run.stage("write_distance"):
+            dist_file = run.tempfix + "dist.list"
+            with open(dist_file, "w") as fout:
+                fout.write("    {0}\n".format(dist.shape[0]))
+                for n, d in enumerate(dist):
+                    fout.write(
+                        "{0!s:10} {1}\n".format(
+                            n, " ".join(["{:.6f}".format(dd) for dd in d])
+                        )
                     )
-                )
-        del dist, d
-        free_memory = int(0.9 * psutil.virtual_memory().total / (1024.0**2))
-        ninja_out = Popen(
-            [
-                "java",
-                "-d64",
-                "-Xmx" + str(free_memory) + "M",
-                "-jar",
-                params["ninja_{0}".format(platform.system())],
-                "--in_type",
-                "d",
-                dist_file,
-            ],
-            stdout=PIPE,
-            stderr=PIPE,
-            universal_newlines=True,
-        ).communicate()
-        if ninja_out[1].find("64-bit JVM") >= 0:
+            del dist, d
+        with run.stage("tree"):
+            free_memory = int(0.9 * psutil.virtual_memory().total / (1024.0**2))
             ninja_out = Popen(
                 [
                     "java",
-                    "-Xmx1200M",
+                    "-d64",
+                    "-Xmx" + str(free_memory) + "M",
                     "-jar",
-                    params["ninja_{0}".format(platform.system())],
+                    run.executable("ninja"),
                     "--in_type",
                     "d",
                     dist_file,
@@ -979,111 +1921,114 @@ class methods(object):
                 stderr=PIPE,
                 universal_newlines=True,
             ).communicate()
-        with open(dist_file + ".nwk", "wt") as fout:
-            fout.write(ninja_out[0])
-        tree = Tree(dist_file + ".nwk")
-        for fname in glob(dist_file + "*"):
-            os.unlink(fname)
+            if ninja_out[1].find("64-bit JVM") >= 0:
+                ninja_out = Popen(
+                    [
+                        "java",
+                        "-Xmx1200M",
+                        "-jar",
+                        run.executable("ninja"),
+                        "--in_type",
+                        "d",
+                        dist_file,
+                    ],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    universal_newlines=True,
+                ).communicate()
+            with open(dist_file + ".nwk", "wt") as fout:
+                fout.write(ninja_out[0])
+            from ete3 import Tree
 
-        for node in tree.traverse():
-            node.dist *= profiles.shape[1]
+            tree = Tree(dist_file + ".nwk")
+            for fname in glob(dist_file + "*"):
+                os.unlink(fname)
 
-        try:
-            tree.set_outgroup(tree.get_midpoint_outgroup())
-            tree.unroot()
-        except:
-            pass
+            for node in tree.traverse():
+                node.dist *= profiles.shape[1]
 
-        for leaf in tree.get_leaves():
-            leaf.name = names[int(leaf.name.strip("'"))]
-        return tree
+            try:
+                tree.set_outgroup(tree.get_midpoint_outgroup())
+                tree.unroot()
+            except:
+                pass
+
+            for leaf in tree.get_leaves():
+                leaf.name = names[int(leaf.name.strip("'"))]
+            return ArrayTree.from_ete3(tree)
 
 
-def nonredundant(names, profiles):
+def nonredundant(names, profiles, handle_missing="pair_delete"):
     encoded_profile = np.array(
         [np.unique(p, return_inverse=True)[1] + 1 for p in profiles.T]
     ).T
     encoded_profile[(profiles == "0") | (profiles == "N") | (profiles == "-")] = 0
-    if params["handle_missing"] == "complete_delete":
-        encoded_profile = encoded_profile[:, np.sum(encoded_profile == 0, 0) > 0]
-    names = names[np.lexsort(encoded_profile.T)]
-    profiles = encoded_profile[np.lexsort(encoded_profile.T)]
-    presence = np.sum(profiles > 0, 1) > 0
-    names, profiles = names[presence], profiles[presence]
+    return collapse_redundant(names, encoded_profile, handle_missing)
 
-    uniqueness = np.concatenate([[1], np.sum(np.diff(profiles, axis=0) != 0, 1) > 0])
-
-    embeded = {names[0]: []}
-    embeded_group = embeded[names[0]]
-    for n, u in zip(names, uniqueness):
-        if u == 0:
-            embeded_group.append(n)
-        else:
-            embeded[n] = [n]
-            embeded_group = embeded[n]
-    names = names[uniqueness > 0]
-    profiles = profiles[uniqueness > 0]
-    return names, profiles, embeded
 
+def collapse_redundant(names, profiles, handle_missing="pair_delete"):
+    """Collapse samples with identical integer coded profiles.
 
-def backend(**args):
+    Missing alleles are coded as 0. Returns the names and profiles of the unique
+    profiles, sorted on their alleles, and the names embedded in each of them.
     """
-    paramters :
-        profile: input file or the content of the file as a string. Can be either profile or fasta. Headings start with an '#' will be ignored.
-        method: MSTreeV2, MSTree or NJ
-        matrix_type: asymmetric or symmetric
-        heuristic: harmonic or eBurst
-        branch_recraft: T or F
-
-    Outputs :
-        A string of a NEWICK tree
-
-    Examples :
-        To run MSTreeV2, use :
-        backend(profile=<filename>, method='MSTreeV2')
-
-        OR simply
-        backend(profile=<filename>)
+    if handle_missing == "complete_delete":
+        profiles = profiles[:, np.sum(profiles == 0, 0) > 0]
+    order = np.lexsort(profiles.T)
+    names, profiles = names[order], profiles[order]
+    presence = np.any(profiles > 0, 1)
+    names, profiles = names[presence], profiles[presence]
 
-        To run a standard minimum spanning tree :
-        backend(profile=<filename>, method='MSTree')
+    uniqueness = np.concatenate([[True], np.any(profiles[1:] != profiles[:-1], 1)])
+    groups = np.split(names, np.flatnonzero(uniqueness)[1:])
+    embeded = {group[0]: list(group) for group in groups}
+    return names[uniqueness], profiles[uniqueness], embeded
 
-        To run a NJ tree (using FastME 2.0) :
-        backend(profile=<filename>, method='NJ')
 
-        To run a RapidNJ tree :
-        backend(profile=<filename>, method='RapidNJ')
+def allele_matrix(alleles):
+    """Get an integer allele matrix and locus names from an array or Arrow table.
 
-        To obtain a standard distance matrix :
-        backend(profile=<filename>, method='distance')
+    Missing alleles, including nulls in an Arrow table, are coded as 0.
+    """
+    loci = None
+    if hasattr(alleles, "column_names"):
+        loci = list(alleles.column_names)
+        alleles = np.column_stack(
+            [np.asarray(col.fill_null(0)) for col in alleles.columns]
+        )
+    alleles = np.asarray(alleles)
+    if alleles.ndim != 2 or not np.issubdtype(alleles.dtype, np.integer):
+        raise ValueError("Alleles must be a two dimensional array of integers")
+    if alleles.size and alleles.min() < 0:
+        raise ValueError("Allele codes must be positive, or 0 for missing alleles")
+    if alleles.size and alleles.max() >= 2**32:
+        # renumber the alleles to fit the compact distance kernels
+        uniques, codes = np.unique(alleles, return_inverse=True)
+        alleles = (codes.reshape(alleles.shape) + (uniques[0] != 0)).astype(np.uint32)
+    return alleles, loci
+
+
+def _read_profiles(profile):
+    """Read the names and profiles of a profile or fasta file, or of its content.
+
+    Returns the format, the locus names of a profile, the names and the profiles.
     """
-    global params
-    params.update(args)
-    if params["method"] == "MSTreeV2":
-        params["method"] = "MSTree"
-        params["matrix_type"] = "asymmetric"
-        params["heuristic"] = "harmonic"
-        params["branch_recraft"] = True
-
-    if params["wgMLST"] and params["matrix_type"] == "asymmetric":
-        matrix_type = "asymmetric_wgMLST"
-
     names, profiles = [], []
     try:
-        if params["profile"][-3:].lower().endswith(".gz"):
+        if profile[-3:].lower().endswith(".gz"):
             fin = (
-                gzip.open(params["profile"], "rt").readlines()
-                if os.path.isfile(params["profile"])
-                else params["profile"].split("\n")
+                gzip.open(profile, "rt").readlines()
+                if os.path.isfile(profile)
+                else profile.split("\n")
             )
         else:
             fin = (
-                open(params["profile"]).readlines()
-                if os.path.isfile(params["profile"])
-                else params["profile"].split("\n")
+                open(profile).readlines()
+                if os.path.isfile(profile)
+                else profile.split("\n")
             )
     except:
-        fin = params["profile"].split("\n")
+        fin = profile.split("\n")
 
     allele_cols = None
     for line_id, line in enumerate(fin):
@@ -1137,10 +2082,121 @@ def backend(**args):
                 profiles.append(np.array(part)[allele_cols])
             else:
                 profiles.append(part[1:])
-    del fin, line, line_id, part, header
+    del fin, line, line_id, part
     profiles = np.char.upper(np.array(profiles, dtype=str))
     names = [re.sub(r"[\(\)\ \,\"\';]", "_", n) for n in names]
-    names, profiles, embeded = nonredundant(np.array(names), np.array(profiles))
+    loci = np.array(header)[allele_cols] if fmt == "profile" else None
+    return fmt, loci, names, profiles
+
+
+def backend(**args):
+    """
+    paramters :
+        profile: input file or the content of the file as a string. Can be either profile or fasta. Headings start with an '#' will be ignored.
+        method: MSTreeV2, MSTree or NJ
+        matrix_type: asymmetric or symmetric
+        heuristic: harmonic or eBurst
+        branch_recraft: T or F
+        tree_state: TreeState of a previous MSTree run on the same group, the
+            symmetric tree is extended with new profiles instead of rebuilt
+        stage_timer: StageTimer that records the time and memory of each stage
+        distance_format: phylip, or npz for the distances as bytes, see
+            distance_matrix.to_npz
+
+    Outputs :
+        A string of a NEWICK tree
+
+    Examples :
+        To run MSTreeV2, use :
+        backend(profile=<filename>, method='MSTreeV2')
+
+        OR simply
+        backend(profile=<filename>)
+
+        To run a standard minimum spanning tree :
+        backend(profile=<filename>, method='MSTree')
+
+        To run a NJ tree (using FastME 2.0) :
+        backend(profile=<filename>, method='NJ')
+
+        To run a RapidNJ tree :
+        backend(profile=<filename>, method='RapidNJ')
+
+        To obtain a standard distance matrix :
+        backend(profile=<filename>, method='distance')
+    """
+    run = ClusterRun(**args)
+    params = run.params
+
+    if params["wgMLST"] and params["matrix_type"] == "asymmetric":
+        matrix_type = "asymmetric_wgMLST"
+
+    with run.stage("parse"):
+        fmt, loci, names, profiles = _read_profiles(params["profile"])
+    keyed = run.distance_cache is not None or run.tree_state is not None
+    if keyed and fmt == "profile":
+        from .distance_cache import profile_hash
+
+        with run.stage("hash"):
+            hashes = {n: profile_hash(loci, p) for n, p in zip(names, profiles)}
+    else:
+        run.distance_cache = run.tree_state = None
+    with run.stage("collapse"):
+        names, profiles, embeded = nonredundant(
+            np.array(names), np.array(profiles), params["handle_missing"]
+        )
+    if run.distance_cache is not None or run.tree_state is not None:
+        run.profile_keys = [(n, hashes[n]) for n in names]
+    return _run_method(run, names, profiles, embeded)
+
+
+def backend_from_matrix(names, alleles, loci=None, **args):
+    """Build a tree from already integer coded allele profiles.
+
+    Skips parsing and encoding of text profiles, which dominates the run time of
+    large schemas.
+
+    paramters :
+        names: sample names
+        alleles: integer allele codes, one row per sample with 0 for missing
+            alleles. Either a numpy array or an Arrow table with one column per locus.
+        loci: locus names, required to use the distance cache or tree state unless
+            taken from an Arrow table.
+        other paramters are the same as for backend
+
+    Outputs :
+        A string of a NEWICK tree
+    """
+    run = ClusterRun(**args)
+    params = run.params
+    with run.stage("parse"):
+        alleles, table_loci = allele_matrix(alleles)
+    loci = table_loci if loci is None else loci
+    if len(names) != alleles.shape[0]:
+        raise ValueError(f"Got {len(names)} names for {len(alleles)} allele profiles")
+    names = np.array([re.sub(r"[\(\)\ \,\"\';]", "_", str(n)) for n in names])
+    if loci is None:
+        run.distance_cache = run.tree_state = None
+    row_of = {n: i for i, n in enumerate(names)}
+    with run.stage("collapse"):
+        names, profiles, embeded = collapse_redundant(
+            names, alleles, params["handle_missing"]
+        )
+    if run.distance_cache is not None or run.tree_state is not None:
+        from .distance_cache import profile_hash
+
+        # only the profiles left after collapsing identical ones are hashed
+        loci = np.array(loci, dtype=str)
+        with run.stage("hash"):
+            run.profile_keys = [
+                (n, profile_hash(loci, alleles[row_of[n]].astype(str))) for n in names
+            ]
+    return _run_method(run, names, profiles, embeded)
+
+
+def _run_method(run, names, profiles, embeded):
+    """Build the tree, or distance matrix, of the nonredundant profiles."""
+    params = run.params
     if int(params.get("checkEnv", False)):
         time, memory = estimate_Consumption(
             platform.system(),
@@ -1156,47 +2212,69 @@ def backend(**args):
         return json.dumps(
             dict(time=time, memory=memory, affordable=free_memory >= memory)
         )
-    with tempfile.NamedTemporaryFile(delete=True, dir=os.path.expanduser("~")) as f:
-        params["tempfix"] = f.name
-        params["prof_file"] = params["tempfix"] + ".prof.npy"
-        params["dist_file"] = params["tempfix"] + ".dist.npy"
-        params["dist_subfile"] = params["tempfix"] + ".dist.{0}.npy"
-        tre = eval("methods." + params["method"])(names, profiles, embeded, **params)
+    run.stage.dimensions.update(
+        n_profiles=int(profiles.shape[0]), n_loci=int(profiles.shape[1])
+    )
+    run.out_of_core = use_out_of_core(params, profiles.shape[1], profiles.shape[0])
+    if run.out_of_core:
+        LOG.info("Keeping the distances of %d profiles on disk", profiles.shape[0])
+    with run:
+        tre = getattr(methods, params["method"])(
+            names, profiles, embeded, run, **params
+        )
+    with run.stage("output"):
         if params["method"] != "distance":
-            maxDist = 0.0
-            for node in tre.iter_descendants():
-                if node.dist > maxDist:
-                    maxDist = node.dist
-            if maxDist > 3:
-                for node in tre.iter_descendants("postorder"):
-                    if node.dist < 0.1 and node.dist > 0:
-                        for s in node.get_sisters():
-                            s.dist += node.dist
-                        node.dist = 0
-            for leaf in tre.get_leaves():
-                embeded_group = embeded[leaf.name]
-                if len(embeded_group) > 1:
-                    leaf.name = ""
-                    for n in embeded_group:
-                        leaf.add_child(name=n, dist=0.0)
-
-            for fname in (params["prof_file"], params["dist_file"]):
-                try:
-                    os.unlink(fname)
-                except:
-                    pass
-            return tre.write(format=1).replace("'", "")
+            tre.collapse_short_branches()
+            tre.expand_leaves(embeded)
+            return tre.write().replace("'", "")
+        elif isinstance(tre, bytes):
+            return tre
         else:
-            for fname in (params["prof_file"], params["dist_file"]):
-                try:
-                    os.unlink(fname)
-                except:
-                    pass
             return "\n".join(tre)
 
 
+def use_out_of_core(params, n_loci, n_profile):
+    """Check if the distance matrix should be kept on disk while building a MSTree.
+
+    Unless set by the out_of_core parameter, it is used when the estimated memory
+    consumption exceeds the available memory.
+    """
+    if params["method"] != "MSTree" or params["matrix_type"] not in (
+        "symmetric",
+        "asymmetric",
+    ):
+        return False
+    if params["out_of_core"] != "auto":
+        return bool(params["out_of_core"])
+    _, memory = estimate_Consumption(
+        platform.system(),
+        params["method"],
+        params["matrix_type"],
+        int(params["n_proc"]),
+        n_loci,
+        n_profile,
+    )
+    return memory > psutil.virtual_memory().available
+
+
+def prewarm(n_profile=None, **args):
+    """Build small synthetic trees ahead of the first job.
+
+    Loads, or compiles, the numba kernels of the MSTree methods and starts the
+    distance worker pool, so that the first job runs at steady-state latency.
+    """
+    params = ClusterRun(**args).params
+    if n_profile is None:
+        n_profile = max(16, 2 * int(params["n_proc"]))
+    rng = np.random.default_rng(0)
+    alleles = rng.integers(0, 4, size=(n_profile, 32))
+    names = ["prewarm_{0}".format(i) for i in range(n_profile)]
+    for method in (ClusterMethod.MSTREE_V2.value, ClusterMethod.MSTREE_V1.value):
+        backend_from_matrix(names, alleles, **dict(args, method=method))
+
+
 def estimate_Consumption(platform, method, matrix, n_proc, n_loci, n_profile):
-    if method in ("MSTree", "RapidNJ", "ninja"):
+    if method in ("MSTree", "RapidNJ", "ninja", "distance"):
         if matrix == "asymmetric":
             if platform == "Windows":
                 time = (
@@ -1,23 +1,149 @@
 """Define reddis tasks."""
 
+import hashlib
 import logging
+from functools import cache
+from io import BytesIO
+from pathlib import Path
 
-from .ms_trees import ClusterMethod, backend
+import numpy as np
+from rq import Queue, get_current_job
+from rq.job import Job
+
+from . import config
+from .admission import monitor_resources, plan_job, profile_size
+from .allele_index import AlleleIndex
+from .cluster_address import ClusterAddresses
+from .distance_cache import DistanceCache
+from .ms_trees import ClusterMethod, StageTimer, backend, backend_from_matrix
+from .tree_state import TreeState
 
 LOG = logging.getLogger(__name__)
 
+RESULT_KEY_PREFIX = "allele_cluster:result"
+TREE_KEY_PREFIX = "allele_cluster:tree"
+DISTANCE_KEY_PREFIX = "allele_cluster:distance"
+
+
+@cache
+def get_distance_cache(typing_method: str) -> DistanceCache | None:
+    """Get the persistent distance cache for a typing method, if enabled."""
+    if config.DISTANCE_CACHE_DIR is None:
+        return None
+    return DistanceCache(Path(config.DISTANCE_CACHE_DIR) / typing_method)
+
+
+@cache
+def get_allele_index(typing_method: str) -> AlleleIndex | None:
+    """Get the allele index of a typing method, if enabled."""
+    if config.ALLELE_INDEX_DIR is None:
+        return None
+    return AlleleIndex(Path(config.ALLELE_INDEX_DIR) / typing_method)
+
+
+@cache
+def get_cluster_addresses(typing_method: str) -> ClusterAddresses | None:
+    """Get the cluster addresses of a typing method, kept with its allele index."""
+    if config.ALLELE_INDEX_DIR is None:
+        return None
+    return ClusterAddresses(
+        Path(config.ALLELE_INDEX_DIR) / typing_method, config.CLUSTER_THRESHOLDS
+    )
+
+
+def decode_profiles(blob: bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Decode a npz blob of sample names, loci and integer coded alleles."""
+    with np.load(BytesIO(blob), allow_pickle=False) as data:
+        return data["names"], data["loci"], data["alleles"]
+
+
+def load_profiles(profile_key: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Load allele profiles stored in redis by the API."""
+    blob = get_current_job().connection.get(profile_key)
+    if blob is None:
+        msg = f"Allele profiles {profile_key} have expired or do not exist"
+        LOG.error(msg)
+        raise ValueError(msg)
+    return decode_profiles(blob)
+
+
+def result_key(cluster_key: str) -> str:
+    """Get the redis key of a cached clustering result."""
+    return f"{RESULT_KEY_PREFIX}:{cluster_key}"
 
-def cluster(profile: str, method: str) -> str:
+
+def distance_key(blob: bytes) -> str:
+    """Get the content addressed redis key of a binary distance matrix."""
+    return f"{DISTANCE_KEY_PREFIX}:{hashlib.sha256(blob).hexdigest()}"
+
+
+def tree_state_key(tree_key: str) -> str:
+    """Get the redis key of the spanning tree kept for a group."""
+    return f"{TREE_KEY_PREFIX}:{tree_key}"
+
+
+def forward_job(job: Job, queue_name: str) -> Job:
+    """Enqueue a copy of a job on another queue and link it in the job meta."""
+    queue = Queue(queue_name, connection=job.connection)
+    forwarded = queue.enqueue(
+        job.func_name,
+        args=job.args,
+        kwargs=job.kwargs,
+        job_timeout=job.timeout,
+        result_ttl=job.result_ttl,
+    )
+    job.meta["forwarded_to"] = forwarded.id
+    job.save_meta()
+    LOG.info("Forwarded job %s to %s as %s", job.id, queue_name, forwarded.id)
+    return forwarded
+
+
+def cluster(
+    profile: str | None = None,
+    method: str = ClusterMethod.MSTREE_V2.value,
+    typing_method: str | None = None,
+    profile_key: str | None = None,
+    handle_missing: str = "pair_delete",
+    cluster_key: str | None = None,
+    tree_key: str | None = None,
+    distance_format: str = "phylip",
+) -> str | bytes | None:
     """
     Cluster multiple sample on their allele profiles.
 
+    The profiles are either given as text or as the redis key of integer coded
+    profiles stored by the API. The resources of the job are estimated before it
+    is run; large jobs are forwarded to the queue for large jobs or run with the
+    distance matrix on disk. The estimate and the measured resources are stored
+    in the job meta, with the wall time, CPU time and peak memory of each stage of
+    the run and the dimensions of the profiles.
+
+    Jobs given a cluster key, the hash of the profiles and options computed by the
+    API, return the cached newick of a previous job with the same key and cache
+    their own result.
+
+    MSTree jobs given a tree key, identifying a group of samples, insert new samples
+    into the tree of the previous job of the group instead of rebuilding it.
+
+    Distance matrices in the npz format are stored in redis under the hash of their
+    content, which is returned instead of the matrix.
+
     :param profile str: a string representation of a tsv table of the allele profiles
     :param method str: the MStree clustering method
+    :param typing_method str: the typing method of the profiles, used to look up
+        previously calculated distances.
+    :param profile_key str: redis key of integer coded allele profiles
+    :param handle_missing str: how missing alleles are compared
+    :param cluster_key str: hash identifying the result of the job
+    :param tree_key str: hash identifying the group of samples clustered
+    :param distance_format str: phylip, or npz for binary distance matrices
 
-    :raises ValueError: raises an exception if the method is not a valid MSTree clustering method.
+    :raises ValueError: raises an exception if the method is not a valid MSTree clustering method
+        or if the job would not fit in the memory budget.
 
-    :return: cluster in newick format
-    :rtype: str
+    :return: cluster in newick format, the phylip distance matrix or the redis key
+        of the npz distance matrix, or None if the job was forwarded
+    :rtype: str | bytes | None
     """
     try:
         method = ClusterMethod(method)
@@ -25,5 +151,151 @@ def cluster(profile: str, method: str) -> str:
         msg = f'"{method}" is not a valid cluster method'
         LOG.error(msg)
         raise ValueError(msg) from error
-    newick = backend(profile=profile, method=method.value)
+    job = get_current_job()
+    if job is not None and cluster_key is not None:
+        cached = job.connection.get(result_key(cluster_key))
+        if cached is not None:
+            LOG.info("Using the cached result of %s", cluster_key)
+            return cached.decode()
+    if profile_key is not None:
+        names, loci, alleles = load_profiles(profile_key)
+        n_profile, n_loci = alleles.shape
+    else:
+        n_profile, n_loci = profile_size(profile)
+
+    plan = plan_job(
+        method.value,
+        n_profile,
+        n_loci,
+        memory_budget=float(config.MEMORY_BUDGET) if config.MEMORY_BUDGET else None,
+        large_job_runtime=(
+            float(config.LARGE_JOB_RUNTIME)
+            if config.LARGE_JOB_RUNTIME and config.LARGE_JOB_QUEUE
+            else None
+        ),
+    )
+    if job is not None:
+        job.meta["resources"] = plan.as_meta()
+        job.save_meta()
+        if plan.forward and job.origin != config.LARGE_JOB_QUEUE:
+            forward_job(job, config.LARGE_JOB_QUEUE)
+            return None
+
+    distance_cache = (
+        None if typing_method is None else get_distance_cache(typing_method)
+    )
+    timer = StageTimer()
+    options = {
+        "method": method.value,
+        "handle_missing": handle_missing,
+        "distance_cache": distance_cache,
+        "stage_timer": timer,
+        "distance_format": distance_format,
+    }
+    if plan.out_of_core:
+        options["out_of_core"] = True
+    tree_state = None
+    if job is not None and tree_key is not None and method == ClusterMethod.MSTREE_V1:
+        blob = job.connection.get(tree_state_key(tree_key))
+        tree_state = TreeState() if blob is None else TreeState.from_bytes(blob)
+        options["tree_state"] = tree_state
+    try:
+        with monitor_resources() as usage:
+            if profile_key is not None:
+                newick = backend_from_matrix(names, alleles, loci=loci, **options)
+            else:
+                newick = backend(profile=profile, **options)
+    finally:
+        # the stages that finished show where a failed or timed out job got to
+        if job is not None:
+            job.meta["resources"].update(usage)
+            job.meta["stages"] = timer.stages
+            job.meta["dimensions"] = dict(timer.dimensions, n_samples=n_profile)
+            job.save_meta()
+    if job is not None:
+        if isinstance(newick, bytes):
+            key = distance_key(newick)
+            job.connection.set(key, newick, ex=config.RESULT_TTL)
+            newick = key
+        if cluster_key is not None:
+            job.connection.set(result_key(cluster_key), newick, ex=config.RESULT_TTL)
+        if tree_state is not None and len(tree_state) > 0:
+            job.connection.set(
+                tree_state_key(tree_key),
+                tree_state.to_bytes(),
+                ex=config.TREE_STATE_TTL,
+            )
     return newick
+
+
+def add_to_index(profile_key: str, typing_method: str) -> int:
+    """Add allele profiles stored in redis by the API to the allele index.
+
+    :return: the number of new or changed profiles
+    """
+    index = get_allele_index(typing_method)
+    if index is None:
+        LOG.warning("The allele index is disabled, set ALLELE_INDEX_DIR to enable it")
+        return 0
+    names, loci, alleles = load_profiles(profile_key)
+    return index.add(names.tolist(), loci.tolist(), alleles)
+
+
+def remove_from_index(sample_ids: list[str], typing_method: str) -> int:
+    """Remove samples from the allele index and the cluster addresses.
+
+    The clusters the samples linked are kept.
+
+    :return: the number of removed samples
+    """
+    index = get_allele_index(typing_method)
+    if index is None:
+        return 0
+    get_cluster_addresses(typing_method).remove(sample_ids)
+    return index.remove(sample_ids)
+
+
+def find_neighbours(
+    sample_id: str, typing_method: str, max_distance: int, limit: int | None = None
+) -> list[dict]:
+    """Find the samples with at most max_distance allele differences to a sample.
+
+    :raises ValueError: if the allele index is disabled or the sample is not in it
+
+    :return: sample ids and their number of differing alleles, closest first
+    """
+    index = get_allele_index(typing_method)
+    if index is None:
+        msg = "The allele index is disabled, set ALLELE_INDEX_DIR to enable it"
+        LOG.error(msg)
+        raise ValueError(msg)
+    return index.neighbours(sample_id, max_distance, limit=limit)
+
+
+def assign_cluster_address(sample_id: str, typing_method: str) -> dict[str, dict]:
+    """Assign a sample in the allele index to single linkage clusters.
+
+    :raises ValueError: if the allele index is disabled or the sample is not in it
+
+    :return: cluster addresses of the sample, with the merges it caused, and of the
+        samples in the clusters it merged
+    """
+    index = get_allele_index(typing_method)
+    if index is None:
+        msg = "The allele index is disabled, set ALLELE_INDEX_DIR to enable it"
+        LOG.error(msg)
+        raise ValueError(msg)
+    return get_cluster_addresses(typing_method).assign(sample_id, index)
+
+
+def lookup_cluster_addresses(
+    typing_method: str, sample_ids: list[str] | None = None
+) -> dict[str, dict]:
+    """Get the cluster addresses of samples, or of all samples, with their merges.
+
+    Used by the API to reconcile the addresses stored on the samples.
+    """
+    addresses = get_cluster_addresses(typing_method)
+    if addresses is None:
+        return {}
+    return addresses.addresses(sample_ids)
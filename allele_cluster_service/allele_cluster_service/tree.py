@@ -0,0 +1,160 @@
+"""Lightweight rooted trees written as newick without ete3."""
+
+import re
+
+ILLEGAL_NEWICK_CHARS = re.compile(r"[:;(),\[\]\t\n\r=]")
+
+
+class ArrayTree:
+    """A rooted tree stored as parent and child index lists.
+
+    Node 0 is the root. Output is the same as an ete3 tree written with format 1.
+    """
+
+    def __init__(self, name=""):
+        self.parent = [-1]
+        self.children = [[]]
+        self.dist = [0.0]
+        self.name = [name]
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_child(self, node, name="", dist=0.0):
+        """Add a child to node and get its index."""
+        child = len(self.parent)
+        self.parent.append(node)
+        self.children.append([])
+        self.children[node].append(child)
+        self.dist.append(float(dist))
+        self.name.append(name)
+        return child
+
+    @classmethod
+    def from_branches(cls, branches, names):
+        """Create a tree from the [src, tgt, length] branches of a spanning tree.
+
+        The root is the source of the longest branch. Internal nodes are unnamed and
+        have their sample attached as a leaf with a zero length branch.
+        """
+        tree = cls()
+        if len(branches) == 0:  # all samples have the same profile
+            for name in names:
+                tree.add_child(0, str(name), 0)
+            return tree
+        branches = sorted(branches, key=lambda x: x[2], reverse=True)
+        # Branches are added by scanning the sorted list repeatedly and taking the
+        # ones connected to the tree so far. A branch is taken in the same scan as
+        # the branch above it if it comes later in the list, else in the next one.
+        root = branches[0][0]
+        incident = {}
+        for i, (src, tgt, _) in enumerate(branches):
+            incident.setdefault(src, []).append(i)
+            incident.setdefault(tgt, []).append(i)
+        added = {root: (0, -1)}
+        order = [None] * len(branches)
+        oriented = [None] * len(branches)
+        stack = [root]
+        while stack:
+            src = stack.pop()
+            scan, pos = added[src]
+            for i in incident[src]:
+                if order[i] is not None:
+                    continue
+                tgt = branches[i][1] if branches[i][0] == src else branches[i][0]
+                order[i] = added[tgt] = (scan + (i < pos), i)
+                oriented[i] = [src, tgt, branches[i][2]]
+                stack.append(tgt)
+        branch = [oriented[i] for i in sorted(range(len(order)), key=order.__getitem__)]
+
+        samples = [root]
+        node_of = {root: 0}
+        for src, tgt, dif in branch:
+            node_of[tgt] = tree.add_child(node_of[src], dist=dif)
+            samples.append(tgt)
+        for node, sample in enumerate(samples):
+            if tree.children[node]:
+                tree.add_child(node, str(names[sample]), 0.0)
+            else:
+                tree.name[node] = str(names[sample])
+        return tree
+
+    @classmethod
+    def from_ete3(cls, ete_tree):
+        """Convert an ete3 tree, keeping the order of the children."""
+        tree = cls(str(ete_tree.name))
+        tree.dist[0] = float(ete_tree.dist)
+        stack = [(ete_tree, 0)]
+        while stack:
+            ete_node, node = stack.pop()
+            for child in ete_node.children:
+                stack.append((child, tree.add_child(node, str(child.name), child.dist)))
+        return tree
+
+    def leaves(self):
+        """Get the indices of the leaves."""
+        return [node for node, children in enumerate(self.children) if not children]
+
+    def postorder(self):
+        """Get the descendants of the root in postorder."""
+        order = []
+        stack = [(0, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited or not self.children[node]:
+                order.append(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(self.children[node]))
+        return order[:-1]
+
+    def collapse_short_branches(self, max_dist=3, min_dist=0.1):
+        """Move branches shorter than min_dist to their sisters.
+
+        Only done in trees with branches longer than max_dist.
+        """
+        dist = self.dist
+        if max(dist[1:], default=0.0) <= max_dist:
+            return
+        for node in self.postorder():
+            if 0 < dist[node] < min_dist:
+                for sister in self.children[self.parent[node]]:
+                    if sister != node:
+                        dist[sister] += dist[node]
+                dist[node] = 0.0
+
+    def expand_leaves(self, embeded):
+        """Attach the samples with identical profiles to the leaf of their group."""
+        for leaf in self.leaves():
+            group = embeded[self.name[leaf]]
+            if len(group) > 1:
+                self.name[leaf] = ""
+                for name in group:
+                    self.add_child(leaf, name, 0.0)
+
+    def _format_node(self, node):
+        name = ILLEGAL_NEWICK_CHARS.sub("_", self.name[node])
+        return "%s:%0.6g" % (name, self.dist[node])
+
+    def write(self):
+        """Write the tree as newick with names and branch lengths."""
+        newick = []
+        stack = [(0, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                newick.append(")")
+                if node != 0:
+                    newick.append(self._format_node(node))
+                continue
+            parent = self.parent[node]
+            if parent >= 0 and self.children[parent][0] != node:
+                newick.append(",")
+            if self.children[node]:
+                newick.append("(")
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(self.children[node]))
+            else:
+                newick.append(self._format_node(node))
+        newick.append(";")
+        return "".join(newick)
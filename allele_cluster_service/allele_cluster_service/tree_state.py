@@ -0,0 +1,76 @@
+"""Minimum spanning trees kept between runs to insert new profiles into."""
+
+from io import BytesIO
+
+import numpy as np
+
+# the tree is rebuilt once the profiles added since it was built exceed this fraction
+REBUILD_FRACTION = 0.2
+# or if inserting profiles replaced more than this fraction of its edges
+MAX_CHANGED_EDGES = 0.1
+
+
+class TreeState:
+    """The last minimum spanning tree built from a group of profiles.
+
+    Nodes are identified by the hash of their profile and ranked by the heuristic
+    that breaks ties between edges of equal length. MSTree runs given a state insert
+    new profiles into its tree, rebuild it when needed and update the state.
+    """
+
+    def __init__(self, keys=(), ranks=(), src=(), dst=(), distance=(), n_built=0):
+        self.keys = np.asarray(keys, dtype=str)
+        self.ranks = np.asarray(ranks, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.int64)
+        self.dst = np.asarray(dst, dtype=np.int64)
+        self.distance = np.asarray(distance, dtype=np.int64)
+        self.n_built = int(n_built)
+
+    def __len__(self):
+        return self.keys.size
+
+    def update(self, keys, ranks, branches, n_built=None):
+        """Replace the tree with [src, dst, rounded distance] branches."""
+        branches = np.asarray(branches, dtype=np.int64).reshape([-1, 3])
+        self.keys = np.asarray(keys, dtype=str)
+        self.ranks = np.asarray(ranks, dtype=np.int64)
+        self.src, self.dst, self.distance = branches.T.copy()
+        if n_built is not None:
+            self.n_built = int(n_built)
+
+    def needs_rebuild(self, keys) -> bool:
+        """Check if the tree should be rebuilt rather than extended with keys.
+
+        Trees without some of the profiles were built from profiles that have since
+        been removed or changed.
+        """
+        if len(self) == 0 or not np.all(np.isin(self.keys, keys)):
+            return True
+        return len(keys) - self.n_built > REBUILD_FRACTION * self.n_built
+
+    def to_bytes(self) -> bytes:
+        """Serialize the state as a npz blob."""
+        buffer = BytesIO()
+        np.savez(
+            buffer,
+            keys=self.keys,
+            ranks=self.ranks,
+            src=self.src,
+            dst=self.dst,
+            distance=self.distance,
+            n_built=np.int64(self.n_built),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> "TreeState":
+        """Read a state serialized by to_bytes."""
+        with np.load(BytesIO(blob), allow_pickle=False) as data:
+            return cls(
+                data["keys"],
+                data["ranks"],
+                data["src"],
+                data["dst"],
+                data["distance"],
+                data["n_built"],
+            )
@@ -1,10 +1,14 @@
 """Service entrypoint for minhash service."""
 
+import argparse
 import logging
+import time
+from importlib import import_module
 from logging.config import dictConfig
 
+import psutil
 from redis import Redis
-from rq import Queue, Worker
+from rq import Queue, SimpleWorker
 
 from . import config
 
@@ -14,13 +18,37 @@ LOG = logging.getLogger(__name__)
 
 def create_app():
     """Start a new worker instance."""
+    parser = argparse.ArgumentParser(description="Start an allele cluster worker.")
+    parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="Build a small tree to compile the clustering kernels before starting.",
+    )
+    args = parser.parse_args()
+    start = time.perf_counter()
     LOG.info("Preparing to start worker")
     LOG.info("Setup redis connection: %s:%s", config.REDIS_HOST, config.REDIS_PORT)
 
     redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
 
-    # start worker with json serializer
-    LOG.info("Starting worker...")
+    # load the tasks before the first job arrives
+    import_module(f"{__package__}.tasks")
+
+    LOG.info("Loaded tasks in %.1f s", time.perf_counter() - start)
+    if args.prewarm:
+        prewarm_start = time.perf_counter()
+        from .ms_trees import prewarm  # pylint: disable=import-outside-toplevel
+
+        prewarm()
+        LOG.info("Prewarmed worker in %.1f s", time.perf_counter() - prewarm_start)
+
+    # jobs are run in the worker process to keep the distance worker pool
+    # alive between jobs. A killed pool process only fails the running job, but
+    # if the worker itself is killed, e.g. by the OOM killer, the container is
+    # restarted and the abandoned job is moved to the failed registry instead of
+    # being retried, so the same job does not crash the worker again.
+    startup = time.time() - psutil.Process().create_time()
+    LOG.info("Starting worker, startup took %.1f s", startup)
     queue = Queue(config.REDIS_QUEUE, connection=redis)
-    worker = Worker([queue], connection=redis)
+    worker = SimpleWorker([queue], connection=redis)
     worker.work()
@@ -0,0 +1,60 @@
+"""Compare the compiled and the Python branch recrafting of MSTreeV2.
+
+Both implementations are run on the same synthetic tree and their output is checked
+to be identical.
+
+    python benchmarks/branch_recraft.py --samples 2000 --loci 1000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from allele_cluster_service.ms_trees import ClusterRun, distance_matrix, methods
+from synthetic import clonal_profiles
+
+
+def timed(func, repeats=1):
+    """Get the result and the shortest runtime of a function."""
+    runtimes = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        runtimes.append(time.perf_counter() - start)
+    return result, min(runtimes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--loci", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    profiles = np.unique(clonal_profiles(rng, args.samples, args.loci), axis=0)
+    with ClusterRun(method="MSTreeV2", n_proc=1) as run:
+        dist = distance_matrix.get_distance("asymmetric", profiles, "pair_delete", run)
+        weights = distance_matrix.harmonic(dist, np.ones(len(profiles), dtype=int))
+        tree = methods._asymmetric(dist, weights, run)
+        # compile the kernels outside of the timing
+        methods._branch_recraft([list(br) for br in tree], dist, weights, args.loci)
+        results = {}
+        for name, func in (
+            ("compiled", methods._branch_recraft),
+            ("python", methods._branch_recraft_python),
+        ):
+            branches, runtime = timed(
+                lambda: func([list(br) for br in tree], dist, weights, args.loci),
+                repeats=args.repeats,
+            )
+            results[name] = [[int(s), int(t), float(d)] for s, t, d in branches]
+            print(f"{name}: {runtime:.3f} s for {len(profiles)} profiles")
+    if results["compiled"] != results["python"]:
+        raise SystemExit("The implementations gave different trees")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Time the stages of the clustering methods on seeded synthetic profiles.
+
+Every method and distance matrix is run in a new process, which gives the peak
+resident memory of the run without the memory of earlier runs. The memory of the
+bundled NJ and RapidNJ programs is not measured. The results are written as JSON
+together with the commit they were measured on, and two result files can be
+compared.
+
+    python benchmarks/cluster_methods.py --samples 2000 --loci 3000 -o base.json
+    python benchmarks/cluster_methods.py --compare base.json new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+
+import numba
+import numpy as np
+
+from allele_cluster_service.ms_trees import (
+    StageTimer,
+    backend,
+    backend_from_matrix,
+    shutdown_pool,
+)
+from synthetic import clonal_profiles, profile_table
+
+# method and matrix to the backend parameters, NJ and RapidNJ build the tree from
+# the symmetric matrix only
+CONFIGURATIONS = {
+    ("MSTree", "symmetric"): dict(method="MSTree", matrix_type="symmetric"),
+    ("MSTree", "asymmetric"): dict(method="MSTree", matrix_type="asymmetric"),
+    ("MSTreeV2", "symmetric"): dict(
+        method="MSTree",
+        matrix_type="symmetric",
+        heuristic="harmonic",
+        branch_recraft=True,
+    ),
+    ("MSTreeV2", "asymmetric"): dict(method="MSTreeV2"),
+    ("NJ", "symmetric"): dict(method="NJ"),
+    ("RapidNJ", "symmetric"): dict(method="RapidNJ"),
+}
+
+
+def max_rss():
+    """Get the peak resident memory of the process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_configuration(args, method, matrix_type):
+    """Build one tree of the synthetic profiles and time its stages."""
+    rng = np.random.default_rng(args.seed)
+    profiles = clonal_profiles(
+        rng,
+        args.samples,
+        args.loci,
+        n_clones=args.clones,
+        mutation_rate=args.mutation_rate,
+        missing_rate=args.missing_rate,
+    )
+    names = [f"sample{i}" for i in range(args.samples)]
+    params = dict(CONFIGURATIONS[method, matrix_type], n_proc=args.n_proc)
+    if args.input == "text":
+        text = profile_table(names, profiles)
+        run = lambda timer: backend(profile=text, stage_timer=timer, **params)
+    else:
+        run = lambda timer: backend_from_matrix(
+            names, profiles, stage_timer=timer, **params
+        )
+    # loads the cached numba kernels and starts the worker pool outside the timing
+    run(StageTimer())
+
+    timer = StageTimer()
+    start = time.perf_counter()
+    run(timer)
+    return {
+        "method": method,
+        "matrix_type": matrix_type,
+        "wall_time": time.perf_counter() - start,
+        "max_rss": max_rss(),
+        "stages": timer.stages,
+    }
+
+
+def _run_in_process(queue, args, method, matrix_type):
+    try:
+        queue.put(run_configuration(args, method, matrix_type))
+    except Exception as error:
+        queue.put(RuntimeError(f"{method} {matrix_type} failed: {error!r}"))
+    finally:
+        shutdown_pool()
+
+
+def git_commit():
+    """Get the checked out commit and if the tree has uncommitted changes."""
+    root = Path(__file__).parent
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def benchmark(args):
+    """Run every configuration in a new process and collect the results."""
+    commit, dirty = git_commit()
+    context = get_context("spawn")
+    results = []
+    for method in args.methods:
+        for matrix_type in args.matrix_types:
+            if (method, matrix_type) not in CONFIGURATIONS:
+                continue
+            for repeat in range(args.repeats):
+                # not a pool worker, those cannot start the distance worker pool
+                queue = context.SimpleQueue()
+                process = context.Process(
+                    target=_run_in_process, args=(queue, args, method, matrix_type)
+                )
+                process.start()
+                result = queue.get()
+                process.join()
+                if isinstance(result, BaseException):
+                    raise result
+                result["repeat"] = repeat
+                results.append(result)
+                print(
+                    f"{method} {matrix_type}: {result['wall_time']:.2f} s, "
+                    f"{result['max_rss'] / 2**20:.0f} MiB",
+                    file=sys.stderr,
+                )
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "platform": {
+            "system": platform.system(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "numba": numba.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "samples": args.samples,
+            "loci": args.loci,
+            "clones": args.clones,
+            "mutation_rate": args.mutation_rate,
+            "missing_rate": args.missing_rate,
+            "seed": args.seed,
+            "input": args.input,
+            "n_proc": args.n_proc,
+        },
+        "results": results,
+    }
+
+
+def median_times(report):
+    """Get the median wall time of each method, matrix and stage of a report."""
+    times = {}
+    for result in report["results"]:
+        key = (result["method"], result["matrix_type"])
+        times.setdefault(key + ("total",), []).append(result["wall_time"])
+        for stage in result["stages"]:
+            times.setdefault(key + (stage["stage"],), []).append(stage["wall_time"])
+    return {key: statistics.median(values) for key, values in times.items()}
+
+
+def compare(base_file, new_file):
+    """Print the median stage times of two reports and their ratio."""
+    reports = []
+    for path in (base_file, new_file):
+        with open(path, encoding="utf-8") as inpt:
+            reports.append(json.load(inpt))
+    if reports[0]["parameters"] != reports[1]["parameters"]:
+        print("The reports were run with different parameters", file=sys.stderr)
+    base, new = (median_times(report) for report in reports)
+    print("method\tmatrix\tstage\tbase\tnew\tratio")
+    for key in sorted(base.keys() & new.keys()):
+        ratio = new[key] / base[key] if base[key] > 0 else float("nan")
+        print("\t".join(key) + f"\t{base[key]:.3f}\t{new[key]:.3f}\t{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--loci", type=int, default=1000)
+    parser.add_argument("--clones", type=int, default=10)
+    parser.add_argument("--mutation-rate", type=float, default=0.05)
+    parser.add_argument("--missing-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--n-proc", type=int, default=1)
+    parser.add_argument(
+        "--input",
+        choices=["text", "matrix"],
+        default="text",
+        help="Run from a tsv profile or from an integer allele matrix.",
+    )
+    parser.add_argument(
+        "--methods",
+        nargs="+",
+        default=["MSTree", "MSTreeV2", "NJ", "RapidNJ"],
+    )
+    parser.add_argument(
+        "--matrix-types", nargs="+", default=["symmetric", "asymmetric"]
+    )
+    parser.add_argument("-o", "--output", help="JSON file, stdout if not given.")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="Compare the stage times of two result files instead.",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump(report, out, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
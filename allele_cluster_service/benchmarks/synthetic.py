@@ -0,0 +1,31 @@
+"""Seeded synthetic allele profiles for the benchmarks."""
+
+import numpy as np
+
+
+def clonal_profiles(
+    rng, n_samples, n_loci, n_clones=10, mutation_rate=0.05, missing_rate=0.01
+):
+    """Profiles derived from a few ancestors by random mutation.
+
+    Samples draw an ancestor at random, every allele is mutated to a new allele with
+    mutation_rate and is missing, coded as 0, with missing_rate. Few clones with a low
+    mutation rate give many close and identical profiles.
+    """
+    ancestors = rng.integers(1, 10, size=(n_clones, n_loci))
+    profiles = ancestors[rng.integers(0, n_clones, size=n_samples)]
+    mutated = rng.random(profiles.shape) < mutation_rate
+    profiles[mutated] = rng.integers(10, 1000, size=mutated.sum())
+    profiles[rng.random(profiles.shape) < missing_rate] = 0
+    return profiles
+
+
+def profile_table(names, profiles):
+    """Format profiles as the tab separated text read by the clustering backend."""
+    n_loci = profiles.shape[1]
+    lines = ["#name\t" + "\t".join(f"locus{i}" for i in range(n_loci))]
+    lines.extend(
+        name + "\t" + "\t".join(map(str, profile))
+        for name, profile in zip(names, profiles.tolist())
+    )
+    return "\n".join(lines)
@@ -0,0 +1,49 @@
+"""Test estimation of the resources of cluster jobs."""
+
+import pytest
+
+from allele_cluster_service.admission import monitor_resources, plan_job, profile_size
+
+
+def test_profile_size(mlst_profiles_different):
+    """Test that the size of a profile is read from the table."""
+    assert profile_size(mlst_profiles_different) == (5, 7)
+
+
+def test_small_jobs_are_run_in_memory():
+    """Test that jobs within the memory budget are run as is."""
+    plan = plan_job("MSTreeV2", 100, 3000, memory_budget=2**40)
+
+    assert not plan.out_of_core
+    assert not plan.forward
+    assert plan.as_meta()["n_profile"] == 100
+
+
+def test_mstree_jobs_over_budget_are_run_out_of_core():
+    """Test that MSTree jobs that need too much memory are run with the matrix on disk."""
+    plan = plan_job("MSTreeV2", 50000, 3000, memory_budget=2**30)
+
+    assert plan.out_of_core
+
+
+def test_jobs_over_budget_are_rejected():
+    """Test that jobs that can't be run out of core are rejected."""
+    with pytest.raises(ValueError):
+        plan_job("NJ", 50000, 3000, memory_budget=2**30)
+
+
+def test_long_jobs_are_forwarded():
+    """Test that jobs estimated to run long should go to the large job queue."""
+    plan = plan_job("MSTreeV2", 50000, 3000, memory_budget=2**50, large_job_runtime=60)
+
+    assert plan.forward
+
+
+def test_monitor_resources():
+    """Test that the runtime and memory of the process are measured."""
+    with monitor_resources(interval=0.01) as usage:
+        data = bytearray(2**20)
+    del data
+
+    assert usage["runtime"] > 0
+    assert usage["max_rss"] > 2**20
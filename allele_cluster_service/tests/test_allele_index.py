@@ -0,0 +1,126 @@
+"""Test the inverted index of allele profiles."""
+
+import numpy as np
+import pytest
+
+from allele_cluster_service import allele_index
+from allele_cluster_service.allele_index import AlleleIndex
+
+
+def brute_force_neighbours(names, profiles, query, max_distance):
+    """Neighbours found by comparing the query with every profile."""
+    row = list(names).index(query)
+    called = (profiles > 0) & (profiles[row] > 0)
+    mismatch = np.sum((profiles != profiles[row]) & called, 1)
+    return sorted(
+        (int(mismatch[i]), name)
+        for i, name in enumerate(names)
+        if i != row and mismatch[i] <= max_distance
+    )
+
+
+@pytest.fixture
+def profiles():
+    """Profiles of a few clones with missing alleles."""
+    rng = np.random.default_rng(1)
+    ancestors = rng.integers(1, 5, size=(4, 300))
+    alleles = ancestors[rng.integers(0, 4, size=120)]
+    mutated = rng.random(alleles.shape) < 0.02
+    alleles[mutated] = rng.integers(5, 50, size=mutated.sum())
+    alleles[rng.random(alleles.shape) < 0.02] = 0
+    return [f"s{i}" for i in range(len(alleles))], alleles
+
+
+@pytest.mark.parametrize("merge_rows", [1, 50, 1024])
+@pytest.mark.parametrize("max_distance", [0, 5, 20])
+def test_neighbours_match_brute_force(
+    profiles, tmp_path, monkeypatch, merge_rows, max_distance
+):
+    """Test that indexed and not yet indexed rows give the exact neighbours."""
+    monkeypatch.setattr(allele_index, "MERGE_ROWS", merge_rows)
+    monkeypatch.setattr(allele_index, "VERIFY_LOCI", 64)
+    names, alleles = profiles
+    loci = [f"locus{i}" for i in range(alleles.shape[1])]
+    index = AlleleIndex(tmp_path)
+    for first in range(0, len(names), 40):
+        index.add(names[first : first + 40], loci, alleles[first : first + 40])
+
+    for query in names[:10]:
+        expected = brute_force_neighbours(names, alleles, query, max_distance)
+        hits = AlleleIndex(tmp_path).neighbours(query, max_distance)
+        assert [(hit["distance"], hit["sample_id"]) for hit in hits] == expected
+
+
+def test_updated_and_removed_samples(tmp_path, monkeypatch):
+    """Test that samples are found by their latest profile and not once removed."""
+    monkeypatch.setattr(allele_index, "MERGE_ROWS", 1)
+    loci = ["a", "b", "c", "d"]
+    index = AlleleIndex(tmp_path)
+    index.add(["s1", "s2", "s3"], loci, [[1, 2, 3, 4], [1, 2, 3, 5], [2, 3, 4, 5]])
+
+    assert index.add(["s2"], loci, [[1, 2, 3, 5]]) == 0
+    assert index.add(["s3"], loci[::-1], [[5, 3, 0, 1]]) == 1
+    assert index.neighbours("s1", 1) == [
+        {"sample_id": "s2", "distance": 1},
+        {"sample_id": "s3", "distance": 1},
+    ]
+    assert index.remove(["s2", "s4"]) == 1
+    assert len(index) == 2
+    assert index.neighbours("s1", 1, limit=5) == [{"sample_id": "s3", "distance": 1}]
+    with pytest.raises(ValueError):
+        index.neighbours("s2", 1)
+
+
+def test_merged_postings_match_a_full_build(profiles, tmp_path, monkeypatch):
+    """Test that merging rows in batches gives the posting lists of one build."""
+    monkeypatch.setattr(allele_index, "MERGE_ROWS", 30)
+    names, alleles = profiles
+    loci = [f"locus{i}" for i in range(alleles.shape[1])]
+    merged = AlleleIndex(tmp_path / "merged")
+    for first in range(0, len(names), 30):
+        merged.add(names[first : first + 30], loci, alleles[first : first + 30])
+    built = AlleleIndex(tmp_path / "built")
+    built.add(names, loci, alleles)
+
+    merged_postings, built_postings = merged._open()[2], built._open()[2]
+    assert isinstance(merged_postings["rows"], np.memmap)
+    for key in allele_index.POSTING_ARRAYS:
+        np.testing.assert_array_equal(merged_postings[key], built_postings[key])
+
+
+def test_rows_are_reclaimed(profiles, tmp_path, monkeypatch):
+    """Test that rows of removed and changed samples are dropped from the index."""
+    monkeypatch.setattr(allele_index, "MERGE_ROWS", 20)
+    names, alleles = profiles
+    loci = [f"locus{i}" for i in range(alleles.shape[1])]
+    index = AlleleIndex(tmp_path)
+    index.add(names, loci, alleles)
+    index.remove(names[:20])
+    changed = alleles.copy()
+    changed[20:40, :3] = 99
+    index.add(names[20:40], loci, changed[20:40])
+
+    assert index._read_index()["n_rows"] == len(names) - 20
+    assert len(list(tmp_path.glob("postings.*"))) == 1
+    assert [path.name for path in tmp_path.glob("alleles.*")] == ["alleles.2.u32"]
+    for query in names[20:30]:
+        expected = brute_force_neighbours(names[20:], changed[20:], query, 10)
+        hits = index.neighbours(query, 10)
+        assert [(hit["distance"], hit["sample_id"]) for hit in hits] == expected
+
+
+@pytest.mark.parametrize("merge_rows", [1, 1024])
+def test_loci_are_added(tmp_path, monkeypatch, merge_rows):
+    """Test that loci not called in the first samples count toward distances."""
+    monkeypatch.setattr(allele_index, "MERGE_ROWS", merge_rows)
+    index = AlleleIndex(tmp_path)
+    index.add(["s1"], ["a", "b"], [[1, 1]])
+    index.add(["s2"], ["a", "c"], [[1, 2]])
+    index.add(["s3"], ["a", "c"], [[1, 3]])
+
+    assert index._read_index()["loci"] == ["a", "b", "c"]
+    assert index.neighbours("s3", 1) == [
+        {"sample_id": "s1", "distance": 0},
+        {"sample_id": "s2", "distance": 1},
+    ]
+    assert index.neighbours("s3", 0) == [{"sample_id": "s1", "distance": 0}]
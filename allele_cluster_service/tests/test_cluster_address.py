@@ -0,0 +1,74 @@
+"""Test the single linkage cluster addresses."""
+
+import networkx as nx
+import numpy as np
+
+from allele_cluster_service.allele_index import AlleleIndex
+from allele_cluster_service.cluster_address import ClusterAddresses
+
+
+def test_clusters_are_single_linkage_components(tmp_path):
+    """Test that samples added one at a time give the single linkage clusters."""
+    rng = np.random.default_rng(2)
+    ancestors = rng.integers(1, 5, size=(5, 100))
+    alleles = ancestors[rng.integers(0, 5, size=80)]
+    mutated = rng.random(alleles.shape) < 0.05
+    alleles[mutated] = rng.integers(5, 50, size=mutated.sum())
+    alleles[rng.random(alleles.shape) < 0.02] = 0
+    names = [f"s{i}" for i in range(len(alleles))]
+    loci = [f"locus{i}" for i in range(alleles.shape[1])]
+    index = AlleleIndex(tmp_path)
+    addresses = ClusterAddresses(tmp_path, thresholds=[3, 8, 15])
+    for name, profile in zip(names, alleles):
+        index.add([name], loci, [profile])
+        addresses.assign(name, index)
+
+    called = (alleles > 0)[:, None] & (alleles > 0)[None]
+    dist = np.sum((alleles[:, None] != alleles[None]) & called, 2)
+    for k, threshold in enumerate([3, 8, 15]):
+        components = nx.connected_components(nx.Graph(dist <= threshold))
+        expected = {frozenset(names[i] for i in c) for c in components}
+        clusters = {}
+        for name in names:
+            clusters.setdefault(addresses.address(name)["clusters"][k], set()).add(name)
+
+        assert {frozenset(c) for c in clusters.values()} == expected
+
+
+def test_merges_are_recorded(tmp_path):
+    """Test that a sample linking two clusters merges them into the oldest."""
+    loci = ["a", "b", "c", "d"]
+    index = AlleleIndex(tmp_path)
+    addresses = ClusterAddresses(tmp_path, thresholds=[1, 2])
+    index.add(["s1", "s2", "s3"], loci, [[1, 1, 1, 1], [2, 2, 1, 1], [2, 2, 2, 2]])
+    for name in ["s1", "s3"]:
+        addresses.assign(name, index)
+
+    assert addresses.address("s3")["address"] == "2.2"
+    changed = addresses.assign("s2", index)
+
+    assert changed["s2"]["merges"] == [
+        {"threshold": 2, "clusters": [1, 2], "cluster": 1}
+    ]
+    assert changed["s2"]["address"] == "1.3"
+    assert changed["s3"]["address"] == "1.2"
+    assert set(changed) == {"s2", "s3"}
+
+
+def test_merges_of_merged_samples_are_kept(tmp_path):
+    """Test that merged samples are given new addresses without their merges."""
+    loci = ["a", "b", "c", "d"]
+    index = AlleleIndex(tmp_path)
+    addresses = ClusterAddresses(tmp_path, thresholds=[1])
+    index.add(["s1", "s2", "s3"], loci, [[1, 1, 1, 1], [1, 1, 1, 2], [1, 1, 2, 2]])
+    for name in ["s1", "s3"]:
+        addresses.assign(name, index)
+    changed = addresses.assign("s2", index)
+
+    assert "merges" not in changed["s3"]
+    assert addresses.address("s2")["merges"] == [
+        {"threshold": 1, "clusters": [1, 2], "cluster": 1}
+    ]
+    assert addresses.address("s3")["merges"] == []
+    assert set(addresses.addresses()) == {"s1", "s2", "s3"}
+    assert (tmp_path / "merges.jsonl").read_text().count("\n") == 1
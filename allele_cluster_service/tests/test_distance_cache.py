@@ -0,0 +1,78 @@
+"""Test the persistent cache of pairwise distances."""
+
+import json
+
+import numpy as np
+import pytest
+
+from allele_cluster_service.distance_cache import DistanceCache
+from allele_cluster_service.ms_trees import backend, distance_matrix
+
+
+@pytest.mark.parametrize("method", ["MSTree", "MSTreeV2", "distance"])
+def test_cached_distances_give_same_tree(mlst_profiles_different, method, tmp_path):
+    """Test that trees built from cached distances are identical."""
+    expected = backend(profile=mlst_profiles_different, method=method)
+    cache = DistanceCache(tmp_path)
+
+    first = backend(
+        profile=mlst_profiles_different, method=method, distance_cache=cache
+    )
+    second = backend(
+        profile=mlst_profiles_different, method=method, distance_cache=cache
+    )
+    assert first == second == expected
+
+
+def test_only_new_pairs_are_calculated(tmp_path, monkeypatch):
+    """Test that cached pairs are reused and changed profiles are recalculated."""
+    profiles = np.array([[1, 2, 3, 0], [1, 2, 4, 4], [2, 2, 3, 1]])
+    keys = [("s1", "a"), ("s2", "b"), ("s3", "c")]
+    cache = DistanceCache(tmp_path)
+    calculated = []
+
+    def pair_counts(profiles, rows, cols):
+        # other jobs can use the cache while the counts are calculated
+        assert not cache._thread_lock.locked()
+        calculated.append(rows.size)
+        return _pair_counts(profiles, rows, cols)
+
+    def mismatch(keys, profiles):
+        return cache.distances(keys, profiles, "symmetric", "absolute_distance")
+
+    _pair_counts = distance_matrix.pair_counts
+    monkeypatch.setattr(distance_matrix, "pair_counts", pair_counts)
+
+    np.testing.assert_array_equal(
+        mismatch(keys, profiles), [[0, 1, 1], [1, 0, 3], [1, 3, 0]]
+    )
+    assert calculated == [3]
+
+    # a job with a subset of the samples is served from the cache
+    for func in ("symmetric", "asymmetric"):
+        np.testing.assert_array_equal(
+            cache.distances(keys[::2], profiles[::2], func, "pair_delete"),
+            getattr(distance_matrix, func)(profiles[::2], "pair_delete"),
+        )
+    assert calculated == [3]
+
+    # a changed profile invalidates its distances
+    profiles[2, 3] = 4
+    np.testing.assert_array_equal(
+        mismatch([*keys[:2], ("s3", "d")], profiles),
+        [[0, 1, 1], [1, 0, 2], [1, 2, 0]],
+    )
+    assert calculated == [3, 2]
+    index = json.loads((tmp_path / "index.json").read_text())
+    assert index["samples"]["s3"] == {"row": 2, "hash": "d"}
+
+    # the freed row of a changed profile is reused and its later pairs recalculated
+    profiles[1, 0] = 2
+    np.testing.assert_array_equal(
+        mismatch([("s1", "a"), ("s2", "e"), ("s3", "d")], profiles),
+        [[0, 2, 1], [2, 0, 1], [1, 1, 0]],
+    )
+    assert calculated == [3, 2, 2]
+    index = json.loads((tmp_path / "index.json").read_text())
+    assert index["n_rows"] == 3
+    assert index["samples"]["s2"] == {"row": 1, "hash": "e"}
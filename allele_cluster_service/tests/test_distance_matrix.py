@@ -0,0 +1,194 @@
+"""Test calculation of allele distance matrices."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from allele_cluster_service import ms_trees
+from allele_cluster_service.ms_trees import ClusterRun, distance_matrix
+
+
+@pytest.fixture()
+def allele_codes():
+    """Integer coded allele profiles with some missing loci."""
+    rng = np.random.default_rng(1)
+    codes = rng.integers(1, 4, size=(23, 40))
+    codes[rng.random(codes.shape) < 0.05] = 0
+    return codes
+
+
+def reference_distances(func, profiles, handle_missing):
+    """Distances computed row by row with numpy, as in GrapeTree."""
+    presences = profiles > 0
+    n_loci = float(profiles.shape[1])
+    distances = np.zeros([profiles.shape[0]] * 2, dtype=np.float32)
+    if func == "symmetric":
+        if handle_missing == "as_allele":
+            presences = np.ones(profiles.shape, dtype=int)
+        elif handle_missing == "complete_delete":
+            presences = np.tile(
+                np.sum(presences, 0) >= profiles.shape[0], [len(profiles), 1]
+            )
+        for i, (profile, presence) in enumerate(zip(profiles, presences)):
+            comparable = presences[:i] * presence
+            diffs = np.sum((profiles[:i] != profile) & comparable, axis=1)
+            if handle_missing == "pair_delete":
+                diffs = (diffs + 0.01) * n_loci / (np.sum(comparable, axis=1) + 0.01)
+            distances[:i, i] = diffs
+    elif func == "asymmetric":
+        for i, (profile, presence) in enumerate(zip(profiles, presences)):
+            diffs = np.sum((profiles != profile) & presence, axis=1)
+            if handle_missing != "absolute_distance":
+                diffs = diffs * n_loci / np.sum(presence)
+            distances[:, i] = diffs
+    elif func == "asymmetric_wgMLST":
+        pp = np.sum(presences, 0).astype(float)
+        pp = pp * (pp - 1) / (presences.shape[0] * (presences.shape[0] - 1))
+        for i, (profile, presence) in enumerate(zip(profiles, presences)):
+            diffs = np.sum(
+                ((profiles != profile) & (presences * presence))
+                + (presences < presence) * pp,
+                axis=1,
+            )
+            distances[:, i] = diffs * n_loci / np.sum(presence)
+    else:
+        for i, profile in enumerate(profiles):
+            zeros = np.zeros([profiles.shape[0], 1], dtype=int)
+            diffs = np.hstack([zeros, profiles - profile, zeros])
+            d1 = np.sum((diffs[:, 1:] != diffs[:, :-1]) & (diffs[:, 1:] != 0), 1)
+            d2 = np.sum(diffs != 0, 1) - d1
+            distances[:, i] = d1 + d2 * handle_missing
+    return distances
+
+
+def test_broken_worker_pool_is_replaced(allele_codes):
+    """Test that a run fails if a pool process dies and the next run gets a new pool."""
+    pool = ms_trees.get_pool()
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result()
+
+    with ClusterRun(n_proc=3) as run:
+        with pytest.raises(BrokenProcessPool):
+            distance_matrix.get_distance("symmetric", allele_codes, "pair_delete", run)
+        assert ms_trees.get_pool() is not pool
+        result = distance_matrix.get_distance(
+            "symmetric", allele_codes, "pair_delete", run
+        )
+    assert result.shape == (len(allele_codes), len(allele_codes))
+
+
+@pytest.mark.parametrize(
+    "func,handle_missing",
+    [
+        ("symmetric", "pair_delete"),
+        ("symmetric", "absolute_distance"),
+        ("symmetric", "as_allele"),
+        ("symmetric", "complete_delete"),
+        ("asymmetric", "pair_delete"),
+        ("asymmetric", "absolute_distance"),
+        ("asymmetric_wgMLST", "pair_delete"),
+        ("blockwise", 0.01),
+    ],
+)
+def test_distance_kernels_match_reference(allele_codes, func, handle_missing):
+    """Test that the compiled kernels give the same distances as the numpy version."""
+    codes = ms_trees.compact_codes(allele_codes)
+    result = getattr(distance_matrix, func)(codes, handle_missing)
+    expected = reference_distances(func, allele_codes, handle_missing)
+    if func == "symmetric":
+        result, expected = np.triu(result), np.triu(expected)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("func", ["symmetric", "asymmetric"])
+def test_shared_memory_workers_match_single_process(allele_codes, func):
+    """Test that distances computed by the worker pool are the same as in-process."""
+    with ClusterRun(n_proc=1) as run:
+        expected = distance_matrix.get_distance(func, allele_codes, "pair_delete", run)
+
+    with ClusterRun(n_proc=3) as run:
+        result = distance_matrix.get_distance(func, allele_codes, "pair_delete", run)
+        result = result.copy()
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_runs_share_the_worker_pool(allele_codes):
+    """Test that concurrent runs with different n_proc use the same worker pool."""
+    with ClusterRun(n_proc=1) as run:
+        expected = distance_matrix.get_distance(
+            "asymmetric", allele_codes, "pair_delete", run
+        )
+
+    def run_distance(n_proc):
+        with ClusterRun(n_proc=n_proc) as run:
+            return distance_matrix.get_distance(
+                "asymmetric", allele_codes, "pair_delete", run
+            ).copy()
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(run_distance, [2, 3, 4, 2]))
+    assert ms_trees.get_pool() is ms_trees.get_pool()
+    for result in results:
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize(
+    "func,handle_missing",
+    [
+        ("symmetric", "pair_delete"),
+        ("symmetric", "absolute_distance"),
+        ("symmetric", "as_allele"),
+        ("asymmetric", "pair_delete"),
+        ("asymmetric", "absolute_distance"),
+    ],
+)
+def test_distances_from_pair_counts(allele_codes, func, handle_missing):
+    """Test that distances derived from cached pair counts are identical."""
+    codes = ms_trees.compact_codes(allele_codes)
+    rows, cols = np.tril_indices(codes.shape[0], -1)
+    mismatch, comparable = distance_matrix.pair_counts(codes, rows, cols)
+
+    result = np.zeros([codes.shape[0]] * 2, dtype=np.float32)
+    n_present = np.sum(codes > 0, 1)
+    distance_matrix.fill_from_counts(
+        result, func, handle_missing, rows, cols, mismatch, comparable, n_present, 40
+    )
+    expected = getattr(distance_matrix, func)(codes, handle_missing)
+    if func == "symmetric":
+        result, expected = np.triu(result), np.triu(expected)
+    np.testing.assert_array_equal(result, expected)
+
+
+def reference_eburst(dist, n_str):
+    """eBurst weights from the full distance histogram of every row, as in GrapeTree."""
+    max_dist = np.max(dist).astype(int) + 1
+    counts = np.apply_along_axis(
+        np.bincount,
+        1,
+        np.hstack([dist.astype(int), np.full([dist.shape[0], 1], max_dist)]),
+    )
+    counts.T[0] += n_str
+    dist_order = np.concatenate([[0], np.arange(counts.shape[1] - 1, 0, -1)])
+    orders = np.lexsort(-counts.T[dist_order])
+    weights = np.zeros(dist.shape[0])
+    weights[orders] = np.arange(orders.size) / float(orders.size)
+    return weights
+
+
+@pytest.mark.parametrize("window", [1, 3, 64])
+def test_eburst_matches_full_histograms(monkeypatch, window):
+    """Test that ranking only tied profiles gives the order of the full histograms."""
+    monkeypatch.setattr(ms_trees, "EBURST_WINDOW", window)
+    rng = np.random.default_rng(5)
+    for n_profile, max_dist in [(1, 5), (30, 4), (50, 40), (40, 300)]:
+        dist = (rng.random([n_profile, n_profile]) * max_dist).astype(np.float32)
+        # rows with the same distances are only ordered by their sample count
+        dist[n_profile // 2 :] = dist[0]
+        n_str = rng.integers(1, 3, size=n_profile)
+
+        weights = distance_matrix.eBurst(dist, n_str)
+
+        assert np.array_equal(weights, reference_eburst(dist, n_str))
@@ -1,8 +1,24 @@
 """Test cluster samples using ms_tree."""
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+
+import numpy as np
+import pandas as pd
 import pytest
+from scipy.spatial.distance import squareform
 
-from allele_cluster_service.tasks import cluster
+from allele_cluster_service.ms_trees import (
+    StageTimer,
+    _recraft_kernel,
+    backend,
+    backend_from_matrix,
+    collapse_redundant,
+    prewarm,
+)
+from allele_cluster_service import tasks
+from allele_cluster_service.tasks import cluster, decode_profiles
 
 
 @pytest.mark.parametrize(
@@ -39,7 +55,10 @@ def test_cluster_task_w_nj_n_same_mlst_profile(mlst_profiles_all_same):
 @pytest.mark.parametrize(
     "cluster_method,expected",
     [
-        ("MSTree", "(DRR237264:2,DRR237262:1,DRR237260:1,DRR237263:1,DRR237261:0);"),
+        (
+            "MSTree",
+            "((DRR237262:1,DRR237260:1,DRR237263:1,DRR237261:0):2,DRR237264:0);",
+        ),
         ("MSTreeV2", "(DRR237264:2,DRR237262:1,DRR237260:1,DRR237263:1,DRR237261:0);"),
         (
             "NJ",
@@ -57,3 +76,196 @@ def test_cluster_task_different_mlst_profile(
     """Test task cluster using samples with different MLST profile."""
     newick = cluster(profile=mlst_profiles_different, method=cluster_method)
     assert newick == expected
+
+
+def test_concurrent_cluster_runs(mlst_profiles_different):
+    """Test that several trees can be built by the same process at the same time."""
+    methods = ["MSTree", "MSTreeV2", "MSTree", "MSTreeV2"]
+    with ThreadPoolExecutor(max_workers=len(methods)) as executor:
+        newicks = list(
+            executor.map(
+                lambda method: cluster(profile=mlst_profiles_different, method=method),
+                methods,
+            )
+        )
+    expected = [cluster(profile=mlst_profiles_different, method=m) for m in methods]
+    assert newicks == expected
+
+
+@pytest.mark.parametrize("cluster_method", ["MSTree", "MSTreeV2", "distance"])
+def test_integer_coded_profiles_give_same_tree(mlst_profiles_different, cluster_method):
+    """Test that integer coded profiles are clustered like their text profiles."""
+    profiles = pd.read_csv(StringIO(mlst_profiles_different), sep="\t")
+    alleles = profiles.drop(columns="sample").to_numpy()
+
+    newick = backend_from_matrix(
+        profiles["sample"].to_numpy(), alleles, method=cluster_method
+    )
+    assert newick == backend(profile=mlst_profiles_different, method=cluster_method)
+
+
+@pytest.mark.parametrize(
+    "cluster_method,stages",
+    [
+        ("MSTree", ["distance", "heuristic", "tree", "link"]),
+        ("MSTreeV2", ["distance", "heuristic", "tree", "recraft", "link"]),
+        ("RapidNJ", ["distance", "write_distance", "tree"]),
+    ],
+)
+def test_stages_are_timed(mlst_profiles_different, cluster_method, stages):
+    """Test that the time and memory of the stages of a run are recorded."""
+    timer = StageTimer()
+    backend(profile=mlst_profiles_different, method=cluster_method, stage_timer=timer)
+
+    assert [stage["stage"] for stage in timer.stages] == (
+        ["parse", "collapse"] + stages + ["output"]
+    )
+    assert all(stage["wall_time"] >= 0 for stage in timer.stages)
+    assert all(stage["max_rss"] > 0 for stage in timer.stages)
+
+
+def test_stage_memory_is_sampled_per_stage():
+    """Test that the peak memory of a stage does not include earlier stages."""
+    timer = StageTimer(interval=0.01)
+    with timer("allocate"):
+        block = np.ones(2**28, dtype=np.uint8)
+        time.sleep(0.05)
+        del block
+    with timer("idle"):
+        time.sleep(0.05)
+
+    allocate, idle = timer.stages
+    assert allocate["max_rss"] - idle["max_rss"] > 2**27
+
+
+def test_collapse_redundant_integer_profiles():
+    """Test that identical profiles are collapsed and fully missing are dropped."""
+    names = np.array(["a", "b", "c", "d", "e"])
+    alleles = np.array([[1, 2], [3, 0], [1, 2], [0, 0], [1, 2]])
+
+    names, profiles, embeded = collapse_redundant(names, alleles)
+
+    assert names.tolist() == ["b", "a"]
+    assert profiles.tolist() == [[3, 0], [1, 2]]
+    assert embeded == {"a": ["a", "c", "e"], "b": ["b"]}
+
+
+def test_backend_from_matrix_rejects_text_alleles():
+    """Test that the integer entry point only accepts integer allele codes."""
+    with pytest.raises(ValueError):
+        backend_from_matrix(["a", "b"], np.array([["1", "2"], ["1", "3"]]))
+
+
+def test_prewarm_compiles_kernels():
+    """Test that prewarming compiles the kernels used by the MSTree methods."""
+    prewarm(n_profile=8, n_proc=1)
+
+    assert _recraft_kernel.signatures
+
+
+def test_decode_binary_profiles(mlst_profiles_different):
+    """Test that profiles stored by the API decode to the integer allele matrix."""
+    profiles = pd.read_csv(StringIO(mlst_profiles_different), sep="\t")
+    alleles = profiles.drop(columns="sample")
+    buffer = BytesIO()
+    np.savez_compressed(
+        buffer,
+        names=profiles["sample"].to_numpy(dtype=str),
+        loci=alleles.columns.to_numpy(dtype=str),
+        alleles=alleles.to_numpy(),
+    )
+
+    names, loci, codes = decode_profiles(buffer.getvalue())
+
+    assert names.tolist() == profiles["sample"].tolist()
+    assert loci.tolist() == alleles.columns.tolist()
+    assert np.array_equal(codes, alleles.to_numpy())
+
+
+class FakeJob:
+    """Job with a dict as redis connection."""
+
+    def __init__(self):
+        self.connection = self
+        self.meta = {}
+        self.origin = "allele_cluster"
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        self.store[key] = value.encode() if isinstance(value, str) else value
+
+    def save_meta(self):
+        pass
+
+
+def test_cluster_results_are_cached(monkeypatch, mlst_profiles_different):
+    """Test that jobs with the same cluster key reuse the cached newick."""
+    job = FakeJob()
+    monkeypatch.setattr(tasks, "get_current_job", lambda: job)
+
+    newick = cluster(profile=mlst_profiles_different, cluster_key="abc")
+    stored = job.store[tasks.result_key("abc")]
+    job.store[tasks.result_key("abc")] = b"(cached:0);"
+    cached = cluster(profile=mlst_profiles_different, cluster_key="abc")
+
+    assert stored == newick.encode()
+    assert cached == "(cached:0);"
+
+
+def test_stages_are_stored_in_job_meta(monkeypatch, mlst_profiles_different):
+    """Test that the stages and dimensions of a cluster job are in its meta."""
+    job = FakeJob()
+    monkeypatch.setattr(tasks, "get_current_job", lambda: job)
+
+    cluster(profile=mlst_profiles_different, method="MSTree")
+
+    assert job.meta["dimensions"] == {"n_samples": 5, "n_profiles": 5, "n_loci": 7}
+    assert [stage["stage"] for stage in job.meta["stages"]][:2] == [
+        "parse",
+        "collapse",
+    ]
+    assert job.meta["resources"]["runtime"] > 0
+
+
+@pytest.mark.parametrize("queue", [None, "allele_cluster_large"])
+def test_long_jobs_are_forwarded_to_a_configured_queue(
+    monkeypatch, mlst_profiles_different, queue
+):
+    """Test that long jobs are only forwarded if the large job queue is set."""
+    job = FakeJob()
+    forwarded = []
+    monkeypatch.setattr(tasks, "get_current_job", lambda: job)
+    monkeypatch.setattr(tasks, "forward_job", lambda job, name: forwarded.append(name))
+    monkeypatch.setattr(tasks.config, "LARGE_JOB_RUNTIME", "0")
+    monkeypatch.setattr(tasks.config, "LARGE_JOB_QUEUE", queue)
+
+    newick = cluster(profile=mlst_profiles_different, method="MSTree")
+
+    if queue is None:
+        assert newick.endswith(";") and forwarded == []
+    else:
+        assert newick is None and forwarded == [queue]
+
+
+def test_binary_distance_matrix_matches_phylip(monkeypatch, mlst_profiles_different):
+    """Test that npz distance matrices are stored by content and match the text."""
+    job = FakeJob()
+    monkeypatch.setattr(tasks, "get_current_job", lambda: job)
+
+    key = cluster(
+        profile=mlst_profiles_different, method="distance", distance_format="npz"
+    )
+    phylip = cluster(profile=mlst_profiles_different, method="distance")
+
+    assert key == tasks.distance_key(job.store[key])
+    with np.load(BytesIO(job.store[key])) as data:
+        names, profile = data["names"], data["profile"]
+        distances = squareform(data["distances"])[profile][:, profile]
+    lines = phylip.split("\n")
+    assert int(lines[0]) == len(names)
+    for name, row, line in zip(names, distances, lines[1:]):
+        assert line.split()[0] == name
+        assert np.allclose([float(d) for d in line.split()[1:]], row, atol=1e-6)
@@ -0,0 +1,145 @@
+"""Test construction of minimum spanning trees from distance matrices."""
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from allele_cluster_service import ms_trees
+from allele_cluster_service.ms_trees import (
+    ClusterRun,
+    backend_from_matrix,
+    distance_matrix,
+    methods,
+)
+from allele_cluster_service.distance_cache import profile_hash
+from allele_cluster_service.tree_state import TreeState
+
+
+def reference_symmetric_tree(dist, weight):
+    """Minimum spanning tree built with networkx, as in GrapeTree."""
+    dist = np.round(dist, 0) + weight.reshape([weight.size, -1])
+    np.fill_diagonal(dist, 0.0)
+    dist[dist > dist.T] = dist.T[dist > dist.T]
+    tree = nx.minimum_spanning_tree(nx.Graph(dist))
+    return [[d[0], d[1], int(d[2]["weight"])] for d in tree.edges(data=True)]
+
+
+@pytest.mark.parametrize("heuristic", ["harmonic", "eBurst"])
+def test_symmetric_tree_matches_networkx(heuristic):
+    """Test that ties are broken as by networkx on matrices with many equal distances."""
+    rng = np.random.default_rng(3)
+    # profiles are unique after removing redundant samples
+    codes = np.unique(rng.integers(1, 3, size=(60, 8)), axis=0)
+    with ClusterRun(n_proc=1) as run:
+        dist = distance_matrix.get_distance("symmetric", codes, "pair_delete", run)
+    weight = getattr(distance_matrix, heuristic)(
+        dist, rng.integers(1, 3, size=len(codes))
+    )
+
+    tree = methods._symmetric(dist, weight, None)
+
+    assert tree == reference_symmetric_tree(dist, weight)
+
+
+def test_asymmetric_tree_is_minimum_arborescence():
+    """Test that the directed tree has the weight of the networkx arborescence."""
+    rng = np.random.default_rng(4)
+    codes = np.unique(rng.integers(1, 4, size=(40, 12)), axis=0)
+    with ClusterRun(n_proc=1) as run:
+        dist = distance_matrix.get_distance("asymmetric", codes, "pair_delete", run)
+        weight = distance_matrix.harmonic(dist, np.ones(len(codes)))
+        tree = methods._asymmetric(dist, weight, run)
+    weighted = np.round(dist, 0) + weight.reshape([weight.size, -1])
+    np.fill_diagonal(weighted, 0.0)
+    expected = nx.minimum_spanning_arborescence(nx.DiGraph(weighted)).size("weight")
+
+    # every node but the root is entered by one branch
+    assert len({t for _, t, _ in tree}) == len(tree) == len(codes) - 1
+    assert sum(weighted[s, t] for s, t, _ in tree) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("heuristic", ["harmonic", "eBurst"])
+def test_branch_recraft_matches_python(heuristic):
+    """Test that the compiled branch recrafting moves the branches as GrapeTree."""
+    rng = np.random.default_rng(5)
+    ancestors = rng.integers(1, 4, size=(4, 60))
+    codes = ancestors[rng.integers(0, 4, size=150)]
+    mutated = rng.random(codes.shape) < 0.1
+    codes[mutated] = rng.integers(4, 20, size=mutated.sum())
+    codes = np.unique(codes, axis=0)
+    with ClusterRun(n_proc=1) as run:
+        dist = distance_matrix.get_distance("asymmetric", codes, "pair_delete", run)
+        weight = getattr(distance_matrix, heuristic)(dist, np.ones(len(codes), int))
+        tree = methods._asymmetric(dist, weight, run)
+
+    recrafted = methods._branch_recraft([list(b) for b in tree], dist, weight, 60)
+    expected = methods._branch_recraft_python([list(b) for b in tree], dist, weight, 60)
+
+    assert [[s, t] for s, t, _ in recrafted] != [[s, t] for s, t, _ in tree]
+    assert recrafted == [[s, t, float(d)] for s, t, d in expected]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"method": "MSTreeV2"},
+        {"method": "MSTree", "matrix_type": "symmetric", "heuristic": "eBurst"},
+        {"method": "MSTree", "matrix_type": "symmetric", "branch_recraft": True},
+    ],
+)
+def test_out_of_core_trees_match_in_memory(monkeypatch, params):
+    """Test that trees built from distances kept on disk are the same."""
+    rng = np.random.default_rng(5)
+    codes = rng.integers(1, 4, size=(50, 30))
+    codes[rng.random(codes.shape) < 0.05] = 0
+    names = [f"sample{i}" for i in range(len(codes))]
+    expected = backend_from_matrix(names, codes, n_proc=1, out_of_core=False, **params)
+
+    # process the matrices in many small tiles
+    monkeypatch.setattr(ms_trees, "TILE_SIZE", 64)
+    tree = backend_from_matrix(names, codes, n_proc=1, out_of_core=True, **params)
+
+    assert tree == expected
+
+
+def test_inserted_profiles_give_minimum_spanning_tree():
+    """Test that inserting profiles gives the tree of the new nodes and ranks."""
+    rng = np.random.default_rng(6)
+    ancestors = rng.integers(1, 4, size=(4, 40))
+    codes = ancestors[rng.integers(0, 4, size=120)]
+    mutated = rng.random(codes.shape) < 0.1
+    codes[mutated] = rng.integers(4, 20, size=mutated.sum())
+    codes = rng.permutation(np.unique(codes, axis=0))
+    names = np.array([f"sample{i}" for i in range(len(codes))])
+    loci = [f"locus{i}" for i in range(codes.shape[1])]
+    state = TreeState()
+    params = {"method": "MSTree", "loci": loci, "tree_state": state, "n_proc": 1}
+    first = backend_from_matrix(names[:-4], codes[:-4], **params)
+
+    assert first == backend_from_matrix(names[:-4], codes[:-4], method="MSTree")
+    # rebuilt trees are kept as they are without new profiles
+    assert backend_from_matrix(names[:-4], codes[:-4], **params) == first
+
+    backend_from_matrix(names, codes, **params)
+    hashes = [profile_hash(np.array(loci), c.astype(str)) for c in codes]
+    row_of = {key: i for i, key in enumerate(hashes)}
+    order = [row_of[key] for key in state.keys]
+    with ClusterRun(n_proc=1) as run:
+        dist = distance_matrix.get_distance(
+            "symmetric", codes[order], "pair_delete", run
+        )
+    expected = methods._symmetric(dist, state.ranks / len(codes), None)
+
+    assert state.n_built == len(codes) - 4 and len(state) == len(codes)
+    assert [list(b) for b in zip(state.src, state.dst, state.distance)] == expected
+
+
+def test_tree_state_is_rebuilt_without_old_profiles():
+    """Test that trees are rebuilt if profiles were removed or many were added."""
+    state = TreeState(["a", "b", "c"], [2, 0, 1], [0, 1], [1, 2], [3, 1], n_built=3)
+    state = TreeState.from_bytes(state.to_bytes())
+
+    assert not state.needs_rebuild(["c", "b", "a"])
+    assert state.needs_rebuild(["a", "b", "d"])
+    assert state.needs_rebuild(["a", "b", "c", "d"])
+    assert state.ranks.tolist() == [2, 0, 1] and state.distance.tolist() == [3, 1]
@@ -0,0 +1,100 @@
+"""Test building and writing trees without ete3."""
+
+import numpy as np
+import pytest
+from ete3 import Tree
+
+from allele_cluster_service.tree import ArrayTree
+
+
+def reference_tree(branches, names):
+    """Tree built with ete3, as in GrapeTree."""
+    tree = Tree()
+    branches = sorted(branches, key=lambda x: x[2], reverse=True)
+    branch = []
+    in_use = {branches[0][0]: 1}
+    while len(branches):
+        remain = []
+        for br in branches:
+            if br[0] in in_use:
+                branch.append(br)
+                in_use[br[1]] = 1
+            elif br[1] in in_use:
+                branch.append([br[1], br[0], br[2]])
+                in_use[br[0]] = 1
+            else:
+                remain.append(br)
+        branches = remain
+    tree.name = branch[0][0]
+    nodes = {tree.name: tree}
+    for src, tgt, dif in branch:
+        nodes[tgt] = nodes[src].add_child(name=tgt, dist=dif)
+    for node in tree.traverse("postorder"):
+        if not node.is_leaf():
+            name = node.name
+            node.name = ""
+            node.add_child(name=names[name], dist=0.0)
+        else:
+            node.name = names[node.name]
+    return tree
+
+
+def random_branches(rng, n_nodes):
+    """Random spanning tree with many equal and short branches."""
+    order = rng.permutation(n_nodes)
+    return [
+        [
+            int(order[rng.integers(0, i)]),
+            int(order[i]),
+            float(rng.choice([0, 0.05, 1, 2, 5])),
+        ]
+        for i in range(1, n_nodes)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_tree_from_branches_matches_ete3(seed):
+    """Test that trees are written as the ete3 trees they replace."""
+    rng = np.random.default_rng(seed)
+    branches = random_branches(rng, 50)
+    names = [f"s:{i}" for i in range(50)]
+    reference = reference_tree(branches, names)
+    for node in reference.iter_descendants("postorder"):
+        if node.dist < 0.1 and node.dist > 0:
+            for s in node.get_sisters():
+                s.dist += node.dist
+            node.dist = 0
+    tree = ArrayTree.from_branches(branches, names)
+    tree.collapse_short_branches()
+
+    assert tree.write() == reference.write(format=1)
+
+
+def test_collapse_short_branches():
+    """Test that short branches are moved to their sisters in trees with long ones."""
+    tree = ArrayTree()
+    inner = tree.add_child(0, dist=5)
+    tree.add_child(inner, "a", 0.05)
+    tree.add_child(inner, "b", 1)
+    tree.add_child(0, "c", 0.05)
+
+    tree.collapse_short_branches()
+
+    assert tree.write() == "((a:0,b:1.05):5.05,c:0);"
+
+
+def test_expand_leaves_with_identical_profiles():
+    """Test that samples with the same profile are attached to their leaf."""
+    tree = ArrayTree.from_branches([[0, 1, 2]], ["a", "b"])
+
+    tree.expand_leaves({"a": ["a"], "b": ["b", "c"]})
+
+    assert tree.write() == "((b:0,c:0):2,a:0);"
+
+
+def test_write_ete3_tree():
+    """Test that converted ete3 trees are written unchanged."""
+    newick = "((a:1,b:0.333333)x:2,(c:0,d:4.5):1,e:7);"
+    tree = ArrayTree.from_ete3(Tree(newick, format=1))
+
+    assert tree.write() == newick
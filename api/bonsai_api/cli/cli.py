@@ -27,6 +27,7 @@ from .cli_tasks import (
     run_get_samples,
     run_lims_export,
     run_migrate_database,
+    run_sync_cluster_addresses,
     run_update_tag,
 )
 from .utils import EmailType, run_async
@@ -275,6 +276,20 @@ def check_paths(
     click.secho("Finished validating file paths", fg="green")
 
 
+@cli.command()
+@click.option(
+    "-t",
+    "--timeout",
+    type=int,
+    default=600,
+    help="Seconds to wait for the addresses.",
+)
+def sync_cluster_addresses(timeout: int):
+    """Store the cgMLST cluster addresses assigned on ingestion on the samples."""
+    n_updated = run_async(run_sync_cluster_addresses(timeout))
+    click.secho(f"Updated the cluster address of {n_updated} samples", fg="green")
+
+
 @cli.command()
 def get_event():
     """Get a events"""
@@ -24,7 +24,9 @@ from bonsai_api.models.sample import (
     MultipleSampleRecordsResponseModel,
     SampleRecordDb,
 )
+from bonsai_api.models.enums import TypingMethod
 from bonsai_api.models.user import UserContext, UserInputCreate, UserOutputDatabase
+from bonsai_api.services.analysis_service import sync_cluster_addresses
 from bonsai_api.services.group_service import create_group_service
 
 LOG = logging.getLogger(__name__)
@@ -107,6 +109,14 @@ async def run_update_tag(sample: SampleRecordDb) -> bool:
         raise NotImplementedError("Tag update function not implemented yet")
 
 
+async def run_sync_cluster_addresses(timeout: int) -> int:
+    """Store the cgMLST cluster addresses of the allele cluster service on samples."""
+    async with get_db_connection() as db:
+        return await sync_cluster_addresses(
+            db, typing_method=TypingMethod.CGMLST, timeout=timeout
+        )
+
+
 async def run_migrate_database(backup_path: Path | None = None) -> None:
     """Helper for running migration functions."""
     async with get_db_connection() as db:
@@ -165,6 +165,11 @@ MANIFEST = Manifest(
             label="Nr novel cgMLST alleles",
             path="$chewbbaca.n_novel",
         ),
+        ColumnFull(
+            id="cgmlst_cluster_address",
+            label="cgMLST cluster address",
+            path="$cluster_address.cgmlst.address",
+        ),
         ColumnFull(
             id="emm_type", requires=["emm"], label="EMM Type", path="$emm.emmtype"
         ),
@@ -23,7 +23,7 @@ from bson.objectid import ObjectId
 from fastapi.encoders import jsonable_encoder
 from prp.parse.models.base import PhenotypeInfo
 from prp.parse.models.enums import AnnotationType, ElementType
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from pymongo.client_session import ClientSession
 from pymongo.results import UpdateResult
 
@@ -466,6 +466,36 @@ async def add_sourmash_sketch(
     )
 
 
+async def update_cluster_addresses(
+    db: Database, *, typing_method: str, addresses: dict[str, dict]
+) -> int:
+    """Set the cluster addresses of a typing method on samples.
+
+    Only the fields given for a sample are set, which keeps the merges of samples
+    whose address changed when their cluster was merged.
+
+    :return: the number of updated samples
+    """
+    if not addresses:
+        return 0
+    resp = await db.sample_collection.bulk_write(
+        [
+            UpdateOne(
+                {"sample_id": sample_id},
+                {
+                    "$set": {
+                        f"cluster_address.{typing_method}.{field}": value
+                        for field, value in address.items()
+                    }
+                },
+            )
+            for sample_id, address in addresses.items()
+        ],
+        ordered=False,
+    )
+    return resp.modified_count
+
+
 async def add_reference_genome_to_sample(
     db: Database, *, sample_id: str, reference_genome_id: str, session: ClientSession
 ) -> UpdateResult:
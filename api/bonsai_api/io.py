@@ -8,7 +8,9 @@ import re
 from enum import StrEnum
 from io import StringIO
 from pathlib import Path
+from typing import Iterator, Literal
 
+import numpy as np
 import pandas as pd
 from fastapi.responses import Response
 
@@ -168,3 +170,43 @@ def to_relative_resource(resource: str | None, base_dir: Path) -> str | None:
     if not resource:
         return None
     return str(resolve_resource_path(resource, base_dir).relative_to(base_dir))
+
+
+def format_distance_matrix(
+    names: np.ndarray,
+    profile: np.ndarray,
+    distances: np.ndarray,
+    fmt: Literal["phylip", "tsv"] = "phylip",
+) -> Iterator[str]:
+    """Format a condensed distance matrix one row at a time.
+
+    :param names: sample names
+    :param profile: the distinct profile of each sample
+    :param distances: distances between the distinct profiles, the upper triangle
+        of the matrix row by row
+    :param fmt: PHYLIP, as written by the allele cluster service, or TSV
+    :return: lines of the distance matrix
+    """
+    n_profile = int(profile.max()) + 1 if profile.size else 0
+    sep = "\t" if fmt == "tsv" else " "
+    if fmt == "tsv":
+        yield "\t" + "\t".join(names) + "\n"
+    else:
+        yield f"    {len(names)}\n"
+    last, values = None, ""
+    for name, row in zip(names, profile):
+        # samples with the same profile have the same distances
+        if row != last:
+            dist = np.zeros(n_profile, dtype=distances.dtype)
+            above = np.arange(row)
+            dist[:row] = distances[
+                above * n_profile - above * (above + 1) // 2 + row - above - 1
+            ]
+            start = row * n_profile - row * (row + 1) // 2
+            dist[row + 1 :] = distances[start : start + n_profile - row - 1]
+            values = sep.join(f"{d:.6f}" for d in dist[profile].tolist())
+            last = row
+        if fmt == "tsv":
+            yield f"{name}\t{values}\n"
+        else:
+            yield f"{name!s:10} {values}\n"
@@ -79,6 +79,25 @@ class SampleBase(TimestampsMixin, ForbidExtraModelMixin):  # pylint: disable=too
     ska_index: str | None = Field(None, description="Ska index path")
 
 
+class ClusterMerge(BaseModel):  # pylint: disable=too-few-public-methods
+    """Clusters at a threshold merged by a new sample."""
+
+    threshold: int
+    clusters: list[int]
+    cluster: int = Field(..., description="Cluster the clusters were merged into.")
+
+
+class ClusterAddress(BaseModel):  # pylint: disable=too-few-public-methods
+    """Single linkage clusters of a sample at fixed allele distance thresholds."""
+
+    thresholds: list[int]
+    clusters: list[int]
+    address: str = Field(..., description="Clusters from the largest threshold.")
+    merges: list[ClusterMerge] = Field(
+        default_factory=list, description="Merges caused by adding the sample."
+    )
+
+
 class InputSearchSimilar(BaseModel):  # pylint: disable=too-few-public-methods
     """Input parameters for finding similar samples."""
 
@@ -298,6 +317,9 @@ class SampleRecordDb(SampleBase):
     pipeline_runs: list[PipelineRun] = Field(default_factory=list)
     last_pipeline_run_id: str | None = None
 
+    # Cluster addresses per typing method
+    cluster_address: dict[str, ClusterAddress] = Field(default_factory=dict)
+
     # Analysis results
     qc_result: list[AnalysisViewEntryDb] = Field(default_factory=list)
     species_prediction: list[AnalysisViewEntryDb] = Field(default_factory=list)
@@ -338,6 +360,9 @@ class SampleRecordOut(SampleBase):
     sequencing: SequencingInfo | None = None
     pipeline: PipelineRun | None = None
     
+    # Cluster addresses per typing method
+    cluster_address: dict[str, ClusterAddress] = Field(default_factory=dict)
+
     # Analysis results
     qc_result: list[AnalysisViewEntryOut] = Field(default_factory=list)
     species_prediction: list[AnalysisViewEntryOut] = Field(default_factory=list)
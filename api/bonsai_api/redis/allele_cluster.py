@@ -1,41 +1,307 @@
 """Functions relating to scheduling allele clustering jobs."""
 
+import hashlib
 import logging
+from io import BytesIO
 from typing import List
+from uuid import uuid4
 
+import numpy as np
 import pandas as pd
+from redis.exceptions import WatchError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 
-from . import ClusterMethod, SubmittedJob
-from .queue import redis
+from bonsai_api.models.enums import TypingMethod
+
+from . import ClusterMethod, MsTreeMethods, SubmittedJob
+from .queue import JobStatusCodes, redis
 
 LOG = logging.getLogger(__name__)
 
+PROFILE_KEY_PREFIX = "allele_cluster:profile"
+PROFILE_TTL = 60 * 60 * 24  # keep profiles long enough for queued jobs to start
+JOB_KEY_PREFIX = "allele_cluster:job"
+JOB_CLAIM_TTL = 60  # seconds a request has to enqueue the job it claimed a key for
+DISTANCE_KEY_PREFIX = "allele_cluster:distance"
+RESULT_TTL = 60 * 60 * 24  # how long trees are kept for identical requests
+HANDLE_MISSING = "pair_delete"
+
+
+def store_allele_profiles(
+    sample_ids: List[str], allele_profile: List[dict], keep_missing_loci: bool = False
+) -> str:
+    """Store allele profiles as an integer coded npz blob in redis.
+
+    Missing alleles are coded as 0. Samples and loci are sorted and the blob is
+    stored under the hash of its content, which gives the same key to the same
+    samples in any order. Loci missing in all samples are dropped unless
+    keep_missing_loci is set.
+
+    :return: redis key of the stored profiles
+    :rtype: str
+    """
+    alleles = pd.DataFrame(allele_profile, index=sample_ids)
+    if not keep_missing_loci:
+        alleles = alleles.dropna(axis=1, how="all")  # remove cols with all nulls
+    alleles = (
+        alleles.fillna(0)  # code nulls as missing alleles
+        .astype(np.int64)
+        .sort_index(axis=0)
+        .sort_index(axis=1)
+    )
+    names = alleles.index.to_numpy(dtype=str)
+    loci = alleles.columns.to_numpy(dtype=str)
+    codes = np.ascontiguousarray(alleles.to_numpy())
+    content = hashlib.sha256()
+    content.update("\t".join(names).encode())
+    content.update(b"\n")
+    content.update("\t".join(loci).encode())
+    content.update(b"\n")
+    content.update(codes.tobytes())
+    key = f"{PROFILE_KEY_PREFIX}:{content.hexdigest()}"
+    buffer = BytesIO()
+    np.savez_compressed(buffer, names=names, loci=loci, alleles=codes)
+    redis.connection.set(key, buffer.getvalue(), ex=PROFILE_TTL)
+    return key
+
+
+def cluster_hash(
+    profile_key: str, cluster_method: ClusterMethod, tree_key: str | None = None
+) -> str:
+    """Get the hash identifying the tree of the stored profiles.
+
+    The tree key is included as jobs of a group keep the tree of the group.
+    """
+    content = "\t".join(
+        [profile_key, cluster_method.value, HANDLE_MISSING, tree_key or ""]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def tree_hash(
+    group_id: str, cluster_method: ClusterMethod, typing_method: TypingMethod
+) -> str:
+    """Get the hash identifying the spanning tree kept for a group of samples."""
+    content = "\t".join(
+        [group_id, typing_method.value, cluster_method.value, HANDLE_MISSING]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_failed_job(job_id: str) -> bool:
+    """Check if a job failed, or was stopped or canceled.
+
+    A job that does not exist is being enqueued by the request that claimed it.
+    """
+    try:
+        job = Job.fetch(job_id, connection=redis.connection)
+    except NoSuchJobError:
+        return False
+    return job.get_status() in (
+        JobStatusCodes.FAILED,
+        JobStatusCodes.STOPPED,
+        JobStatusCodes.CANCELED,
+    )
+
+
+def claim_cluster_job(cluster_key: str, job_id: str) -> str:
+    """Claim a cluster hash for a job unless another job with the hash is active.
+
+    The hash is claimed with SET NX before the job is enqueued, so only one of
+    concurrent requests for the same tree enqueues a job. A hash held by a failed
+    job is taken over in a transaction. The claim expires after JOB_CLAIM_TTL
+    seconds unless it is extended once the job is enqueued.
+
+    :return: the id of the job with the cluster hash, job_id if it was claimed
+    """
+    job_key = f"{JOB_KEY_PREFIX}:{cluster_key}"
+    if redis.connection.set(job_key, job_id, nx=True, ex=JOB_CLAIM_TTL):
+        return job_id
+    with redis.connection.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(job_key)
+                held = pipe.get(job_key)
+                if held is not None and not is_failed_job(held.decode()):
+                    pipe.unwatch()
+                    return held.decode()
+                pipe.multi()
+                pipe.set(job_key, job_id, ex=JOB_CLAIM_TTL)
+                pipe.execute()
+                return job_id
+            except WatchError:
+                # the hash was claimed by another request, check its job
+                continue
+
 
 def schedule_cluster_samples(
-    profiles: List[str], cluster_method: ClusterMethod
+    profiles: List[str],
+    cluster_method: ClusterMethod,
+    typing_method: TypingMethod,
+    group_id: str | None = None,
 ) -> SubmittedJob:
     """Schedule clustering on the provided allele profile.
 
+    The typing method lets the worker reuse distances from previous jobs. Requests
+    for the same samples, method and group get the job of the first request while
+    it is running, and its cached result for RESULT_TTL seconds after. Trees of a
+    group are kept by the worker to insert new samples into. Distance matrices are
+    stored by the worker as npz, the result of the job is their key.
+
     :return: Information of submitted job
     :rtype: SubmittedJob
     """
     task = "allele_cluster_service.tasks.cluster"
-    # convert the allele profile object to two arrays, one with names and another with
-    # a tsv representation of the profile
     sample_ids = []
     allele_profile = []
     for profile in profiles:
         sample_ids.append(profile.sample_id)
         allele_profile.append(profile.allele_profile())
-    # convert to pandas dataframe
-    profile_tsv = (
-        pd.DataFrame(allele_profile, index=sample_ids)
-        .dropna(axis=1, how="all")  # remove cols with all nulls
-        .fillna("-")  # replace nulls with MStree null char, "-"
-        .to_csv(sep="\t")  # convert to tsv string
+    # the job only carry the key to the profiles to keep large profiles out of the
+    # job payload
+    profile_key = store_allele_profiles(sample_ids, allele_profile)
+    tree_key = (
+        None if group_id is None else tree_hash(group_id, cluster_method, typing_method)
+    )
+    cluster_key = cluster_hash(profile_key, cluster_method, tree_key)
+    job_id = str(uuid4())
+    claimed_by = claim_cluster_job(cluster_key, job_id)
+    if claimed_by != job_id:
+        LOG.debug("Using job %s with the same profiles", claimed_by)
+        return SubmittedJob(id=claimed_by, task=task)
+    job = redis.allele.enqueue(
+        task,
+        profile_key=profile_key,
+        method=cluster_method.value,
+        typing_method=typing_method.value,
+        handle_missing=HANDLE_MISSING,
+        cluster_key=cluster_key,
+        distance_format=(
+            "npz" if cluster_method == MsTreeMethods.DISTANCE else "phylip"
+        ),
+        tree_key=tree_key,
+        job_id=job_id,
+        job_timeout="30m",
+        result_ttl=RESULT_TTL,
+    )
+    redis.connection.expire(f"{JOB_KEY_PREFIX}:{cluster_key}", RESULT_TTL)
+    LOG.debug("Submitting job, %s to %s", task, job.worker_name)
+    return SubmittedJob(id=job.id, task=task)
+
+
+def load_distance_matrix(
+    distance_key: str,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+    """Load a distance matrix stored by an allele clustering job.
+
+    :return: the sample names, the distinct profile of each sample and the condensed
+        distances between the profiles, or None if the matrix is not stored
+    """
+    if not distance_key.startswith(f"{DISTANCE_KEY_PREFIX}:"):
+        raise ValueError(f"{distance_key} is not the key of a distance matrix")
+    blob = redis.connection.get(distance_key)
+    if blob is None:
+        return None
+    with np.load(BytesIO(blob), allow_pickle=False) as data:
+        return data["names"], data["profile"], data["distances"]
+
+
+def schedule_add_to_allele_index(
+    profiles: List[str], typing_method: TypingMethod
+) -> SubmittedJob:
+    """Schedule adding allele profiles to the allele index of the typing method.
+
+    :return: Information of submitted job
+    :rtype: SubmittedJob
+    """
+    task = "allele_cluster_service.tasks.add_to_index"
+    # the index is given all loci of the scheme, also those the samples miss
+    profile_key = store_allele_profiles(
+        [profile.sample_id for profile in profiles],
+        [profile.allele_profile() for profile in profiles],
+        keep_missing_loci=True,
+    )
+    job = redis.allele.enqueue(
+        task, profile_key=profile_key, typing_method=typing_method.value
+    )
+    LOG.debug("Submitting job, %s to %s", task, job.worker_name)
+    return SubmittedJob(id=job.id, task=task)
+
+
+def schedule_assign_cluster_address(
+    sample_id: str, typing_method: TypingMethod, depends_on: List[str] | None = None
+) -> SubmittedJob:
+    """Schedule assigning a sample in the allele index to threshold clusters.
+
+    :return: Information of submitted job
+    :rtype: SubmittedJob
+    """
+    task = "allele_cluster_service.tasks.assign_cluster_address"
+    job = redis.allele.enqueue(
+        task,
+        sample_id=sample_id,
+        typing_method=typing_method.value,
+        depends_on=depends_on,
+    )
+    LOG.debug("Submitting job, %s to %s", task, job.worker_name)
+    return SubmittedJob(id=job.id, task=task)
+
+
+def schedule_lookup_cluster_addresses(
+    typing_method: TypingMethod, sample_ids: List[str] | None = None
+) -> SubmittedJob:
+    """Schedule getting the cluster addresses of samples, or of all samples.
+
+    :return: Information of submitted job
+    :rtype: SubmittedJob
+    """
+    task = "allele_cluster_service.tasks.lookup_cluster_addresses"
+    job = redis.allele.enqueue(
+        task, typing_method=typing_method.value, sample_ids=sample_ids
+    )
+    LOG.debug("Submitting job, %s to %s", task, job.worker_name)
+    return SubmittedJob(id=job.id, task=task)
+
+
+def schedule_remove_from_allele_index(
+    sample_ids: List[str], typing_method: TypingMethod
+) -> SubmittedJob:
+    """Schedule removing samples from the allele index of the typing method.
+
+    :return: Information of submitted job
+    :rtype: SubmittedJob
+    """
+    task = "allele_cluster_service.tasks.remove_from_index"
+    job = redis.allele.enqueue(
+        task, sample_ids=sample_ids, typing_method=typing_method.value
     )
+    LOG.debug("Submitting job, %s to %s", task, job.worker_name)
+    return SubmittedJob(id=job.id, task=task)
+
+
+def schedule_find_allele_neighbours(
+    sample_id: str,
+    typing_method: TypingMethod,
+    max_distance: int,
+    limit: int | None = None,
+) -> SubmittedJob:
+    """Schedule a search for samples within max_distance allele differences.
+
+    The search is put first in the queue as it is answered from the allele index
+    and should not wait for clustering jobs.
+
+    :return: Information of submitted job
+    :rtype: SubmittedJob
+    """
+    task = "allele_cluster_service.tasks.find_neighbours"
     job = redis.allele.enqueue(
-        task, profile=profile_tsv, method=cluster_method.value, job_timeout="30m"
+        task,
+        sample_id=sample_id,
+        typing_method=typing_method.value,
+        max_distance=max_distance,
+        limit=limit,
+        at_front=True,
     )
     LOG.debug("Submitting job, %s to %s", task, job.worker_name)
     return SubmittedJob(id=job.id, task=task)
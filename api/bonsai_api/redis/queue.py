@@ -45,6 +45,15 @@ class JobStatusCodes(str, Enum):
     FAILED = "failed"
 
 
+class JobStage(BaseModel):  # pylint: disable=too-few-public-methods
+    """Wall time, CPU time in seconds and peak memory in bytes of a job stage."""
+
+    stage: str
+    wall_time: float
+    cpu_time: float
+    max_rss: int
+
+
 class JobStatus(BaseModel):  # pylint: disable=too-few-public-methods
     """Container for basic job information."""
 
@@ -56,11 +65,18 @@ class JobStatus(BaseModel):  # pylint: disable=too-few-public-methods
     submitted_at: datetime
     started_at: datetime | None
     finished_at: datetime | None
+    # reported by allele clustering jobs
+    stages: list[JobStage] = []
+    dimensions: dict[str, int] = {}
+    resources: dict[str, Any] | None = None
 
 
 def check_redis_job_status(job_id: str, raise_on_exception: bool = False) -> JobStatus:
     """Check status of a job."""
     job = Job.fetch(job_id, connection=redis.connection)
+    # workers can forward large jobs to another queue
+    while job.meta.get("forwarded_to"):
+        job = Job.fetch(job.meta["forwarded_to"], connection=redis.connection)
     job_info = JobStatus(
         status=job.get_status(refresh=True),
         queue=job.origin,
@@ -69,6 +85,9 @@ def check_redis_job_status(job_id: str, raise_on_exception: bool = False) -> Job
         submitted_at=job.enqueued_at,
         started_at=job.started_at,
         finished_at=job.ended_at,
+        stages=job.meta.get("stages", []),
+        dimensions=job.meta.get("dimensions", {}),
+        resources=job.meta.get("resources"),
     )
     # LOG stacktraces for failed jobs
     if job_info.status == JobStatusCodes.FAILED:
@@ -2,7 +2,7 @@
 
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Literal
 
 from bonsai_api.crud.cluster import (
     TypingProfileOutput,
@@ -12,23 +12,32 @@ from bonsai_api.crud.cluster import (
 )
 from bonsai_api.db import Database
 from bonsai_api.dependencies import get_database
+from bonsai_api.io import format_distance_matrix
 from bonsai_api.models.base import RWModel
 from bonsai_api.models.enums import DistanceMethod, TypingMethod
 from bonsai_api.redis import ClusterMethod, MsTreeMethods, SubmittedJob
 from bonsai_api.redis.allele_cluster import (
     schedule_cluster_samples as schedule_allele_cluster_samples,
 )
+from bonsai_api.redis.allele_cluster import (
+    DISTANCE_KEY_PREFIX,
+    load_distance_matrix,
+    schedule_find_allele_neighbours,
+)
 from bonsai_api.redis.minhash import (
     schedule_add_genome_signature_to_index,
 )
 from bonsai_api.redis.minhash import (
     schedule_cluster_samples as schedule_minhash_cluster_samples,
 )
+from bonsai_api.redis.queue import JobStatusCodes, check_redis_job_status
 from bonsai_api.redis.ska import (
     schedule_cluster_samples as schedule_ska_cluster_samples,
 )
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
 from pydantic import ConfigDict, Field
+from rq.exceptions import NoSuchJobError
 
 from .tags import RouterTags
 
@@ -49,6 +58,7 @@ class ClusterInput(RWModel):  # pylint: disable=too-few-public-methods
     sample_ids: list[str] = Field(..., min_length=2, alias="sampleIds")
     distance: DistanceMethod | None = None
     method: ClusterMethod | MsTreeMethods
+    group_id: str | None = Field(None, alias="groupId")
 
     model_config = ConfigDict(use_enum_values=False)
 
@@ -88,10 +98,126 @@ async def cluster_samples(
         profiles: TypingProfileOutput = await get_typing_profiles(
             db, cluster_input.sample_ids, typing_method.value
         )
-        job = schedule_allele_cluster_samples(profiles, cluster_input.method)
+        job = schedule_allele_cluster_samples(
+            profiles,
+            cluster_input.method,
+            typing_method,
+            group_id=cluster_input.group_id,
+        )
+    return job
+
+
+class NeighboursInput(RWModel):  # pylint: disable=too-few-public-methods
+    """Input data model for the allele neighbours entrypoint.
+
+    :param RWModel: Generic read write base model
+    :type RWModel: Generic basemodel for read/ write
+    """
+
+    sample_id: str = Field(..., alias="sampleId")
+    max_distance: int = Field(..., ge=0, alias="maxDistance")
+    limit: int | None = Field(None, gt=0)
+
+
+@router.post(
+    "/cluster/{typing_method}/neighbours",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=SubmittedJob,
+    tags=[RouterTags.CLUSTER],
+)
+async def find_allele_neighbours(
+    typing_method: TypingMethod, neighbours_input: NeighboursInput
+) -> SubmittedJob:
+    """Find the samples within a number of allele differences of a sample.
+
+    The samples are looked up in the allele index of the typing method, which is
+    updated as typing results are added, instead of clustering the samples.
+
+    :param typing_method: allele typing method
+    :type typing_method: TypingMethod
+    :param neighbours_input: sample and maximum number of allele differences
+    :type neighbours_input: NeighboursInput
+    :raises HTTPException: Raised if the typing method is not allele based
+    :return: Information on scheduled job
+    :rtype: SubmittedJob
+    """
+    if typing_method not in (TypingMethod.MLST, TypingMethod.CGMLST):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{typing_method} is not an allele typing method",
+        )
+    try:
+        job = schedule_find_allele_neighbours(
+            neighbours_input.sample_id,
+            typing_method,
+            max_distance=neighbours_input.max_distance,
+            limit=neighbours_input.limit,
+        )
+    except ConnectionError as error:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)
+        ) from error
     return job
 
 
+@router.get(
+    "/cluster/distances/{job_id}",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {"text/plain": {}, "text/tab-separated-values": {}}},
+        404: {"description": "Job or distance matrix not found"},
+        409: {"description": "Job has not finished"},
+    },
+    tags=[RouterTags.CLUSTER],
+)
+def get_distance_matrix(
+    job_id: str, fmt: Literal["phylip", "tsv"] = "phylip"
+) -> StreamingResponse:
+    """Stream the distance matrix of an allele clustering job.
+
+    Jobs with the distance method store the matrix in binary, it is formatted as
+    PHYLIP or TSV while it is sent.
+
+    :param job_id: Redis job id
+    :type job_id: str
+    :param fmt: output format
+    :type fmt: Literal["phylip", "tsv"]
+    :raises HTTPException: Raised if the job has not finished or has no matrix
+    :return: the distance matrix
+    :rtype: StreamingResponse
+    """
+    try:
+        job = check_redis_job_status(job_id)
+    except NoSuchJobError as error:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found"
+        ) from error
+    if job.status != JobStatusCodes.FINISHED:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job {job_id} is {job.status.value}",
+        )
+    if not isinstance(job.result, str) or not job.result.startswith(
+        DISTANCE_KEY_PREFIX
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} did not calculate a distance matrix",
+        )
+    matrix = load_distance_matrix(job.result)
+    if matrix is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The distance matrix of job {job_id} has expired",
+        )
+    media_type = "text/tab-separated-values" if fmt == "tsv" else "text/plain"
+    headers = {"Content-Disposition": f'attachment; filename="{job_id}.{fmt}"'}
+    return StreamingResponse(
+        format_distance_matrix(*matrix, fmt=fmt), media_type=media_type, headers=headers
+    )
+
+
 class IndexInput(RWModel):  # pylint: disable=too-few-public-methods
     """Input data model for index entrypoint.
 
@@ -1,10 +1,12 @@
 """Services for ingesting analysis output files."""
 
+import asyncio
 import logging
 import io
 
 from fastapi import UploadFile
 from pydantic import ValidationError
+from redis.exceptions import RedisError
 from bonsai_api.crud.utils import managed_transaction
 from bonsai_api.models.analysis import (
     AnalysisResult,
@@ -16,8 +18,22 @@ from bonsai_api.models.sample import AnalysisViewEntryDb
 from api_client.audit_log.models import Subject, SourceType
 from api_client.audit_log import AuditLogClient, EventCreate
 from bonsai_api.crud.analysis import analysis_exists, create_analysis, get_analysis
-from bonsai_api.crud.sample import sample_exists, upsert_analysis_results
+from bonsai_api.crud.cluster import CLUSTER_TYPING_SPECS, get_typing_profiles
+from bonsai_api.crud.sample import (
+    sample_exists,
+    update_cluster_addresses,
+    upsert_analysis_results,
+)
 from bonsai_api.dependencies import ApiRequestContext
+from bonsai_api.models.enums import TypingMethod
+from bonsai_api.redis.allele_cluster import (
+    schedule_add_to_allele_index,
+    schedule_assign_cluster_address,
+    schedule_lookup_cluster_addresses,
+)
+from bonsai_api.redis.models import SubmittedJob
+from bonsai_api.redis.queue import JobFailedError
+from bonsai_api.redis.utils import wait_for_job
 from bonsai_api.exceptions import (
     AnalysisExistsError,
     AuditLogError,
@@ -32,6 +48,11 @@ from prp.parse import run_parser
 
 LOG = logging.getLogger(__name__)
 
+# seconds to wait for the cluster address of an ingested sample
+CLUSTER_ADDRESS_TIMEOUT = 60 * 30
+# running background tasks, which would otherwise be garbage collected
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
 TYPING_RESULT = "typing_result"
 ELEMENT_TYPE_RESULT = "element_type_result"
 QC_RESULT = "qc_result"
@@ -104,6 +125,80 @@ def to_result_storage(
     )
 
 
+async def store_cluster_addresses(
+    db, *, typing_method: TypingMethod, job: SubmittedJob
+) -> None:
+    """Wait for a cluster address job and store the addresses on the samples."""
+    try:
+        job_status = await wait_for_job(job, timeout=CLUSTER_ADDRESS_TIMEOUT, delay=2)
+    except (asyncio.TimeoutError, JobFailedError, RedisError) as exc:
+        LOG.warning(
+            "Could not get the cluster addresses of job %s, they are stored by the "
+            "next sync-cluster-addresses: %s",
+            job.id,
+            exc,
+        )
+        return
+    n_updated = await update_cluster_addresses(
+        db, typing_method=typing_method.value, addresses=job_status.result
+    )
+    LOG.info("Updated the %s cluster address of %d samples", typing_method, n_updated)
+
+
+async def sync_cluster_addresses(
+    db, *, typing_method: TypingMethod, timeout: int = CLUSTER_ADDRESS_TIMEOUT
+) -> int:
+    """Store the cluster addresses kept by the allele cluster service on the samples.
+
+    Reconciles the samples with addresses that were not stored after ingestion, for
+    instance if the API was restarted before the address job finished.
+
+    :raises asyncio.TimeoutError: if the addresses were not returned within timeout
+    :return: the number of updated samples
+    """
+    job = schedule_lookup_cluster_addresses(typing_method)
+    job_status = await wait_for_job(job, timeout=timeout, delay=2)
+    n_updated = await update_cluster_addresses(
+        db, typing_method=typing_method.value, addresses=job_status.result
+    )
+    LOG.info("Synced the %s cluster address of %d samples", typing_method, n_updated)
+    return n_updated
+
+
+async def index_allele_profiles(db, *, sample_id: str, software: str) -> None:
+    """Schedule adding the allele profiles from a software to the allele index.
+
+    cgMLST profiles are also given cluster addresses, which are stored on the
+    samples by a background task and reconciled by `sync_cluster_addresses`.
+    Failures are logged as the index is not needed for storing the analysis.
+    """
+    for typing_method, spec in CLUSTER_TYPING_SPECS.items():
+        if spec.selector.get("software") != software:
+            continue
+        typing_method = TypingMethod(typing_method)
+        try:
+            profiles = await get_typing_profiles(db, [sample_id], typing_method.value)
+            index_job = schedule_add_to_allele_index(profiles, typing_method)
+            if typing_method == TypingMethod.CGMLST:
+                address_job = schedule_assign_cluster_address(
+                    sample_id, typing_method, depends_on=[index_job.id]
+                )
+                task = asyncio.create_task(
+                    store_cluster_addresses(
+                        db, typing_method=typing_method, job=address_job
+                    )
+                )
+                _BACKGROUND_TASKS.add(task)
+                task.add_done_callback(_BACKGROUND_TASKS.discard)
+        except (EntryNotFound, RedisError) as exc:
+            LOG.warning(
+                "Could not add %s to the %s allele index: %s",
+                sample_id,
+                typing_method,
+                exc,
+            )
+
+
 async def ingest_analysis_service(
     db,
     *,
@@ -232,6 +327,7 @@ async def ingest_analysis_service(
             )
 
     LOG.info("Ingested analysis %s for %s", analysis_id, sample_id)
+    await index_allele_profiles(db, sample_id=sample_id, software=doc.software)
     return {
         "analysis_id": analysis_id,
         "software": doc.software,
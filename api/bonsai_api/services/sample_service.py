@@ -8,6 +8,7 @@ from .genomic_resource_service import list_genomic_resources_for_sample_service
 import uuid_utils as uuid
 from api_client.audit_log.client import AuditLogClient
 from api_client.audit_log.models import SourceType, Subject
+from bonsai_api.crud.cluster import CLUSTER_TYPING_SPECS
 from bonsai_api.crud.group import check_groups_exists
 from bonsai_api.crud.sample import (
     add_pipeline_run,
@@ -40,7 +41,9 @@ from bonsai_api.models.igv import (
 from bonsai_api.models.memberships import MembershipEdge
 from bonsai_api.models.pipeline import PipelineRun
 from bonsai_api.models.reference_genome import ReferenceGenomeResponse
+from bonsai_api.models.enums import TypingMethod
 from bonsai_api.models.sample import SampleInfoCreate, SampleRecordDb, SampleRecordOut
+from bonsai_api.redis.allele_cluster import schedule_remove_from_allele_index
 from bonsai_api.redis.minhash import (
     schedule_add_genome_signature,
     schedule_add_genome_signature_to_index,
@@ -163,6 +166,8 @@ async def delete_sample_service(
         reidx_job = schedule_remove_genome_signature_from_index(
             [sample_id], depends_on=[rm_job.id]
         )
+        for typing_method in CLUSTER_TYPING_SPECS:
+            schedule_remove_from_allele_index([sample_id], TypingMethod(typing_method))
 
         return {
             "removed_sample": status,
@@ -36,6 +36,15 @@ def parse_manysearch_results(path: Path) -> SimilaritySearchResults:
     return result
 
 
+def merge_search_results(results: SimilaritySearchResults) -> SimilaritySearchResults:
+    """Merge the results of several index segments, most similar first."""
+    return sorted(
+        results,
+        key=lambda r: (r.jaccard_similarity is not None, r.jaccard_similarity or 0.0),
+        reverse=True,
+    )
+
+
 def filter_search_results(
         results: SimilaritySearchResults, 
         *, 
@@ -58,12 +67,13 @@ def filter_search_results(
 def annotate_sample_id(results: SimilaritySearchResults, *, kmer_size: int) -> SimilaritySearchResults:
     """Annotate similarity search results with sample IDs."""
     repo = create_signature_repo()
+    sample_ids = repo.get_sample_ids_by_checksums(
+        (r.md5 for r in results), kmer_size=kmer_size
+    )
     for i, match in enumerate(results):
-        records = repo.get_by_sample_id_or_checksum(checksum=match.md5, kmer_size=kmer_size)
-        record = records[0]
-        if record is None:
+        if match.md5 not in sample_ids:
             continue
-        results[i] = match.model_copy(update={"name": record.sample_id})
+        results[i] = match.model_copy(update={"name": sample_ids[match.md5]})
     return results
 
 
@@ -82,28 +92,41 @@ def get_similar_signatures(
     # output all and then do filtering in python
     output_all = True
 
-    # do multisearch
+    # do multisearch of every segment of the index
+    result: SimilaritySearchResults = []
     with TemporaryDirectory() as tmpdir:
-        output_path = Path(tmpdir) / "output.csv"
         start_execution = time.time()
-        exit_status = sourmash_plugin_branchwater.do_multisearch(
-            str(query_sig.absolute()),
-            str(index_repo.index_path.absolute()),
-            threshold=0,
-            ksize=config.ksize,
-            scaled=config.scaled,
-            moltype=config.moltype,
-            estimate_ani=config.estimate_ani,
-            estimate_prob_overlap=config.estimate_prob_overlap,
-            output_all_comparisons=output_all,
-            calc_abund_stats=config.calc_abund_stats,
-            output_path=str(output_path.absolute()),
-        )
-        if exit_status != 0:
-            raise ValueError(f"Branchwater multisearch failed with status {exit_status}")
-        
+        locations = index_repo.search_locations()
+        for n_location, (index_path, removed) in enumerate(locations):
+            output_path = Path(tmpdir) / f"output{n_location}.csv"
+            exit_status = sourmash_plugin_branchwater.do_multisearch(
+                str(query_sig.absolute()),
+                str(index_path.absolute()),
+                threshold=0,
+                ksize=config.ksize,
+                scaled=config.scaled,
+                moltype=config.moltype,
+                estimate_ani=config.estimate_ani,
+                estimate_prob_overlap=config.estimate_prob_overlap,
+                output_all_comparisons=output_all,
+                calc_abund_stats=config.calc_abund_stats,
+                output_path=str(output_path.absolute()),
+            )
+            if exit_status != 0:
+                raise ValueError(
+                    f"Branchwater multisearch failed with status {exit_status}"
+                )
+
+            try:
+                matches = parse_manysearch_results(output_path)
+            except Exception as exc:
+                LOG.error("Error parsing branchwater multisearch results: %s", exc)
+                raise
+            result.extend(match for match in matches if match.md5 not in removed)
+
+        if len(locations) > 1:
+            result = merge_search_results(result)
         try:
-            result = parse_manysearch_results(output_path)
             result = filter_search_results(result, min_similarity=config.min_similarity, limit=config.limit)
             result = annotate_sample_id(result, kmer_size=config.ksize)
         except Exception as exc:
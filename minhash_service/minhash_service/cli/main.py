@@ -16,7 +16,8 @@ from minhash_service.db import MongoDB
 from minhash_service.integrity.checker import check_signature_integrity
 from minhash_service.integrity.report_model import InitiatorType
 from minhash_service.tasks import dispatch_job
-from minhash_service.tasks.handlers import add_to_index
+from minhash_service.signatures.index import get_index_path, get_index_store
+from minhash_service.tasks.handlers import add_records_to_index
 from minhash_service.tasks.dispatch import SimpleWhitelistWorker
 
 from .utils import format_startup_banner
@@ -87,6 +88,16 @@ def run_cron_scheduler():
         )
         log.info("Scheduling cleanup of removed files: %s", cron_string)
 
+    if cnf.compact_index.enabled:
+        cron_string = cnf.compact_index.cron
+        cron.register(
+            dispatch_job,
+            kwargs={"task": "compact_index"},
+            queue_name=cnf.compact_index.queue,
+            cron=cron_string,
+        )
+        log.info("Scheduling compaction of the signature index: %s", cron_string)
+
     log.info("Starting maintainance worker...")
     cron.start()
 
@@ -177,7 +188,12 @@ def recreate_index(kmer_size: int, include_excluded: bool, dry_run: bool, force:
             return
 
     try:
-        add_to_index(sample_ids=sample_ids)
+        index = get_index_store(
+            get_index_path(cnf.signature_dir, cnf.index_format), cnf.index_format
+        )
+        result = add_records_to_index(index, repo, signatures, kmer_size)
+        if not result.is_successful:
+            raise RuntimeError("; ".join(result.warnings))
         log.info("Index recreated successfully with %d signatures.", len(signatures))
         click.secho("Index recreated successfully.", fg="green")
     except Exception as e:
@@ -92,6 +92,25 @@ class CleanupRemovedFilesConfig(BasePeriodicTaskConfig):
     cron: str = "0 * * * *"  # cron schedule for periodic tasks
 
 
+class CompactIndexConfig(BasePeriodicTaskConfig):
+    """Configure when the segments of the signature index are compacted."""
+
+    model_config = SettingsConfigDict(env_prefix="compact_index_task_")
+
+    cron: str = "*/30 * * * *"  # cron schedule for periodic tasks
+    max_segments: PositiveInt = 8  # merge newer segments when there are more
+    max_tombstone_ratio: float = Field(default=0.1, ge=0)  # of indexed signatures
+
+
+class IndexBatchConfig(BaseSettings):
+    """Configure how signatures are batched when they are added to the index."""
+
+    model_config = SettingsConfigDict(env_prefix="index_batch_")
+
+    debounce: float = Field(default=2.0, ge=0)  # seconds to wait for more signatures
+    max_size: PositiveInt = 1000  # signatures added in one index update
+
+
 class Notification(BaseSettings):
     """Setup notification service."""
 
@@ -106,6 +125,7 @@ class Settings(BaseSettings):
     kmer_size: PositiveInt = 31
     signature_dir: Path = Path("/data/signature_db")
     index_format: IndexFormat = IndexFormat.ROCKSDB
+    index_batch: IndexBatchConfig = IndexBatchConfig()
     trash_dir: DirectoryPath = Field(
         default_factory=_get_trash_dir, description="Directory for trashed files"
     )
@@ -117,6 +137,7 @@ class Settings(BaseSettings):
         PeriodicIntegrityCheckConfig()
     )
     cleanup_removed_files: CleanupRemovedFilesConfig = CleanupRemovedFilesConfig()
+    compact_index: CompactIndexConfig = CompactIndexConfig()
 
     # setup notification settings
     notification: Notification = Notification()
@@ -5,7 +5,7 @@ import logging
 
 from minhash_service.core.config import Settings
 from minhash_service.core.factories import create_signature_repo
-from minhash_service.signatures.index import create_index_store, get_index_path
+from minhash_service.signatures.index import get_index_path, get_index_store
 from minhash_service.signatures.storage import SignatureStorage
 from minhash_service.version import __version__ as sourmash_version
 
@@ -25,7 +25,7 @@ def check_signature_integrity(
     )
     # load index
     idx_path = get_index_path(settings.signature_dir, settings.index_format)
-    index = create_index_store(idx_path, settings.index_format)
+    index = get_index_store(idx_path, settings.index_format)
     indexed_signatures: list[str] = [sig.name for sig in index.list_signatures()]
 
     all_records = repo.get_all_signatures()
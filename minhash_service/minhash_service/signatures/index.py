@@ -1,12 +1,14 @@
 """Sourmash index operations."""
 
 import contextlib
+import datetime as dt
 import logging
 import shutil
 import tempfile
+import threading
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Any, Iterable, cast
+from typing import Any, Iterable, Iterator, cast
 
 import fasteners
 import sourmash
@@ -19,7 +21,11 @@ from .models import IndexFormat, SignatureName, SourmashSignatures
 LOG = logging.getLogger(__name__)
 
 SBTIndex = sourmash.sbtmh.SBT
-RocksDBIndex = DiskRevIndex
+
+ROCKSDB_MANIFEST = "manifest.json"
+LEGACY_SEGMENT = "."  # the index directory itself
+# merged segments are kept for searches that started before the compaction
+RETIRED_SEGMENT_GRACE = dt.timedelta(hours=1)
 
 
 def get_index_path(signature_dir: Path, fmt: IndexFormat) -> Path:
@@ -43,6 +49,27 @@ def create_index_store(
             raise NotImplementedError(f"Unknown index format: {index_format}")
 
 
+_INDEX_STORES: dict[tuple[Path, IndexFormat], "BaseIndexStore"] = {}
+_INDEX_STORES_LOCK = threading.Lock()
+
+
+def get_index_store(
+    index_path: Path, index_format: IndexFormat, lock_path: Path | None = None
+) -> "BaseIndexStore":
+    """Get the index store of the process for a path and format.
+
+    The store keeps the loaded index between jobs and reloads it when another
+    process has written the index since.
+    """
+    key = (Path(index_path).resolve(), index_format)
+    with _INDEX_STORES_LOCK:
+        store = _INDEX_STORES.get(key)
+        if store is None:
+            store = create_index_store(index_path, index_format, lock_path)
+            _INDEX_STORES[key] = store
+    return store
+
+
 class AddResult(BaseModel):
     """Result of adding new signatures to index."""
 
@@ -61,6 +88,108 @@ class RemoveResult(BaseModel):
     removed: list[str] = []
 
 
+class CompactResult(BaseModel):
+    """Result of compacting the segments of an index."""
+
+    is_compacted: bool
+    merged: list[str] = []
+    deleted: list[str] = []
+    n_signatures: int = 0
+    dropped_count: int = 0
+
+
+class IndexSegment(BaseModel):
+    """A RocksDB index of signatures that were added together."""
+
+    name: str
+    sequence: int
+
+
+class RetiredSegment(BaseModel):
+    """A segment that has been merged but can still be read by running searches."""
+
+    name: str
+    retired_at: dt.datetime
+
+
+class SegmentManifest(BaseModel):
+    """Segments of a RocksDB index and tombstones of the removed signatures.
+
+    A tombstone hides the signature in the segments with a lower sequence number,
+    signatures added again after they were removed are written to later segments.
+    """
+
+    segments: list[IndexSegment] = []
+    tombstones: dict[str, int] = {}
+    next_sequence: int = 0
+    retired: list[RetiredSegment] = []
+
+
+class SegmentedRevIndex:
+    """The segments of a RocksDB index searched as one index."""
+
+    def __init__(
+        self,
+        location: Path,
+        manifest: SegmentManifest,
+        opened: dict[str, DiskRevIndex] | None = None,
+    ):
+        """Open the segments in the manifest, reusing already opened segments."""
+        opened = opened or {}
+        self.location = location
+        self.manifest = manifest
+        self.segments: dict[str, DiskRevIndex] = {
+            seg.name: opened.get(seg.name) or DiskRevIndex(str(location / seg.name))
+            for seg in manifest.segments
+        }
+
+    def is_removed(self, checksum: str, segment: IndexSegment) -> bool:
+        """Check if a signature in a segment has been removed."""
+        return self.manifest.tombstones.get(checksum, -1) > segment.sequence
+
+    def removed_checksums(self, segment: IndexSegment) -> set[str]:
+        """Checksums of the removed signatures that are hidden in a segment."""
+        return {
+            checksum
+            for checksum, sequence in self.manifest.tombstones.items()
+            if sequence > segment.sequence
+        }
+
+    def rows(self) -> Iterator[tuple[IndexSegment, dict[str, Any]]]:
+        """Manifest rows of the signatures that have not been removed."""
+        for segment in self.manifest.segments:
+            for row in self.segments[segment.name].manifest.rows:
+                if not self.is_removed(row["md5"], segment):
+                    yield segment, row
+
+    def signatures(self) -> Iterator[sourmash.SourmashSignature]:
+        """Signatures that have not been removed."""
+        for segment in self.manifest.segments:
+            for sig in self.segments[segment.name].signatures():
+                if not self.is_removed(sig.md5sum(), segment):
+                    yield sig
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.rows())
+
+    def search(self, query: sourmash.SourmashSignature, *, threshold: float, **kwargs):
+        """Search all segments and merge the matches, best match first."""
+        matches = []
+        for segment in self.manifest.segments:
+            results = self.segments[segment.name].search(
+                query, threshold=threshold, **kwargs
+            )
+            matches.extend(
+                match
+                for match in results
+                if not self.is_removed(match.signature.md5sum(), segment)
+            )
+        return sorted(matches, key=lambda match: match.score, reverse=True)
+
+
+RocksDBIndex = SegmentedRevIndex
+
+
 class BaseIndexStore(ABC):
     """Base class for index stores."""
 
@@ -71,7 +200,11 @@ class BaseIndexStore(ABC):
             f"{self.index_path.suffix}.lock"
         )
         self._lock = fasteners.InterProcessLock(str(self.lock_path))
+        self.generation_path = self.index_path.with_suffix(
+            f"{self.index_path.suffix}.generation"
+        )
         self._index: Any = None  # lazy load index
+        self._generation: int | None = None  # generation of the loaded index
         LOG.debug("Index path: %s; lock path: %s", self.index_path, self.lock_path)
 
     @contextlib.contextmanager
@@ -87,6 +220,33 @@ class BaseIndexStore(ABC):
             self._lock.release()
             LOG.debug("Released lock: %s", self.lock_path)
 
+    def read_generation(self) -> int:
+        """Read how many times the index has been written, 0 if never."""
+        try:
+            return int(self.generation_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump_generation(self) -> None:
+        """Mark the index on disk as changed for the stores of other processes.
+
+        NOTE: Assumes caller holds aquire_lock() and has written the index.
+        """
+        generation = self.read_generation() + 1
+        tmp_path = self.generation_path.with_name(f"{self.generation_path.name}.tmp")
+        tmp_path.write_text(str(generation), encoding="utf-8")
+        tmp_path.replace(self.generation_path)
+        self._generation = generation
+
+    def _is_current(self) -> bool:
+        """Check if the index in memory is the latest written index."""
+        if self._index is None:
+            return False
+        if self._generation != self.read_generation():
+            LOG.info("Index changed on disk, reloading: %s", self.index_path)
+            return False
+        return True
+
     @abstractmethod
     def _load_index(self, create_if_missing: bool) -> SBTIndex | RocksDBIndex:
         """Index specific load function."""
@@ -110,12 +270,22 @@ class BaseIndexStore(ABC):
     def remove_signatures(self, checksums_to_remove: set[str]) -> RemoveResult:
         """Remove signatures by name."""
 
+    def search_locations(self) -> list[tuple[Path, set[str]]]:
+        """Paths to search and the checksums to leave out of the matches of each."""
+        return [(self.index_path, set())]
+
+    def needs_compaction(self, max_segments: int, max_tombstone_ratio: float) -> bool:
+        """Check if the index should be compacted."""
+        return False
+
+    def compact(self, max_segments: int, max_tombstone_ratio: float) -> CompactResult:
+        """Compact the index, if the index format supports it."""
+        return CompactResult(is_compacted=False)
+
     @property
     def index(self) -> SBTIndex | RocksDBIndex:
         """Return memory representation of index."""
-        if self._index is None:
-            self._load_index(create_if_missing=True)
-        return self._index
+        return self._load_index(create_if_missing=True)
 
 
 class SBTIndexStore(BaseIndexStore):
@@ -123,9 +293,10 @@ class SBTIndexStore(BaseIndexStore):
 
     def _load_index(self, create_if_missing: bool = True) -> SBTIndex:
         """Load index to memory."""
-        if self._index is not None:
+        if self._is_current():
             return self._index
 
+        generation = self.read_generation()
         try:
             index = cast(SBTIndex, sourmash.load_file_as_index(str(self.index_path)))
         except (FileNotFoundError, ValueError) as err:
@@ -134,6 +305,7 @@ class SBTIndexStore(BaseIndexStore):
             LOG.warning("Invalid index: %s, creating new index", self.index_path)
             index = sourmash.create_sbt_index()
         self._index = index
+        self._generation = generation
         return self._index
 
     def _atomic_save(self):
@@ -150,6 +322,7 @@ class SBTIndexStore(BaseIndexStore):
                 self.index_path,
             )
             tmp_idx_path.replace(self.index_path)
+        self._bump_generation()
 
     def add_signatures(
         self,
@@ -210,64 +383,127 @@ class SBTIndexStore(BaseIndexStore):
 
 
 class RocksDBIndexStore(BaseIndexStore):
-    """Handles RocksDB index on disk."""
+    """Handles a segmented RocksDB index on disk.
+
+    Added signatures are written to a new segment and removed signatures are marked
+    with tombstones, which keeps writes from rebuilding the whole index. Compaction
+    merges segments and drops the removed signatures from them.
+    """
+
+    retired_grace: dt.timedelta = RETIRED_SEGMENT_GRACE
 
-    def _load_index(self, create_if_missing: bool = True) -> DiskRevIndex:
-        if self._index is not None:
+    @property
+    def manifest_path(self) -> Path:
+        """Path to the manifest with the segments of the index."""
+        return self.index_path / ROCKSDB_MANIFEST
+
+    def _read_manifest(self) -> SegmentManifest | None:
+        if self.manifest_path.exists():
+            return SegmentManifest.model_validate_json(
+                self.manifest_path.read_text(encoding="utf-8")
+            )
+        if (self.index_path / "CURRENT").exists():
+            # index written as a single RocksDB before it was segmented
+            return SegmentManifest(
+                segments=[IndexSegment(name=LEGACY_SEGMENT, sequence=0)],
+                next_sequence=1,
+            )
+        return None
+
+    def _write_manifest(self, manifest: SegmentManifest) -> None:
+        """Atomically replace the manifest and use it for the index in memory.
+
+        NOTE: Assumes caller holds aquire_lock(). Do not call directly.
+        """
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(manifest.model_dump_json(), encoding="utf-8")
+        tmp_path.replace(self.manifest_path)
+        opened = self._index.segments if self._index is not None else None
+        self._index = SegmentedRevIndex(self.index_path, manifest, opened)
+        self._bump_generation()
+
+    def _load_index(self, create_if_missing: bool = True) -> SegmentedRevIndex:
+        if self._is_current():
             return self._index
 
-        try:
-            self._index = DiskRevIndex(str(self.index_path))
-        except (FileNotFoundError, ValueError):
+        generation = self.read_generation()
+        manifest = self._read_manifest()
+        if manifest is None:
             if not create_if_missing:
                 raise FileNotFoundError(f"RocksDB index not found at {self.index_path}")
             LOG.warning("Invalid index: %s, creating new index", self.index_path)
-            self._index = DiskRevIndex.create_from_sigs([], str(self.index_path))
+            manifest = SegmentManifest()
+        try:
+            opened = self._index.segments if self._index is not None else None
+            self._index = SegmentedRevIndex(self.index_path, manifest, opened)
         except SourmashError as err:
             LOG.error("Sourmash failed to load index: %s", err)
             raise
+        self._generation = generation
         return self._index
 
-    def _rebuild_index(
-        self, signatures: Iterable[sourmash.SourmashSignature]
-    ) -> DiskRevIndex:
-        """Rebuild the entire index using all samples that should be indexed.
+    def list_signatures(self) -> list[SignatureName]:
+        """List signatures in index from the manifests of the segments."""
+        index = self._load_index(create_if_missing=False)
+        return [
+            SignatureName(name=row["name"], filename=row["filename"] or "")
+            for _, row in index.rows()
+        ]
+
+    def _migrate_legacy_index(self) -> None:
+        """Move an index written as a single RocksDB into the first segment.
 
-        DiskRevIndex or RocksDB doesnt have an API for appending or removing signatures
-        from the index.
+        NOTE: Assumes caller holds aquire_lock(). Do not call directly.
+        """
+        if self.manifest_path.exists() or not (self.index_path / "CURRENT").exists():
+            return
+        LOG.info("Moving index to the first segment: %s", self.index_path)
+        segment = IndexSegment(name=_segment_name(0), sequence=0)
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.migrate")
+        self.index_path.rename(tmp_path)
+        self.index_path.mkdir()
+        tmp_path.rename(self.index_path / segment.name)
+        self._index = None
+        self._write_manifest(SegmentManifest(segments=[segment], next_sequence=1))
+
+    def _write_segment(
+        self, signatures: Iterable[sourmash.SourmashSignature], segment: IndexSegment
+    ) -> None:
+        """Write signatures to a new segment.
 
         NOTE: Assumes caller holds aquire_lock(). Do not call directly.
         """
-        parent = self.index_path.parent  # keep on same file system
-        with tempfile.TemporaryDirectory(
-            dir=parent, prefix=self.index_path.name
-        ) as tmp_dir:
-            tmp_path = Path(tmp_dir) / "index.tmp"
-            index = DiskRevIndex.create_from_sigs(signatures, str(tmp_path))
-            if self.index_path.exists():
-                shutil.rmtree(self.index_path)
-            tmp_path.replace(self.index_path)  # atomic save
-        return index
+        self.index_path.mkdir(parents=True, exist_ok=True)
+        # keep on same file system
+        with tempfile.TemporaryDirectory(dir=self.index_path, prefix=".tmp") as tmp_dir:
+            tmp_path = Path(tmp_dir) / segment.name
+            DiskRevIndex.create_from_sigs(signatures, str(tmp_path))
+            tmp_path.replace(self.index_path / segment.name)
 
     def add_signatures(
         self,
         signatures: Iterable[sourmash.SourmashSignature],
     ) -> AddResult:
-        """Add one or more signatures to index."""
+        """Add one or more signatures to a new segment of the index."""
         sigs = list(signatures)
         if not sigs:
             return AddResult(is_successful=False, warnings=[], added_count=0, added_md5s=[])
 
         try:
             with self.aquire_lock():
-                old_index = self._load_index(create_if_missing=True)
-                existing: SourmashSignatures = list(old_index.signatures())
-                # Combine existing and new signatures
-                combined = existing + sigs
-                # Rebuild index while holding lock for atomicity
-                self._index = self._rebuild_index(combined)
+                self._migrate_legacy_index()
+                index = self._load_index(create_if_missing=True)
+                manifest = index.manifest.model_copy(deep=True)
+                segment = IndexSegment(
+                    name=_segment_name(manifest.next_sequence),
+                    sequence=manifest.next_sequence,
+                )
+                self._write_segment(sigs, segment)
+                manifest.segments.append(segment)
+                manifest.next_sequence += 1
+                self._write_manifest(manifest)
         except Exception as error:
-            LOG.error("Got a error when rebuilding index: %s", error)
+            LOG.error("Got a error when adding a segment to the index: %s", error)
             return AddResult(
                 is_successful=False, warnings=[str(error)], added_count=0, added_md5s=[]
             )
@@ -280,30 +516,155 @@ class RocksDBIndexStore(BaseIndexStore):
         )
 
     def remove_signatures(self, checksums_to_remove: set[str]) -> RemoveResult:
-        """Remove signatures by name."""
-        sigs = list(checksums_to_remove)
-        if not sigs:
-            return AddResult(is_successful=False, warnings=[], added_count=0, added_md5s=[])
+        """Remove signatures by checksum by adding tombstones for them."""
+        if not checksums_to_remove:
+            return RemoveResult(is_successful=False, warnings=[], removed_count=0)
 
         with self.aquire_lock():
-            old_index = self._load_index(create_if_missing=False)
-            kept: SourmashSignatures = []
-            removed: list[str] = []
-            for sig in old_index.signatures():
-                checksum = sig.md5sum()
-                (removed if checksum in checksums_to_remove else kept).append(sig)
-            # Rebuild index while holding lock for atomicity
-            self._index = self._rebuild_index(kept)
+            self._migrate_legacy_index()
+            index = self._load_index(create_if_missing=False)
+            removed = sorted(
+                {
+                    row["md5"]
+                    for _, row in index.rows()
+                    if row["md5"] in checksums_to_remove
+                }
+            )
+            if removed:
+                manifest = index.manifest.model_copy(deep=True)
+                # hides the signatures in the current segments but not in later ones
+                for checksum in removed:
+                    manifest.tombstones[checksum] = manifest.next_sequence
+                self._write_manifest(manifest)
 
-        removed_checksums = {r.md5sum() for r in removed}
-        not_removed = checksums_to_remove - removed_checksums
+        not_removed = checksums_to_remove - set(removed)
         if not_removed:
             return RemoveResult(
-                ok=False,
+                is_successful=False,
                 warnings=[f"could not remove {', '.join(not_removed)}"],
-                removed=[s.md5sum() for s in removed],
+                removed=removed,
                 removed_count=len(removed),
             )
         return RemoveResult(
-            ok=True, warnings=[], removed_count=len(removed), removed=list(removed_checksums)
+            is_successful=True,
+            warnings=[],
+            removed_count=len(removed),
+            removed=removed,
         )
+
+    def search_locations(self) -> list[tuple[Path, set[str]]]:
+        """Paths of the segments and the removed checksums hidden in each."""
+        index = self._load_index(create_if_missing=False)
+        return [
+            (self.index_path / segment.name, index.removed_checksums(segment))
+            for segment in index.manifest.segments
+        ]
+
+    def _plan_compaction(
+        self, index: SegmentedRevIndex, max_segments: int, max_tombstone_ratio: float
+    ) -> list[IndexSegment]:
+        """Select the segments to merge.
+
+        All segments are merged when the newer segments have grown as large as the
+        first segment or when there are many removed signatures, otherwise the newer
+        segments are merged when there are more than max_segments.
+        """
+        segments = index.manifest.segments
+        n_tombstones = len(index.manifest.tombstones)
+        if len(segments) < 2 and n_tombstones == 0:
+            return []
+        sizes = [len(index.segments[segment.name]) for segment in segments]
+        base_size, delta_size = sizes[0], sum(sizes[1:])
+        if n_tombstones > max_tombstone_ratio * sum(sizes) or delta_size >= base_size:
+            return list(segments)
+        if len(segments) > max_segments:
+            return list(segments[1:])
+        return []
+
+    def needs_compaction(self, max_segments: int, max_tombstone_ratio: float) -> bool:
+        """Check if the segments of the index should be compacted."""
+        index = self._load_index(create_if_missing=True)
+        return bool(self._plan_compaction(index, max_segments, max_tombstone_ratio))
+
+    def _delete_retired_segments(self, manifest: SegmentManifest) -> list[str]:
+        """Delete the merged segments that were retired before the grace period.
+
+        NOTE: Assumes caller holds aquire_lock(). Do not call directly.
+        """
+        cutoff = dt.datetime.now(dt.timezone.utc) - self.retired_grace
+        expired = [seg for seg in manifest.retired if seg.retired_at <= cutoff]
+        for segment in expired:
+            shutil.rmtree(self.index_path / segment.name, ignore_errors=True)
+        manifest.retired = [seg for seg in manifest.retired if seg.retired_at > cutoff]
+        return [segment.name for segment in expired]
+
+    def compact(self, max_segments: int, max_tombstone_ratio: float) -> CompactResult:
+        """Merge segments and drop the removed signatures from them.
+
+        Searches use the old segments until the merged segment is written. The
+        merged segments are retired and deleted by a compaction after the grace
+        period, searches that read their paths earlier can finish with them.
+        """
+        with self.aquire_lock():
+            self._migrate_legacy_index()
+            index = self._load_index(create_if_missing=True)
+            manifest = index.manifest.model_copy(deep=True)
+            deleted = self._delete_retired_segments(manifest)
+            merged = self._plan_compaction(index, max_segments, max_tombstone_ratio)
+            if not merged:
+                if deleted:
+                    self._write_manifest(manifest)
+                return CompactResult(is_compacted=False, deleted=deleted)
+
+            LOG.info("Merging %d index segments", len(merged))
+            sigs: SourmashSignatures = []
+            dropped = 0
+            for segment in merged:
+                for sig in index.segments[segment.name].signatures():
+                    if index.is_removed(sig.md5sum(), segment):
+                        dropped += 1
+                    else:
+                        sigs.append(sig)
+
+            remaining = [seg for seg in manifest.segments if seg not in merged]
+            # keep the tombstones that still hide signatures in the other segments
+            manifest.tombstones = {
+                checksum: sequence
+                for checksum, sequence in manifest.tombstones.items()
+                if any(
+                    seg.sequence < sequence
+                    and checksum in _segment_checksums(index, seg)
+                    for seg in remaining
+                )
+            }
+            manifest.segments = remaining
+            if sigs:
+                segment = IndexSegment(
+                    name=_segment_name(manifest.next_sequence),
+                    sequence=max(seg.sequence for seg in merged),
+                )
+                self._write_segment(sigs, segment)
+                manifest.segments.append(segment)
+                manifest.segments.sort(key=lambda seg: seg.sequence)
+                manifest.next_sequence += 1
+            retired_at = dt.datetime.now(dt.timezone.utc)
+            manifest.retired.extend(
+                RetiredSegment(name=segment.name, retired_at=retired_at)
+                for segment in merged
+            )
+            self._write_manifest(manifest)
+        return CompactResult(
+            is_compacted=True,
+            merged=[segment.name for segment in merged],
+            deleted=deleted,
+            n_signatures=len(sigs),
+            dropped_count=dropped,
+        )
+
+
+def _segment_name(number: int) -> str:
+    return f"segment-{number:06d}"
+
+
+def _segment_checksums(index: SegmentedRevIndex, segment: IndexSegment) -> set[str]:
+    return {row["md5"] for row in index.segments[segment.name].manifest.rows}
@@ -35,6 +35,11 @@ class SignatureRepository:
         self._col.create_index(
             [("has_been_indexed", ASCENDING)], name="ix_has_been_indexed"
         )
+        # Query accelerator for finding the samples of search and cluster results
+        self._col.create_index(
+            [("signature_checksum", ASCENDING), ("kmer_size", ASCENDING)],
+            name="ix_signature_checksum_ksize",
+        )
 
     # ---- create -------------------------------------------------------------
     def add_signature(self, signature: SignatureRecord) -> ObjectId | None:
@@ -93,6 +98,34 @@ class SignatureRepository:
         docs = self._col.find(query, projection={"_id": 0})
         return [SignatureRecord.model_validate(doc) for doc in docs]
 
+    def get_many_by_sample_ids(
+        self, sample_ids: Iterable[str], kmer_size: int | None = None
+    ) -> list[SignatureRecord]:
+        """Get the signatures of several samples in one query."""
+        query: dict[str, Any] = {"sample_id": {"$in": list(set(sample_ids))}}
+        if kmer_size is not None:
+            query["kmer_size"] = kmer_size
+        docs = self._col.find(query, projection={"_id": 0})
+        return [SignatureRecord.model_validate(doc) for doc in docs]
+
+    # Search and cluster results only need the sample id of each checksum, so
+    # there is no lookup of whole records by checksum; this only projects the two
+    # fields instead of loading every signature record.
+    def get_sample_ids_by_checksums(
+        self, checksums: Iterable[str], kmer_size: int | None = None
+    ) -> dict[str, str]:
+        """Map signature checksums to the sample id of the first record with it."""
+        query: dict[str, Any] = {"signature_checksum": {"$in": list(set(checksums))}}
+        if kmer_size is not None:
+            query["kmer_size"] = kmer_size
+        docs = self._col.find(
+            query, projection={"_id": 0, "sample_id": 1, "signature_checksum": 1}
+        )
+        sample_ids: dict[str, str] = {}
+        for doc in docs:
+            sample_ids.setdefault(doc["signature_checksum"], doc["sample_id"])
+        return sample_ids
+
     def get_all_signatures(self) -> Iterator[SignatureRecord]:
         """Get all signatures in the database."""
         cursor = self._col.find(projection={"_id": 0})
@@ -100,10 +133,24 @@ class SignatureRepository:
             yield SignatureRecord.model_validate(doc)
 
     def get_unindexed_signatures(
-        self, *, limit: int | None = None
+        self,
+        *,
+        kmer_size: int | None = None,
+        limit: int | None = None,
+        skip_excluded: bool = False,
     ) -> Iterator[SignatureRecord]:
-        """Get signatures that have not been indexed yet."""
-        cursor = self._col.find({"has_been_indexed": False}, projection={"_id": 0})
+        """Get signatures that have not been indexed yet.
+
+        Signatures excluded from analysis or marked for deletion are left out with
+        skip_excluded.
+        """
+        query: dict[str, Any] = {"has_been_indexed": False}
+        if kmer_size is not None:
+            query["kmer_size"] = kmer_size
+        if skip_excluded:
+            query["exclude_from_analysis"] = {"$ne": True}
+            query["marked_for_deletion"] = {"$ne": True}
+        cursor = self._col.find(query, projection={"_id": 0})
         if limit:
             cursor = cursor.limit(limit)
         for doc in cursor:
@@ -126,6 +173,35 @@ class SignatureRepository:
         )
         return res.modified_count > 0
 
+    def _set_flags(self, sample_ids: Iterable[str], status: bool, flag: str) -> int:
+        """
+        Set a flag for several samples with one update.
+        Returns the number of documents that were modified.
+        """
+        query = {"sample_id": {"$in": list(set(sample_ids))}, flag: {"$ne": status}}
+        # every sample gets the same $set, so one update_many replaces a bulk_write
+        # of one UpdateOne per sample and does not need to find the samples first
+        res = self._col.update_many(query, {"$set": {flag: status}})
+        LOG.debug("Set flag %s=%s for %d samples", flag, status, res.modified_count)
+        return res.modified_count
+
+    def _set_flags_and_get_changed(
+        self, sample_ids: Iterable[str], status: bool, flag: str
+    ) -> list[str]:
+        """
+        Set a flag for several samples with one update.
+        Returns the sample ids of the documents that were changed, in input order.
+        """
+        sample_ids = list(dict.fromkeys(sample_ids))
+        docs = self._col.find(
+            {"sample_id": {"$in": sample_ids}, flag: {"$ne": status}},
+            projection={"_id": 0, "sample_id": 1},
+        )
+        to_change = {doc["sample_id"] for doc in docs}
+        if to_change:
+            self._set_flags(to_change, status=status, flag=flag)
+        return [sid for sid in sample_ids if sid in to_change]
+
     def mark_indexed(self, sample_id: str) -> bool:
         """Mark a signature as indexed. Returns True if a document was modified."""
         return self._set_flag(sample_id, flag="has_been_indexed", status=True)
@@ -144,7 +220,27 @@ class SignatureRepository:
 
     def marked_for_deletion(self, sample_id: str) -> bool:
         """Mark a signature for deletion. Returns True if a document was modified."""
-        return self._set_flag(sample_id, flag="mark_for_deletion", status=True)
+        return self._set_flag(sample_id, flag="marked_for_deletion", status=True)
+
+    def mark_many_indexed(self, sample_ids: Iterable[str]) -> int:
+        """Mark signatures as indexed. Returns the number modified."""
+        return self._set_flags(sample_ids, flag="has_been_indexed", status=True)
+
+    def unmark_many_indexed(self, sample_ids: Iterable[str]) -> int:
+        """Mark signatures as not indexed. Returns the number modified."""
+        return self._set_flags(sample_ids, flag="has_been_indexed", status=False)
+
+    def exclude_many_from_analysis(self, sample_ids: Iterable[str]) -> list[str]:
+        """Exclude samples from future analysis. Returns the samples modified."""
+        return self._set_flags_and_get_changed(
+            sample_ids, flag="exclude_from_analysis", status=True
+        )
+
+    def include_many_in_analysis(self, sample_ids: Iterable[str]) -> list[str]:
+        """Include samples in future analysis. Returns the samples modified."""
+        return self._set_flags_and_get_changed(
+            sample_ids, flag="exclude_from_analysis", status=False
+        )
 
     # ---- delete -------------------------------------------------------------
     def remove_by_sample_id(self, sample_id: str, kmer_size: int | None = None) -> int:
@@ -6,7 +6,7 @@ from rq import Queue, SimpleWorker
 from rq.job import Job
 
 from .handlers import (add_signature, add_to_index, check_signature,
-                       cleanup_removed_files, cluster_samples,
+                       cleanup_removed_files, cluster_samples, compact_index,
                        exclude_from_analysis, find_similar_and_cluster,
                        get_data_integrity_report, include_in_analysis,
                        remove_from_index, remove_signature,
@@ -26,6 +26,7 @@ REGISTRY: dict[str, Callable[..., Any]] = {
     "check_data_integrity": run_data_integrity_check,
     "get_integrity_report": get_data_integrity_report,
     "cleanup_removed_files": cleanup_removed_files,
+    "compact_index": compact_index,
 }
 
 ALLOWED_ENTRYPOINTS: set[str] = {
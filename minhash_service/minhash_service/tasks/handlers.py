@@ -4,9 +4,13 @@ import datetime as dt
 import json
 import logging
 import tempfile
+import time
 from pathlib import Path
 from typing import Any, Iterable, cast
 
+import fasteners
+from rq import Queue, get_current_job
+
 from minhash_service.analysis.cluster import cluster_signatures, tree_to_newick
 from minhash_service.analysis.models import (AniEstimateOptions, ClusterMethod,
                                              SimilaritySearchConfig)
@@ -19,7 +23,8 @@ from minhash_service.core.factories import (create_audit_trail_repo,
 from minhash_service.core.models import Event, EventType
 from minhash_service.integrity.checker import check_signature_integrity
 from minhash_service.integrity.report_model import InitiatorType
-from minhash_service.signatures.index import create_index_store, get_index_path
+from minhash_service.signatures.index import (AddResult, BaseIndexStore,
+                                              get_index_path, get_index_store)
 from minhash_service.signatures.io import read_signatures, write_signatures
 from minhash_service.signatures.models import (SignatureRecord,
                                                SourmashSignatures)
@@ -30,6 +35,9 @@ from .notify import EmailApiInput, dispatch_email
 
 LOG = logging.getLogger(__name__)
 
+COMPACTION_SCHEDULED_KEY = "minhash:compact_index:scheduled"
+COMPACTION_SCHEDULED_TTL = 60 * 60  # seconds, in case the job is lost
+
 
 def add_signature(sample_id: str, signature: str) -> str:
     """
@@ -112,7 +120,7 @@ def remove_signature(sample_id: str) -> dict[str, str | bool]:
     store = SignatureStorage(base_dir=cnf.signature_dir, trash_dir=cnf.trash_dir)
     # get index store
     idx_path = get_index_path(cnf.signature_dir, cnf.index_format)
-    index = create_index_store(idx_path, cnf.index_format)
+    index = get_index_store(idx_path, cnf.index_format)
     # mark sample for deletion in db
     was_marked = repo.marked_for_deletion(sample_id)
     if not was_marked:
@@ -188,48 +196,101 @@ def check_signature(sample_id: str) -> dict[str, str | bool]:
     }
 
 
-def add_to_index(sample_ids: list[str]) -> str:
+def add_to_index(sample_ids: list[str]) -> dict[str, Any]:
     """
     Add signatures to sourmash index.
 
-    :param sample_ids list[str]: The path to multiple signature files
+    Additions are coalesced, the job waits until the debounce window after the
+    upload of its signatures has passed and then adds every signature that has not
+    been indexed, including the signatures of other queued jobs, in one index
+    update. Jobs whose samples have already been indexed return without waiting.
+
+    :param sample_ids list[str]: Sample ids of the signatures to add
 
     :return: result message
-    :rtype: str
+    :rtype: dict[str, Any]
     """
     kmer_size = cnf.kmer_size
-    LOG.info("Adding %d signatures to index...", len(sample_ids))
+    settings = cnf.index_batch
     repo = create_signature_repo()
+    pending = [
+        rec
+        for rec in repo.get_many_by_sample_ids(sample_ids, kmer_size=kmer_size)
+        if not rec.has_been_indexed
+    ]
+    if not pending:
+        LOG.info("Signatures of %d samples are already indexed", len(sample_ids))
+        return AddResult(
+            is_successful=True, warnings=[], added_count=0, added_md5s=[]
+        ).model_dump(mode="json")
+
+    # let the signatures of samples uploaded together be added with this batch, the
+    # window starts at the upload so jobs queued behind it do not wait again
+    newest_upload = max(rec.uploaded_at for rec in pending)
+    age = (dt.datetime.now(dt.timezone.utc) - newest_upload).total_seconds()
+    if age < settings.debounce:
+        time.sleep(settings.debounce - age)
 
-    signatures = _load_signatures_from_sample_id(sample_ids, kmer_size=kmer_size)
-
-    # add to index
     idx_path = get_index_path(cnf.signature_dir, cnf.index_format)
-    index = create_index_store(idx_path, index_format=cnf.index_format)
-    result = index.add_signatures(signatures)
-
-    LOG.info(
-        "Updating index status in the database for %d samples.", result.added_count
+    index = get_index_store(idx_path, index_format=cnf.index_format)
+    batch_lock = fasteners.InterProcessLock(
+        str(index.lock_path.with_suffix(".batch.lock"))
     )
-    update_status: dict[str, bool] = {}
-    for checksum in result.added_md5s:
-        recs = repo.get_by_sample_id_or_checksum(checksum=checksum, kmer_size=kmer_size)
-        rec = recs[0]
-        status = repo.mark_indexed(rec.sample_id)
-        update_status[rec.sample_id] = status
-
-    all_updated: bool = all(status for status in update_status.values())
-    if not all_updated:
-        failed_update = [name for name, status in update_status.items() if not status]
+    result = AddResult(is_successful=True, warnings=[], added_count=0, added_md5s=[])
+    added: set[str] = set()
+    with batch_lock:
+        # read after the lock so signatures added by other jobs are not added again
+        while records := [
+            rec
+            for rec in repo.get_unindexed_signatures(
+                kmer_size=kmer_size, limit=settings.max_size, skip_excluded=True
+            )
+            if rec.sample_id not in added
+        ]:
+            batch = add_records_to_index(index, repo, records, kmer_size)
+            result.is_successful = batch.is_successful
+            result.warnings.extend(batch.warnings)
+            result.added_count += batch.added_count
+            result.added_md5s.extend(batch.added_md5s)
+            added.update(rec.sample_id for rec in records)
+            if not batch.is_successful or len(records) < settings.max_size:
+                break
+    if not added:
+        LOG.info(
+            "Signatures of %d samples were indexed by another job", len(sample_ids)
+        )
+    _schedule_index_compaction(index)
+    return result.model_dump(mode="json")
+
+
+def add_records_to_index(
+    index: BaseIndexStore,
+    repo: SignatureRepository,
+    records: list[SignatureRecord],
+    kmer_size: int,
+) -> AddResult:
+    """Add the signatures of records to the index and mark them indexed."""
+    LOG.info("Adding %d signatures to index...", len(records))
+    signatures: SourmashSignatures = []
+    for record in records:
+        signatures.extend(read_signatures(record.signature_path, kmer_size=kmer_size))
+    result = index.add_signatures(signatures)
+    if not result.is_successful:
+        LOG.error("Failed to add %d signatures to the index", len(records))
+        return result
+
+    LOG.info("Updating index status in the database for %d samples.", len(records))
+    n_updated = repo.mark_many_indexed(rec.sample_id for rec in records)
+    n_samples = len({rec.sample_id for rec in records})
+    if n_updated < n_samples:
         LOG.error(
-            "Failed to mark %d samples as indexed; %s",
-            len(failed_update),
-            ", ".join(failed_update),
+            "Failed to mark %d of %d samples as indexed",
+            n_samples - n_updated,
+            n_samples,
         )
     else:
-        LOG.debug("Marked %d samples as indexed", len(update_status))
-
-    return result.model_dump(mode="json")
+        LOG.debug("Marked %d samples as indexed", n_updated)
+    return result
 
 
 def remove_from_index(sample_ids: list[str]) -> dict[str, Any]:
@@ -244,32 +305,74 @@ def remove_from_index(sample_ids: list[str]) -> dict[str, Any]:
     LOG.info("Removing signatures from index.")
     # get index store
     idx_path = get_index_path(cnf.signature_dir, cnf.index_format)
-    index = create_index_store(idx_path, index_format=cnf.index_format)
+    index = get_index_store(idx_path, index_format=cnf.index_format)
 
     # lookup checksums for sample ids
     repo = create_signature_repo()
-    checksums_to_remove: list[str] = []
-    md5_to_sample_id: dict[str, str] = {}
-    for sid in sample_ids:
-        sample = repo.get_by_sample_id_or_checksum(sample_id=sid)
-        if sample is None:
-            continue
-        checksum = sample.signature_checksum
-        md5_to_sample_id[checksum] = sid
-        checksums_to_remove.append(checksum)
+    checksums_to_remove: list[str] = [
+        rec.signature_checksum
+        for rec in repo.get_many_by_sample_ids(sample_ids, kmer_size=cnf.kmer_size)
+    ]
 
     result = index.remove_signatures(set(checksums_to_remove))
-    if not result.ok:
+    _schedule_index_compaction(index)
+    if not result.is_successful:
         n_remaining = len(checksums_to_remove) - result.removed_count
         LOG.error("Failed to remove %d checksum from index", n_remaining)
 
     # unmark indexed status in db
-    repo = create_signature_repo()
-    for sid in sample_ids:
-        repo.unmark_indexed(sid)
+    repo.unmark_many_indexed(sample_ids)
     return result.model_dump()
 
 
+def _schedule_index_compaction(index: BaseIndexStore) -> None:
+    """Queue a compaction of the index when its segments hit the thresholds."""
+    settings = cnf.compact_index
+    if not settings.enabled or not index.needs_compaction(
+        settings.max_segments, settings.max_tombstone_ratio
+    ):
+        return
+    job = get_current_job()
+    if job is None:
+        LOG.info("Index needs compaction, leaving it to the periodic task")
+        return
+    # only one compaction is queued at a time, the task clears the flag when it starts
+    if not job.connection.set(
+        COMPACTION_SCHEDULED_KEY, 1, nx=True, ex=COMPACTION_SCHEDULED_TTL
+    ):
+        LOG.debug("Compaction of the index is already scheduled")
+        return
+    Queue(settings.queue, connection=job.connection).enqueue(
+        "minhash_service.tasks.dispatch.dispatch_job", task="compact_index"
+    )
+    LOG.info("Scheduled compaction of the index")
+
+
+def compact_index() -> dict[str, Any]:
+    """
+    Merge the segments of the index and drop removed signatures from them.
+
+    :return: result of the compaction
+    :rtype: dict[str, Any]
+    """
+    settings = cnf.compact_index
+    job = get_current_job()
+    if job is not None:
+        # writes from now on may need another compaction
+        job.connection.delete(COMPACTION_SCHEDULED_KEY)
+    idx_path = get_index_path(cnf.signature_dir, cnf.index_format)
+    index = get_index_store(idx_path, index_format=cnf.index_format)
+    result = index.compact(settings.max_segments, settings.max_tombstone_ratio)
+    if result.is_compacted:
+        LOG.info(
+            "Merged %d index segments with %d signatures, dropped %d removed",
+            len(result.merged),
+            result.n_signatures,
+            result.dropped_count,
+        )
+    return result.model_dump(mode="json")
+
+
 def exclude_from_analysis(sample_ids: list[str]) -> dict[str, bool | list[str]]:
     """
     Exclude signatures from being included in analysis without removing them.
@@ -281,14 +384,10 @@ def exclude_from_analysis(sample_ids: list[str]) -> dict[str, bool | list[str]]:
     """
     LOG.info("Excluding %d signatures from future analysis.", len(sample_ids))
     # unmark indexed status in db
-    excluded_samples: list[str] = []
     repo = create_signature_repo()
-    for sid in sample_ids:
-        status = repo.exclude_from_analysis(sid)
-        if status:
-            excluded_samples.append(sid)
+    excluded_samples = repo.exclude_many_from_analysis(sample_ids)
 
-    all_ok = len(excluded_samples) == len(sample_ids)
+    all_ok = len(excluded_samples) == len(set(sample_ids))
     return {"ok": all_ok, "excluded": excluded_samples, "to_exclude": sample_ids}
 
 
@@ -304,14 +403,9 @@ def include_in_analysis(sample_ids: list[str]) -> dict[str, str | bool | list[st
     LOG.info("Including %d signatures in future analysis.", len(sample_ids))
     # unmark indexed status in db
     repo = create_signature_repo()
+    included = repo.include_many_in_analysis(sample_ids)
 
-    included: list[str] = []
-    for sid in sample_ids:
-        status = repo.include_in_analysis(sid)
-        if status:
-            included.append(sid)
-
-    all_ok = len(included) == len(sample_ids)
+    all_ok = len(included) == len(set(sample_ids))
     return {"ok": all_ok, "included": included, "to_include": sample_ids}
 
 
@@ -324,8 +418,7 @@ def _lookup_checksums_from_sample_ids(
 
     return [
         rec.signature_checksum
-        for sid in sample_ids
-        if (rec := repo.get_by_sample_id_or_checksum(sample_id=sid))
+        for rec in repo.get_many_by_sample_ids(sample_ids, kmer_size=cnf.kmer_size)
     ]
 
 
@@ -334,9 +427,13 @@ def _load_signatures_from_sample_id(sample_ids: list[str], kmer_size: int | None
     LOG.debug("Load signatures to memory")
     repo = create_signature_repo()
 
+    records_by_sample: dict[str, list[SignatureRecord]] = {}
+    for rec in repo.get_many_by_sample_ids(sample_ids, kmer_size=kmer_size):
+        records_by_sample.setdefault(rec.sample_id, []).append(rec)
+
     signatures: SourmashSignatures = []
     for sample_id in sample_ids:
-        records = repo.get_by_sample_id_or_checksum(sample_id=sample_id, kmer_size=kmer_size)
+        records = records_by_sample.get(sample_id, [])
 
         if not records:
             LOG.error("No signature found for sample_id=%s", sample_id)
@@ -386,7 +483,7 @@ def search_similar(
     
     record = records[0]
 
-    index = create_index_store(
+    index = get_index_store(
         get_index_path(cnf.signature_dir, cnf.index_format),
         index_format=cnf.index_format,
     )
@@ -439,14 +536,10 @@ def cluster_samples(sample_ids: list[str], cluster_method: str = "single") -> st
     tree, checksums  = cluster_signatures(signatures, method)
 
     repo = create_signature_repo()
-    kmer_size = cnf.kmer_size
-    sample_ids = []
-    for checksum in checksums:
-        records = repo.get_by_sample_id_or_checksum(checksum=checksum, kmer_size=kmer_size)
-        record = records[0]
-        if record is None:
-            continue
-        sample_ids.append(record.sample_id)
+    sample_id_lookup = repo.get_sample_ids_by_checksums(
+        checksums, kmer_size=cnf.kmer_size
+    )
+    sample_ids = [sample_id_lookup[c] for c in checksums if c in sample_id_lookup]
 
     LOG.debug("Creating newick tree; checksums: %s; leaf names: %s", checksums, sample_ids)
     newick = tree_to_newick(node=tree, newick="", parentdist=tree.dist, leaf_names=sample_ids)
@@ -503,15 +596,14 @@ def find_similar_and_cluster(
     # load sequence signatures to memory
     repo = create_signature_repo()
     kmer_size = cnf.kmer_size
-    sample_ids: list[str] = []
-    checksums_lookup = {}
-    for match in results["matches"]:
-        records = repo.get_by_sample_id_or_checksum(checksum=match["md5"], kmer_size=kmer_size)
-        record = records[0]
-        if record is None:
-            continue
-        sample_ids.append(record.sample_id)
-        checksums_lookup[record.signature_checksum] = record.sample_id
+    checksums_lookup = repo.get_sample_ids_by_checksums(
+        (match["md5"] for match in results["matches"]), kmer_size=kmer_size
+    )
+    sample_ids: list[str] = [
+        checksums_lookup[match["md5"]]
+        for match in results["matches"]
+        if match["md5"] in checksums_lookup
+    ]
     signatures = _load_signatures_from_sample_id(sample_ids, kmer_size=kmer_size)
 
     # cluster samples
@@ -1,4 +1,6 @@
 """Test signature index operations."""
+
+import datetime as dt
 import shutil
 from pathlib import Path
 from unittest.mock import Mock, patch
@@ -10,6 +12,7 @@ from minhash_service.signatures.index import (
     SBTIndexStore,
     create_index_store,
     get_index_path,
+    get_index_store,
 )
 from minhash_service.signatures.io import read_signatures
 from minhash_service.signatures.models import IndexFormat
@@ -146,6 +149,37 @@ class TestCreateIndexStore:
             create_index_store(index_path, "invalid_format")
 
 
+class TestGetIndexStore:
+    """Test the index stores shared by the jobs of a process."""
+
+    def test_same_store_for_path_and_format(self, tmp_index_dir: Path):
+        """The store and its loaded index are reused."""
+        index_path = tmp_index_dir / "test_sbt"
+
+        store = get_index_store(index_path, IndexFormat.SBT)
+
+        assert get_index_store(index_path, IndexFormat.SBT) is store
+        assert get_index_store(index_path, IndexFormat.ROCKSDB) is not store
+
+    def test_index_is_cached_until_written(self, tmp_index_dir: Path):
+        """The index is reloaded after another store has written it."""
+        index_path = tmp_index_dir / "test_sbt"
+        store = SBTIndexStore(index_path)
+        other_store = SBTIndexStore(index_path)
+
+        with patch("sourmash.load_file_as_index", side_effect=lambda _: Mock()) as load:
+            index = store.index
+            assert store.index is index
+            assert load.call_count == 1
+
+            with other_store.aquire_lock():
+                other_store._bump_generation()
+
+            assert store.index is not index
+            assert load.call_count == 2
+            assert store.read_generation() == 1
+
+
 class TestSBTIndexStore:
     """Test SBT index store."""
 
@@ -309,20 +343,14 @@ class TestRocksDBIndexStore:
             with pytest.raises(FileNotFoundError):
                 store._load_index(create_if_missing=False)
 
-    def test_rocksdb_list_signatures(self, tmp_index_dir: Path, mock_signature):
+    def test_rocksdb_list_signatures(self, tmp_rocksdb_index: Path):
         """List signatures from RocksDB index."""
-        index_path = tmp_index_dir / "test"
+        store = RocksDBIndexStore(tmp_rocksdb_index)
 
-        with patch("sourmash.index.revindex.DiskRevIndex") as mock_class:
-            mock_index = Mock()
-            mock_index.signatures.return_value = [mock_signature]
-            mock_class.return_value = mock_index
+        sigs = store.list_signatures()
 
-            store = RocksDBIndexStore(index_path)
-            store.index  # assert index is created
-            sigs = store.list_signatures()
-
-            assert len(sigs) == 1
+        assert len(sigs) == 4
+        assert "DRR237260" in {sig.name for sig in sigs}
 
     def test_rocksdb_add_signature(self, tmp_rocksdb_index: Path, tmp_dupl_signature: Path):
         """Use the actual database to test adding a signature."""
@@ -335,9 +363,14 @@ class TestRocksDBIndexStore:
         sigs = [sig for sig in read_signatures(tmp_dupl_signature) if sig.minhash.ksize == 31]
         status = store.add_signatures(sigs)
 
-        assert status.ok
+        assert status.is_successful
 
         assert len(store.list_signatures()) == start_n_sigs + 1
+        # the index is moved to the first segment and the signature added to a new
+        assert [seg.name for seg in store.index.manifest.segments] == [
+            "segment-000000",
+            "segment-000001",
+        ]
 
     def test_rocksdb_remove_signature(self, tmp_rocksdb_index: Path):
         """Use the actual database to test removing a signature."""
@@ -349,18 +382,148 @@ class TestRocksDBIndexStore:
         assert start_n_sigs > 0, "Index must have at least one signature to test removal"
 
         # remove the first signature
-        sig_to_remove = start_sigs[0]
-        md5_to_remove = None
-        for sig in store.index.signatures():
-            if sig.name == sig_to_remove.name:
-                md5_to_remove = sig.md5sum()
-                break
-
-        assert md5_to_remove is not None
+        md5_to_remove = next(row["md5"] for _, row in store.index.rows())
         status = store.remove_signatures({md5_to_remove})
 
-        assert status.ok
-        assert len(store.list_signatures()) == start_n_sigs - 1 
+        assert status.is_successful
+        assert status.removed == [md5_to_remove]
+        assert len(store.list_signatures()) == start_n_sigs - 1
+        # the removed signature is hidden from searches of the segment
+        [(_, removed)] = store.search_locations()
+        assert removed == {md5_to_remove}
+
+
+@pytest.fixture()
+def signatures_k31(data_dir: Path) -> list:
+    """Signatures of four samples."""
+    return [
+        sig
+        for name in ("DRR237260", "DRR237261", "DRR237262", "DRR237263")
+        for sig in read_signatures(data_dir / f"{name}.sig")
+        if sig.minhash.ksize == 31
+    ]
+
+
+class TestSegmentedRocksDBIndex:
+    """Test adding, removing and compacting segments of a RocksDB index."""
+
+    def test_added_signatures_are_searched(self, tmp_index_dir: Path, signatures_k31):
+        """Each add writes a segment and searches merge the segments."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+
+        for sig in signatures_k31:
+            assert store.add_signatures([sig]).is_successful
+
+        assert len(store.index.manifest.segments) == 4
+        assert len(store.search_locations()) == 4
+        matches = store.index.search(signatures_k31[0], threshold=0)
+        assert len(matches) == 4
+        assert matches[0].signature.name == signatures_k31[0].name
+        assert [m.score for m in matches] == sorted(
+            (m.score for m in matches), reverse=True
+        )
+
+    def test_readded_signature_is_not_removed(
+        self, tmp_index_dir: Path, signatures_k31
+    ):
+        """A tombstone only hides the signature in earlier segments."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+        sig = signatures_k31[0]
+        store.add_signatures(signatures_k31)
+
+        store.remove_signatures({sig.md5sum()})
+        assert sig.md5sum() not in {s.md5sum() for s in store.index.signatures()}
+
+        store.add_signatures([sig])
+        assert [s.md5sum() for s in store.index.signatures()].count(sig.md5sum()) == 1
+
+    def test_compaction_merges_newer_segments(
+        self, tmp_index_dir: Path, signatures_k31
+    ):
+        """Newer segments are merged when there are too many of them."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+        store.add_signatures(signatures_k31)
+        store.add_signatures(signatures_k31[:1])
+        assert not store.needs_compaction(max_segments=2, max_tombstone_ratio=1)
+        store.add_signatures(signatures_k31[1:2])
+        assert store.needs_compaction(max_segments=2, max_tombstone_ratio=1)
+
+        result = store.compact(max_segments=2, max_tombstone_ratio=1)
+
+        assert result.is_compacted
+        assert result.merged == ["segment-000001", "segment-000002"]
+        segments = store.index.manifest.segments
+        assert [seg.name for seg in segments] == ["segment-000000", "segment-000003"]
+        assert len(store.list_signatures()) == 6
+        # merged segments are kept for searches that already read their paths
+        assert (store.index_path / "segment-000001").exists()
+        retired = [seg.name for seg in store.index.manifest.retired]
+        assert retired == ["segment-000001", "segment-000002"]
+
+    def test_retired_segments_are_deleted_after_grace(
+        self, tmp_index_dir: Path, signatures_k31
+    ):
+        """A later compaction deletes the merged segments."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+        store.add_signatures(signatures_k31[:2])
+        store.add_signatures(signatures_k31[2:])
+        store.compact(max_segments=8, max_tombstone_ratio=0.1)
+
+        assert store.compact(max_segments=8, max_tombstone_ratio=0.1).deleted == []
+        store.retired_grace = dt.timedelta(0)
+        result = store.compact(max_segments=8, max_tombstone_ratio=0.1)
+
+        assert not result.is_compacted
+        assert result.deleted == ["segment-000000", "segment-000001"]
+        assert not (store.index_path / "segment-000000").exists()
+        assert store.index.manifest.retired == []
+        assert len(store.list_signatures()) == 4
+
+    def test_remove_duplicated_checksum(self, tmp_index_dir: Path, signatures_k31):
+        """A checksum in several segments is removed once."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+        sig = signatures_k31[0]
+        store.add_signatures([sig])
+        store.add_signatures([sig])
+
+        result = store.remove_signatures({sig.md5sum(), "missing"})
+
+        assert result.removed == [sig.md5sum()]
+        assert result.removed_count == 1
+        assert store.list_signatures() == []
+
+    def test_compaction_drops_removed_signatures(
+        self, tmp_index_dir: Path, signatures_k31
+    ):
+        """Removed signatures are dropped when all segments are merged."""
+        store = RocksDBIndexStore(tmp_index_dir / "test_rocksdb")
+        store.add_signatures(signatures_k31)
+        removed = signatures_k31[0].md5sum()
+        store.remove_signatures({removed})
+
+        result = store.compact(max_segments=8, max_tombstone_ratio=0.1)
+
+        assert result.is_compacted
+        assert result.dropped_count == 1
+        assert store.index.manifest.tombstones == {}
+        assert removed not in {s.md5sum() for s in store.index.signatures()}
+        assert len(store.list_signatures()) == 3
+
+    def test_other_store_reads_compacted_index(
+        self, tmp_index_dir: Path, signatures_k31
+    ):
+        """A store loaded before the compaction reloads the new segments."""
+        index_path = tmp_index_dir / "test_rocksdb"
+        store = RocksDBIndexStore(index_path)
+        store.add_signatures(signatures_k31[:2])
+        store.add_signatures(signatures_k31[2:])
+        other_store = RocksDBIndexStore(index_path)
+        assert len(other_store.index.manifest.segments) == 2
+
+        store.compact(max_segments=8, max_tombstone_ratio=0.1)
+
+        assert len(other_store.index.manifest.segments) == 1
+        assert len(other_store.list_signatures()) == 4
 
 
 class TestLockManagement:
@@ -421,15 +584,16 @@ class TestErrorHandling:
             with pytest.raises(Exception):
                 store.remove_signatures({"checksum"})
 
-    def test_rocksdb_rebuild_on_error(self, tmp_index_dir: Path, mock_signature):
-        """RocksDB rebuild handles errors."""
+    def test_rocksdb_add_segment_on_error(self, tmp_index_dir: Path, mock_signature):
+        """RocksDB add handles errors when writing the segment."""
         index_path = tmp_index_dir / "test"
 
-        with patch("sourmash.index.revindex.DiskRevIndex") as mock_class:
-            mock_class.create_from_sigs.side_effect = Exception("Rebuild failed")
-
+        with patch(
+            "minhash_service.signatures.index.DiskRevIndex.create_from_sigs",
+            side_effect=Exception("Rebuild failed"),
+        ):
             store = RocksDBIndexStore(index_path)
             result = store.add_signatures([mock_signature])
 
-            assert result.ok is False
+            assert result.is_successful is False
             assert len(result.warnings) > 0
@@ -56,6 +56,13 @@ class TestSchemaManagement:
         indexed_index = calls[1][0][0]
         assert ("has_been_indexed", 1) in indexed_index
 
+    def test_ensure_indexes_signature_checksum_index(self, repo):
+        """Verify index on signature checksum and kmer size."""
+        repo.ensure_indexes()
+
+        indexes = [call[0][0] for call in repo._col.create_index.call_args_list]
+        assert [("signature_checksum", 1), ("kmer_size", 1)] in indexes
+
 
 class TestAddSignature:
     """Test signature creation."""
@@ -270,6 +277,49 @@ class TestGetByQuery:
             )
 
 
+class TestBulkQuery:
+    """Test queries for several samples or checksums at once."""
+
+    def test_get_many_by_sample_ids(self, repo):
+        """All samples are fetched in one query."""
+        repo._col.find.return_value.__iter__ = lambda self: iter(
+            [
+                {
+                    "sample_id": sample_id,
+                    "kmer_size": 31,
+                    "signature_checksum": f"check_{sample_id}",
+                    "file_checksum": f"file_{sample_id}",
+                    "signature_path": f"path/to/{sample_id}",
+                }
+                for sample_id in ("sample_1", "sample_2")
+            ]
+        )
+
+        results = repo.get_many_by_sample_ids(["sample_1", "sample_2"], kmer_size=31)
+
+        assert [rec.sample_id for rec in results] == ["sample_1", "sample_2"]
+        repo._col.find.assert_called_once()
+        query = repo._col.find.call_args[0][0]
+        assert sorted(query["sample_id"]["$in"]) == ["sample_1", "sample_2"]
+        assert query["kmer_size"] == 31
+
+    def test_get_sample_ids_by_checksums(self, repo):
+        """Checksums are mapped to the first sample with them."""
+        repo._col.find.return_value.__iter__ = lambda self: iter(
+            [
+                {"sample_id": "sample_1", "signature_checksum": "check_abc"},
+                {"sample_id": "sample_1_dupl", "signature_checksum": "check_abc"},
+                {"sample_id": "sample_2", "signature_checksum": "check_def"},
+            ]
+        )
+
+        result = repo.get_sample_ids_by_checksums(["check_abc", "check_def"])
+
+        assert result == {"check_abc": "sample_1", "check_def": "sample_2"}
+        projection = repo._col.find.call_args[1]["projection"]
+        assert projection == {"_id": 0, "sample_id": 1, "signature_checksum": 1}
+
+
 class TestIterators:
     """Test iteration methods."""
 
@@ -335,6 +385,22 @@ class TestIterators:
         )
         cursor_mock.limit.assert_called_once_with(10)
 
+    def test_get_unindexed_signatures_to_add(self, repo):
+        """Get unindexed signatures of a kmer size that can be added to the index."""
+        repo._col.find.return_value.__iter__ = lambda self: iter([])
+
+        list(repo.get_unindexed_signatures(kmer_size=31, skip_excluded=True))
+
+        repo._col.find.assert_called_once_with(
+            {
+                "has_been_indexed": False,
+                "kmer_size": 31,
+                "exclude_from_analysis": {"$ne": True},
+                "marked_for_deletion": {"$ne": True},
+            },
+            projection={"_id": 0},
+        )
+
 
 class TestCountByChecksum:
     """Test count operations."""
@@ -414,6 +480,47 @@ class TestFlagOperations:
         result = repo.marked_for_deletion("sample_1")
 
         assert result is True
+        # the field of the record, which unindexed signature queries filter on
+        query, update = repo._col.update_one.call_args[0]
+        assert query["marked_for_deletion"] == {"$ne": True}
+        assert update == {"$set": {"marked_for_deletion": True}}
+
+    def test_mark_many_indexed(self, repo):
+        """Samples that are not indexed are marked with one update."""
+        repo._col.update_many.return_value.modified_count = 1
+
+        result = repo.mark_many_indexed(["sample_1", "sample_2", "sample_1"])
+
+        assert result == 1
+        repo._col.update_many.assert_called_once()
+        query, update = repo._col.update_many.call_args[0]
+        assert sorted(query["sample_id"]["$in"]) == ["sample_1", "sample_2"]
+        assert query["has_been_indexed"] == {"$ne": True}
+        assert update == {"$set": {"has_been_indexed": True}}
+        repo._col.find.assert_not_called()
+
+    def test_exclude_many_from_analysis(self, repo):
+        """Only samples that are not excluded are updated and returned."""
+        repo._col.find.return_value = [{"sample_id": "sample_2"}]
+
+        result = repo.exclude_many_from_analysis(["sample_1", "sample_2", "sample_2"])
+
+        assert result == ["sample_2"]
+        query = repo._col.find.call_args[0][0]
+        assert query["sample_id"] == {"$in": ["sample_1", "sample_2"]}
+        assert query["exclude_from_analysis"] == {"$ne": True}
+        query, update = repo._col.update_many.call_args[0]
+        assert query["sample_id"] == {"$in": ["sample_2"]}
+        assert update == {"$set": {"exclude_from_analysis": True}}
+
+    def test_include_many_already_included(self, repo):
+        """Nothing is updated if all samples are already included."""
+        repo._col.find.return_value = []
+
+        result = repo.include_many_in_analysis(["sample_1"])
+
+        assert result == []
+        repo._col.update_many.assert_not_called()
 
 
 class TestRemoveOperations: